@@ -0,0 +1,168 @@
+import time
+import logging
+import threading
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from record_helper import Record, omitted
+from metrics_helper import metrics, in_current_context
+
+
+default_batch_size = 1000
+default_max_rows = 1000
+default_max_bytes = 20000000
+default_workers = 1
+
+logger = logging.getLogger('BatchHelper')
+
+
+def configure_batches(max_rows=None, max_bytes=None, workers=None):
+    global default_max_rows, default_max_bytes, default_workers
+    if max_rows:
+        default_max_rows = max_rows
+    if max_bytes:
+        default_max_bytes = max_bytes
+    if workers:
+        default_workers = workers
+
+
+# Splits any iterable of values, e.g. a themis_helper.iter_table_values generator, into lists
+# of at most size elements, so a stage never holds more than one batch of rows in memory.
+def split_every(iterable, size=default_batch_size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+# Cheap approximation of the size a value takes in the request body, without marshalling it twice.
+def estimate_value_size(value):
+    if isinstance(value, (str, bytes)):
+        return len(value) + 16
+    if isinstance(value, dict):
+        return sum(len(str(key)) + estimate_value_size(val) for key, val in value.items()) + 32
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_value_size(val) for val in value) + 32
+    if isinstance(value, Record):
+        return sum(len(field) + estimate_value_size(val) for field, val in zip(value.schema.fields, value.values) if val is not omitted) + 32
+    return 32
+
+
+def plan_batches(vals, max_rows, max_bytes, size_function=estimate_value_size):
+    batch = []
+    batch_size = 0
+    for val in vals:
+        val_size = size_function(val)
+        if batch and (len(batch) >= max_rows or batch_size + val_size > max_bytes):
+            yield batch, batch_size
+            batch = []
+            batch_size = 0
+        batch.append(val)
+        batch_size += val_size
+    if batch:
+        yield batch, batch_size
+
+
+def get_error_reason(error):
+    return type(error).__name__ + ": " + str(error)
+
+
+class BatchLoader:
+    # execute is called with a list of values and has to return a list with one result per value,
+    # in the same order, so results can still be zipped with the Themis id list of the stage.
+    # on_result(batch, result) is called for every sent batch, in input order, and
+    # on_failure(vals, reason) for every value that failed on its own.
+    # A failing batch is split in two until the values that fail are found. With probe_bytes it is
+    # first sent again in probe batches of at most probe_bytes and only a failing probe batch is
+    # split, so large values like documents are not sent over and over.
+    def __init__(self, execute, label="records", max_rows=None, max_bytes=None, size_function=estimate_value_size, workers=None, on_result=None,
+                 on_failure=None, probe_bytes=None):
+        self.execute = execute
+        self.on_result = on_result
+        self.on_failure = on_failure
+        self.label = label
+        self.max_rows = max_rows or default_max_rows
+        self.max_bytes = max_bytes or default_max_bytes
+        self.probe_bytes = probe_bytes
+        self.size_function = size_function
+        self.workers = workers or default_workers
+        self.lock = threading.Lock()
+        self.batch_count = 0
+        self.row_count = 0
+        self.byte_count = 0
+        self.failed_count = 0
+        self.duration = 0.0
+
+    def execute_batch(self, batch, probe=True):
+        try:
+            return self.execute(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self.fail(batch[0], get_error_reason(e))
+                return [False]
+            metrics.count("retries")
+            if self.probe_bytes and probe:
+                probe_batches = [probe_batch for probe_batch, probe_size in plan_batches(batch, self.max_rows, self.probe_bytes, self.size_function)]
+                if len(probe_batches) > 1:
+                    logger.warning("Error occured when migrating " + self.label + ", sending batch of " + str(len(batch)) + " again in "
+                                   + str(len(probe_batches)) + " batches of at most " + str(self.probe_bytes) + " bytes: " + get_error_reason(e))
+                    return [result for probe_batch in probe_batches for result in self.execute_batch(probe_batch, False)]
+            logger.warning("Error occured when migrating " + self.label + ", splitting batch of " + str(len(batch)) + " into 2: " + get_error_reason(e))
+            return self.execute_batch(batch[:len(batch) // 2], False) + self.execute_batch(batch[len(batch) // 2:], False)
+
+    def fail(self, vals, reason):
+        logger.error("Error occured when migrating " + self.label + ": " + reason)
+        logger.error("Failed values: " + str(vals)[:500])
+        with self.lock:
+            self.failed_count += 1
+        metrics.count("failed_rows")
+        if self.on_failure:
+            self.on_failure(vals, reason)
+
+    def timed_execute_batch(self, batch, batch_size):
+        start = time.perf_counter()
+        result = self.execute_batch(batch)
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.batch_count += 1
+            self.row_count += len(batch)
+            self.byte_count += batch_size
+            self.duration += duration
+            batch_number = self.batch_count
+        metrics.count("rows", len(batch))
+        logger.info("Batch " + str(batch_number) + " of " + self.label + ": " + str(len(batch)) + " rows, "
+                    + str(batch_size) + " bytes in " + format(duration, ".2f") + "s ("
+                    + format(len(batch) / max(duration, 1e-6), ".0f") + " rows/s, "
+                    + format(batch_size / max(duration, 1e-6) / 1000000, ".2f") + " MB/s)")
+        return result
+
+    # The next batch is planned (and its values preprocessed by the vals generator) while up to
+    # workers previous batches are still being sent, e.g. over the pooled connections of an
+    # OdooSession. Results are collected in submission order, so they stay aligned with the input.
+    def load(self, vals):
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for batch, batch_size in plan_batches(vals, self.max_rows, self.max_bytes, self.size_function):
+                if len(pending) >= self.workers:
+                    results.extend(self.collect(*pending.popleft()))
+                pending.append((batch, executor.submit(in_current_context(self.timed_execute_batch), batch, batch_size)))
+            while pending:
+                results.extend(self.collect(*pending.popleft()))
+        self.log_summary()
+        return results
+
+    def collect(self, batch, future):
+        result = future.result()
+        if self.on_result:
+            self.on_result(batch, result)
+        return result
+
+    def log_summary(self):
+        if self.batch_count:
+            logger.info("Sent " + str(self.row_count) + " " + self.label + " in " + str(self.batch_count) + " batches, "
+                        + str(self.byte_count) + " bytes in " + format(self.duration, ".2f") + "s ("
+                        + format(self.row_count / max(self.duration, 1e-6), ".0f") + " rows/s), "
+                        + str(self.failed_count) + " failed.")
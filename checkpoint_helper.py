@@ -0,0 +1,320 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from collections import Counter
+from decimal import Decimal
+from datetime import date, datetime
+
+from mapping_helper import IdMapping, compact_mapping
+
+
+logger = logging.getLogger('Checkpoint')
+
+
+# Watermark values are Themis ids and timestamps, which JSON can not tell apart from strings
+def encode_watermark(watermark):
+    encoded = {}
+    for col, value in watermark.items():
+        if isinstance(value, datetime):
+            encoded[col] = {"datetime": value.isoformat()}
+        elif isinstance(value, date):
+            encoded[col] = {"date": value.isoformat()}
+        else:
+            encoded[col] = {"value": value}
+    return json.dumps(encoded)
+
+
+def decode_watermark(watermark_string):
+    watermark = {}
+    for col, value in json.loads(watermark_string).items():
+        if "datetime" in value:
+            watermark[col] = datetime.fromisoformat(value["datetime"])
+        elif "date" in value:
+            watermark[col] = date.fromisoformat(value["date"])
+        else:
+            watermark[col] = value["value"]
+    return watermark
+
+
+# Values read from Themis that JSON has no type for: NUMERIC columns (e.g. the tariffs in a stage
+# result) come back as Decimal and are stored as numbers, dates as ISO strings
+def json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+
+def dump_json(value):
+    return json.dumps(value, default=json_default)
+
+
+# JSON lists come back as tuples, so keys like the (case, contact, company, category) of a party
+# can be looked up in a dict or set
+def hashable_key(key):
+    if isinstance(key, list):
+        return tuple(hashable_key(part) for part in key)
+    return key
+
+
+# Append-only JSON lines file with the values a stage could not migrate and the reason, e.g. the
+# documents that Odoo refused, so they can be looked into and sent again (see main.py --retry-failed).
+# The last entry of a key counts, and the entries of a key are removed when it is migrated later on.
+class DeadLetterFile:
+    def __init__(self, path, reset=False):
+        self.path = path
+        self.lock = threading.Lock()
+        if reset and os.path.exists(path):
+            os.remove(path)
+        self.keys = set((stage, json.dumps(key)) for stage, key in self.load())
+
+    def read_entries(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as dead_letters:
+            return [json.loads(line) for line in dead_letters if line.strip()]
+
+    # The last entry of every (stage, key), by (stage, key)
+    def load(self, stage=None):
+        with self.lock:
+            entries = self.read_entries()
+        return dict(((entry["stage"], hashable_key(entry["key"])), entry) for entry in entries if stage is None or entry["stage"] == stage)
+
+    def add(self, stage, key, reason, details=None):
+        entry = {"stage": stage, "key": key, "reason": reason, "failed": datetime.now().isoformat(" ", "seconds"), "details": details or {}}
+        with self.lock:
+            with open(self.path, "a") as dead_letters:
+                dead_letters.write(dump_json(entry) + "\n")
+            self.keys.add((stage, json.dumps(key)))
+
+    def resolve(self, stage, keys):
+        with self.lock:
+            resolved = set((stage, json.dumps(key)) for key in keys) & self.keys
+            if not resolved:
+                return
+            entries = [entry for entry in self.read_entries() if (entry["stage"], json.dumps(entry["key"])) not in resolved]
+            with open(self.path + ".tmp", "w") as dead_letters:
+                dead_letters.writelines(dump_json(entry) + "\n" for entry in entries)
+            os.replace(self.path + ".tmp", self.path)
+            self.keys -= resolved
+
+
+# Local SQLite store with the Themis -> Odoo mappings and the progress of every stage, committed
+# batch by batch, so an interrupted migration can resume after the last committed batch.
+# Keys and values are stored as JSON, so integer Themis ids come back as integers.
+# The store also keeps the high-water mark of every extracted table. A delta run keeps the store
+# of the previous run, reruns the given stages on the rows above the watermarks and updates the
+# records that are already in the mappings. A resumed run continues in the mode it was started in.
+# Values that failed are kept in a DeadLetterFile at dead_letter_path, which a new run starts over.
+class CheckpointStore:
+    def __init__(self, path, resume=False, delta=False, dead_letter_path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dead_letters = DeadLetterFile(dead_letter_path, not resume and not delta) if dead_letter_path else None
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if not resume and not delta:
+            for table in ["stage", "mapping", "watermark", "setting"]:
+                self.connection.execute("drop table if exists " + table)
+        self.connection.execute("create table if not exists stage (name text primary key, finished text, result text)")
+        self.connection.execute("create table if not exists mapping (stage text, name text, key text, value text, primary key (stage, name, key))")
+        self.connection.execute("create table if not exists watermark (table_name text primary key, value text)")
+        self.connection.execute("create table if not exists setting (name text primary key, value text)")
+        self.connection.commit()
+        if resume:
+            self.delta = bool(self.load_setting("delta"))
+        else:
+            self.delta = delta
+            self.save_setting("delta", delta)
+        # Watermarks of the tables read by a running stage, saved when the stage finishes
+        self.pending_watermarks = {}
+
+    # Settings of the run that a resumed or delta run keeps, e.g. the case ranges of the shards
+    def load_setting(self, name, default=None):
+        with self.lock:
+            row = self.connection.execute("select value from setting where name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def save_setting(self, name, value):
+        with self.lock:
+            self.connection.execute("insert or replace into setting (name, value) values (?, ?)", (name, dump_json(value)))
+            self.connection.commit()
+
+    # Starts a delta run of the stages: they run again and start over without their resume points
+    def reset_stages(self, stages):
+        with self.lock:
+            for stage in stages:
+                self.connection.execute("delete from stage where name = ?", (stage,))
+                self.connection.execute("delete from mapping where stage = ? and name = 'resume'", (stage,))
+            self.connection.commit()
+
+    def load_watermark(self, table_name):
+        with self.lock:
+            row = self.connection.execute("select value from watermark where table_name = ?", (table_name,)).fetchone()
+        return decode_watermark(row[0]) if row else None
+
+    def set_watermark(self, stage, table_name, watermark):
+        with self.lock:
+            self.pending_watermarks.setdefault(stage, {})[table_name] = watermark
+
+    def stage(self, name):
+        return StageCheckpoint(self, name)
+
+    def is_finished(self, name):
+        with self.lock:
+            row = self.connection.execute("select finished from stage where name = ?", (name,)).fetchone()
+        return bool(row and row[0])
+
+    # mapping_type is called with the items, e.g. IdMapping, which are read one by one
+    def load_mapping(self, stage, name, mapping_type=dict):
+        with self.lock:
+            rows = self.connection.execute("select key, value from mapping where stage = ? and name = ?", (stage, name))
+            return mapping_type((json.loads(key), json.loads(value)) for key, value in rows)
+
+    def save_mapping(self, stage, name, items):
+        with self.lock:
+            self.connection.executemany("insert or replace into mapping (stage, name, key, value) values (?, ?, ?, ?)",
+                                        ((stage, name, dump_json(key), dump_json(value)) for key, value in items))
+            self.connection.commit()
+
+    # Dicts in the stage result are stored as mappings, everything else as JSON
+    def finish(self, stage, result):
+        parts = result if isinstance(result, tuple) else (result,)
+        layout = []
+        for index, part in enumerate(parts):
+            if isinstance(part, (dict, IdMapping)):
+                self.save_mapping(stage, "result" + str(index), part.items())
+                layout.append({"mapping": "result" + str(index)})
+            else:
+                layout.append({"value": part})
+        result_string = dump_json({"tuple": isinstance(result, tuple), "parts": layout})
+        with self.lock:
+            self.connection.execute("insert into stage (name, finished, result) values (?, ?, ?) on conflict (name) do update set finished = excluded.finished, result = excluded.result",
+                                    (stage, datetime.now().isoformat(), result_string))
+            self.connection.executemany("insert or replace into watermark (table_name, value) values (?, ?)",
+                                        [(table_name, encode_watermark(watermark)) for table_name, watermark in self.pending_watermarks.pop(stage, {}).items()])
+            self.connection.commit()
+
+    def load_dead_letters(self, stage):
+        if not self.dead_letters:
+            return {}
+        return dict((key, entry) for (entry_stage, key), entry in self.dead_letters.load(stage).items())
+
+    def load_result(self, stage):
+        with self.lock:
+            row = self.connection.execute("select result from stage where name = ?", (stage,)).fetchone()
+        result = json.loads(row[0])
+        parts = tuple(self.load_mapping(stage, part["mapping"], compact_mapping) if "mapping" in part else part["value"] for part in result["parts"])
+        return parts if result["tuple"] else parts[0]
+
+    # Runs a stage, or returns its stored result when a previous run already finished it. In a delta
+    # run the stage only returns the mappings of the changed rows, they are merged with the stored ones.
+    def run(self, stage, function, *args, **kwargs):
+        if self.is_finished(stage):
+            logger.info("Skipping finished stage " + stage + ".")
+            return self.load_result(stage)
+        result = function(*args, **kwargs)
+        self.finish(stage, result)
+        return self.load_result(stage) if self.delta else result
+
+    def close(self):
+        self.connection.close()
+
+
+# Checkpoint handle passed to a stage. Without a store nothing is loaded or saved, so stages
+# behave the same with and without checkpoints.
+class StageCheckpoint:
+    def __init__(self, store, stage):
+        self.store = store
+        self.stage = stage
+        self.delta = bool(store and store.delta)
+
+    def load_mapping(self, name, mapping_type=dict):
+        return self.store.load_mapping(self.stage, name, mapping_type) if self.store else mapping_type()
+
+    def save_mapping(self, name, items):
+        if self.store:
+            self.store.save_mapping(self.stage, name, items)
+
+    def add_dead_letter(self, key, reason, details=None):
+        if self.store and self.store.dead_letters:
+            self.store.dead_letters.add(self.stage, key, reason, details)
+
+    def resolve_dead_letters(self, keys):
+        if self.store and self.store.dead_letters:
+            self.store.dead_letters.resolve(self.stage, keys)
+
+    def resume_point(self, name):
+        return ResumePoint(self, name)
+
+    # BatchLoader callback that stores the Odoo ids of every committed batch. The ids of the sent
+    # values are taken from id_list in order, failed values are not stored so a resumed run retries them.
+    def mapping_committer(self, name, id_list, id_mapping):
+        position = 0
+
+        def commit(batch, result):
+            nonlocal position
+            items = list(zip(id_list[position:position + len(batch)], result))
+            position += len(batch)
+            id_mapping.update(items)
+            self.save_mapping(name, [(key, value) for key, value in items if value])
+        return commit
+
+
+no_checkpoint = StageCheckpoint(None, None)
+
+
+# Where a stage without Odoo ids to store (e.g. the timesheets) resumes. Its input is ordered by a
+# Themis key and read by group, the first column of the order: the ID of a timesheet or the case of a
+# party. The last committed group and the keys committed in it are stored with every batch, a resumed
+# run reads the rows from that group on (see group) and track skips the keys that were committed.
+# Rows that are added, removed or billed in the meantime do not shift what is skipped, unlike a count.
+# Values that fail are kept as dead letters with [name, key], a resumed run does not send them again.
+class ResumePoint:
+    def __init__(self, checkpoint, name):
+        self.checkpoint = checkpoint
+        self.name = name
+        resume = checkpoint.load_mapping("resume")
+        # Nothing is committed without a stored resume point, while None is the group of rows without a case
+        self.started = name in resume
+        self.group, self.group_keys = resume.get(name, [None, []])
+        self.committed = Counter(json.dumps(key) for key in self.group_keys)
+        # (group, key) of the values that are sent, by id of the value
+        self.keys = {}
+
+    # The values of the batch that were not committed yet. get_key(vals) returns the (group, key)
+    # of a value, it is called before the values are preprocessed.
+    def track(self, batch, get_key):
+        tracked = []
+        for vals in batch:
+            group, key = get_key(vals)
+            if self.committed and group == self.group:
+                key_string = json.dumps(key)
+                if self.committed[key_string]:
+                    self.committed[key_string] -= 1
+                    continue
+            self.keys[id(vals)] = (group, key)
+            tracked.append(vals)
+        return tracked
+
+    # BatchLoader on_result callback, batches are committed in input order
+    def commit(self, batch, result):
+        succeeded = []
+        for vals, value in zip(batch, result):
+            group, key = self.keys.pop(id(vals))
+            if group != self.group or not self.started:
+                self.group = group
+                self.group_keys = []
+                self.started = True
+            self.group_keys.append(key)
+            if value:
+                succeeded.append([self.name, key])
+        self.checkpoint.save_mapping("resume", [(self.name, [self.group, self.group_keys])])
+        self.checkpoint.resolve_dead_letters(succeeded)
+
+    # BatchLoader on_failure callback
+    def fail(self, vals, reason):
+        group, key = self.keys[id(vals)]
+        self.checkpoint.add_dead_letter([self.name, key], reason)
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import queue
+import sqlite3
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_helper import get_error_reason
+from metrics_helper import in_current_context
+
+
+default_readers = 4
+# Case folders that are listed at the same time, on a network share most of the time of a
+# listing is waiting for the server
+default_index_workers = 16
+
+logger = logging.getLogger('DocumentHelper')
+
+
+# SHA-1 of the content of a file, the checksum Odoo keeps of every attachment
+def hash_file(path, chunk_size=1024 * 1024):
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as data:
+        for block in iter(lambda: data.read(chunk_size), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+# Case folders are named after the Themis id of their case. case_range is the (low, high) range of
+# the cases of a shard, either end can be None.
+def in_case_range(folder, case_range=None):
+    if case_range is None:
+        return True
+    low, high = case_range
+    return folder.isdigit() and (low is None or int(folder) >= low) and (high is None or int(folder) < high)
+
+
+# Size and modification time of the files in the case folders of the documents folder, by folder
+# name and file name, see scan_document_folder. The index lists every case folder of case_range, so
+# a file that is not in it is missing, also when its whole case folder is. Only other paths (a file
+# name with a subfolder, a folder outside case_range) are looked up on disk.
+class DocumentIndex:
+    def __init__(self, document_path, folders, case_range=None):
+        self.document_path = document_path
+        self.folders = folders
+        self.case_range = case_range
+        self.missing_count = 0
+        self.lock = threading.Lock()
+
+    # (size, modification time in ns) of the file, raises FileNotFoundError like os.stat
+    def stat(self, folder, filename):
+        if "/" in filename or os.sep in filename or not in_case_range(folder, self.case_range):
+            stat = os.stat(os.path.join(self.document_path, folder, filename))
+            return stat.st_size, stat.st_mtime_ns
+        file_stat = self.folders.get(folder, {}).get(filename)
+        if file_stat is None:
+            with self.lock:
+                self.missing_count += 1
+            raise FileNotFoundError("File " + filename + " is not in case folder " + folder)
+        return file_stat
+
+    def file_count(self):
+        return sum(len(files) for files in self.folders.values())
+
+    # The documents without a file, as a list of file names by case folder, from (folder, file name) pairs
+    def find_missing(self, documents):
+        missing = {}
+        for folder, filename in documents:
+            folder = str(folder)
+            if not filename or "/" in filename or os.sep in filename or not in_case_range(folder, self.case_range):
+                continue
+            if filename not in self.folders.get(folder, {}):
+                missing.setdefault(folder, []).append(filename)
+        return missing
+
+    # Logs the documents without a file, the case folders that are missing as a whole apart
+    def report_missing(self, documents):
+        missing = self.find_missing(documents)
+        if not missing:
+            logger.info("Every document has a file in " + self.document_path + ".")
+            return missing
+        missing_folders = [folder for folder in missing if folder not in self.folders]
+        logger.warning(str(sum(len(filenames) for filenames in missing.values())) + " documents have no file in " + self.document_path + ": "
+                       + str(len(missing_folders)) + " case folders are missing and " + str(len(missing) - len(missing_folders)) + " case folders miss files.")
+        for folder, filenames in sorted(missing.items()):
+            if folder in self.folders:
+                logger.info("Case folder " + folder + " misses " + str(len(filenames)) + " files: " + ", ".join(filenames))
+            else:
+                logger.info("Case folder " + folder + " of " + str(len(filenames)) + " documents is missing.")
+        return missing
+
+    # Pickled without the lock, e.g. when StageScheduler spills the index to disk
+    def __getstate__(self):
+        return self.document_path, self.folders, self.case_range, self.missing_count
+
+    def __setstate__(self, state):
+        self.document_path, self.folders, self.case_range, self.missing_count = state
+        self.lock = threading.Lock()
+
+
+def scan_case_folder(path):
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+# Lists the case folders of the documents folder in one pass, workers folders at a time, instead
+# of looking up every document on its own. With case_range only the case folders of those cases
+# are listed, e.g. of a shard. documents are the (case folder, file name) pairs of the documents
+# that will be migrated, the ones without a file are reported right away. With cache_path the listings are kept in a SQLite file, and a folder whose
+# modification time did not change is not listed again. A folder only changes when files are added,
+# removed or renamed, so a file that is overwritten in place keeps its cached size and time.
+def scan_document_folder(document_path, workers=default_index_workers, cache_path=None, case_range=None, documents=None):
+    logger.info("Indexing the documents folder " + document_path + " ...")
+    start = time.perf_counter()
+    folder_times = {}
+    with os.scandir(document_path) as entries:
+        for entry in entries:
+            if entry.is_dir() and in_case_range(entry.name, case_range):
+                folder_times[entry.name] = entry.stat().st_mtime_ns
+    connection = None
+    cached = {}
+    if cache_path:
+        connection = sqlite3.connect(cache_path)
+        connection.execute("create table if not exists folder (name text primary key, mtime integer, files text)")
+        for name, mtime_ns, files in connection.execute("select name, mtime, files from folder"):
+            if folder_times.get(name) == mtime_ns:
+                cached[name] = dict((filename, tuple(file_stat)) for filename, file_stat in json.loads(files).items())
+    scanned_names = [name for name in folder_times if name not in cached]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        scanned = dict(zip(scanned_names, executor.map(scan_case_folder, [os.path.join(document_path, name) for name in scanned_names])))
+    if connection:
+        try:
+            connection.executemany("insert or replace into folder (name, mtime, files) values (?, ?, ?)",
+                                   ((name, folder_times[name], json.dumps(files)) for name, files in scanned.items()))
+            connection.commit()
+        finally:
+            connection.close()
+    folders = dict(cached)
+    folders.update(scanned)
+    index = DocumentIndex(document_path, folders, case_range)
+    logger.info("Indexed " + str(index.file_count()) + " files in " + str(len(folder_times)) + " case folders (" + str(len(cached))
+                + " from the cache) in " + format(time.perf_counter() - start, ".2f") + "s.")
+    if documents is not None:
+        index.report_missing(documents)
+    return index
+
+
+# Caps the number of encoded document bytes that are read but not uploaded yet. A single
+# document larger than the limit is still let through when nothing else is in flight.
+# acquire returns False once the budget is stopped, e.g. because the uploads failed.
+class ByteBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.waiting = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            self.waiting += 1
+            while not self.stopped and self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.waiting -= 1
+            if self.stopped:
+                return False
+            self.used += size
+            return True
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    # Takes size without waiting, for the small values that are sent from the uploader threads
+    def add(self, size):
+        with self.condition:
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+# Prepares documents on a pool of reader threads while the batches that are already complete
+# are uploaded by loader.workers uploader threads, so disk, CPU and network overlap.
+# prepare(vals) returns False for documents that can not be sent, and None for documents it holds
+# back, e.g. a copy of content that is still being uploaded, which the callbacks of the loader send
+# later on with release. File contents are only read
+# and encoded while a batch is streamed to Odoo (see transport_helper.DocumentFile), so memory
+# stays at a few encoding chunks per uploader, while max_inflight_bytes caps how many prepared
+# bytes may wait for an upload.
+class DocumentPipeline:
+    def __init__(self, loader, prepare, readers=default_readers, max_inflight_bytes=None):
+        self.loader = loader
+        self.prepare = prepare
+        self.readers = readers
+        self.uploaders = loader.workers
+        self.max_inflight_bytes = max_inflight_bytes or (self.uploaders + 1) * loader.max_bytes
+        self.budget = ByteBudget(self.max_inflight_bytes)
+        self.ready = queue.Queue()
+        self.created_count = 0
+        self.skipped_count = 0
+        self.upload_count = 0
+        self.lock = threading.Lock()
+        # First exception of the uploader thread, run raises it once the readers stopped
+        self.error = None
+
+    def stop(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.budget.stop()
+
+    # Sends a held document, from the on_result and on_failure callbacks of the loader
+    def release(self, vals):
+        size = self.loader.size_function(vals)
+        self.budget.add(size)
+        self.ready.put((vals, size))
+
+    def read_document(self, vals):
+        if self.budget.stopped:
+            return
+        try:
+            prepared = self.prepare(vals)
+            if prepared is None:
+                return
+            if not prepared:
+                with self.lock:
+                    self.skipped_count += 1
+                return
+            size = self.loader.size_function(vals)
+            if self.budget.acquire(size):
+                self.ready.put((vals, size))
+        except Exception as e:
+            self.loader.fail(vals, "Error occured when reading document " + str(vals.get("filename", "")) + ": " + get_error_reason(e))
+
+    def upload_batch(self, batch, batch_size):
+        try:
+            response = self.loader.timed_execute_batch(batch, batch_size)
+            if self.loader.on_result:
+                self.loader.on_result(batch, response)
+            with self.lock:
+                self.created_count += len(list(filter(None, response)))
+        finally:
+            self.budget.release(batch_size)
+            with self.lock:
+                self.upload_count -= 1
+
+    # Yields batches of the documents that are read, until the reader threads are done and no upload
+    # can release a document any more. A partial batch is flushed when the readers are done or
+    # blocked, instead of holding on to budget that the blocked reader threads are waiting for.
+    def ready_batches(self, readers_done):
+        batch = []
+        batch_size = 0
+        while True:
+            try:
+                vals, size = self.ready.get(timeout=0.1)
+            except queue.Empty:
+                if batch and (readers_done.is_set() or self.budget.waiting):
+                    yield batch, batch_size
+                    batch = []
+                    batch_size = 0
+                elif not batch and readers_done.is_set() and not self.upload_count and self.ready.empty():
+                    return
+                continue
+            if batch and (len(batch) >= self.loader.max_rows or batch_size + size > self.loader.max_bytes):
+                yield batch, batch_size
+                batch = []
+                batch_size = 0
+            batch.append(vals)
+            batch_size += size
+
+    # An error of an upload (e.g. of on_result or a checkpoint write) stops the readers, instead of
+    # leaving them waiting for budget that is never released
+    def upload_documents(self, readers_done):
+        try:
+            with ThreadPoolExecutor(max_workers=self.uploaders) as executor:
+                futures = []
+                for batch, batch_size in self.ready_batches(readers_done):
+                    for future in [future for future in futures if future.done()]:
+                        future.result()
+                        futures.remove(future)
+                    with self.lock:
+                        self.upload_count += 1
+                    futures.append(executor.submit(in_current_context(self.upload_batch), batch, batch_size))
+                for future in futures:
+                    future.result()
+        except BaseException as e:
+            self.stop(e)
+
+    def run(self, document_vals):
+        readers_done = threading.Event()
+        uploader = threading.Thread(target=in_current_context(self.upload_documents), args=(readers_done,))
+        uploader.start()
+        # Limits the documents waiting for a reader, so the document rows are still streamed
+        slots = threading.BoundedSemaphore(self.readers * 2)
+
+        def read_document(vals):
+            try:
+                self.read_document(vals)
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.readers) as executor:
+                for vals in document_vals:
+                    slots.acquire()
+                    if self.budget.stopped:
+                        slots.release()
+                        break
+                    executor.submit(in_current_context(read_document), vals)
+        finally:
+            readers_done.set()
+            uploader.join()
+        if self.error is not None:
+            raise self.error
+        self.loader.log_summary()
+        return self.created_count
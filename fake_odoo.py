@@ -0,0 +1,258 @@
+import gzip
+import json
+import time
+import random
+import argparse
+import threading
+import xmlrpc.client
+from itertools import count
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Rows with this text in one of their values make the call that sends them fail, see -fm of
+# synthetic_themis.py. The migration has to split the batch until only the row fails.
+failure_marker = "#fail#"
+
+
+class FakeOdooError(Exception):
+    pass
+
+
+def decompress(body, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "zstd":
+        try:
+            from compression import zstd
+            return zstd.decompress(body)
+        except ImportError:
+            import zstandard
+            return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise FakeOdooError("Content encoding " + encoding + " is not supported")
+
+
+def contains_marker(value):
+    if isinstance(value, str):
+        return failure_marker in value
+    if isinstance(value, dict):
+        return any(contains_marker(val) for val in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(contains_marker(val) for val in value)
+    return False
+
+
+# Stands in for the Odoo models and methods the migration calls (see odoo_helper), it only
+# answers with new ids, keeps the external ids given in the xml_id of the created rows and records the calls. latency is added to every call and row_latency
+# for every row in it. Calls fail at random with failure_rate, and always when a row contains
+# failure_marker. With bandwidth (bytes per second) the request bodies share a link of that speed,
+# and without compressed_requests compressed bodies are refused like Odoo does.
+class FakeOdoo:
+    def __init__(self, latency=0.0, row_latency=0.0, failure_rate=0.0, seed=None, bandwidth=None, compressed_requests=True):
+        self.latency = latency
+        self.row_latency = row_latency
+        self.failure_rate = failure_rate
+        self.bandwidth = bandwidth
+        self.compressed_requests = compressed_requests
+        self.link = threading.Lock()
+        self.random = random.Random(seed)
+        self.ids = count(1)
+        self.lock = threading.Lock()
+        # (module, model, name): res_id of the external ids that were created
+        self.external_ids = {}
+        # (start, end, model, method, rows, request bytes, failed) for every execute_kw
+        self.calls = []
+
+    def authenticate(self, database, login, password, context=None):
+        return 2
+
+    # Creates the records of rows with the external ids in their xml_id, all or nothing like one transaction
+    def create(self, model, rows):
+        with self.lock:
+            keys = [tuple(row["xml_id"].split(".", 1)) for row in rows if isinstance(row, dict) and row.get("xml_id")]
+            for module, name in keys:
+                if (module, model, name) in self.external_ids:
+                    raise FakeOdooError("External id " + module + "." + name + " exists already")
+            ids = [next(self.ids) for row in rows]
+            for row, record_id in zip(rows, ids):
+                if isinstance(row, dict) and row.get("xml_id"):
+                    module, name = row["xml_id"].split(".", 1)
+                    self.external_ids[(module, model, name)] = record_id
+            return ids
+
+    # Only the domain of odoo_helper.ExternalIds: module, model and a list of names
+    def search_external_ids(self, domain):
+        conditions = dict((field, value) for field, operator, value in domain)
+        with self.lock:
+            return [{"id": 0, "name": name, "res_id": self.external_ids[(conditions["module"], conditions["model"], name)]}
+                    for name in conditions["name"] if (conditions["module"], conditions["model"], name) in self.external_ids]
+
+    def execute_kw(self, database, uid, password, model, method, args, kwargs=None):
+        if model == "ir.model.data" and method == "search_read":
+            rows = []
+            operation = lambda: self.search_external_ids(args[0])
+        elif method in ["create", "create_from_themis", "create_timesheet_types_from_themis"]:
+            rows = args[0]
+            operation = lambda: self.create(model, rows)
+        elif method == "create_timesheets_costs_from_themis":
+            rows = args[0] + args[1]
+            operation = lambda: [len(args[0]), len(args[1])]
+        elif method in ["write", "write_from_themis"]:
+            rows = args[0]
+            operation = lambda: True
+        elif model == "res.country" and method == "search_read":
+            rows = []
+            operation = lambda: [{"id": 20, "code": "BE"}, {"id": 21, "code": "NL"}, {"id": 22, "code": "FR"}, {"id": 23, "code": "DE"}, {"id": 24, "code": "LU"}]
+        elif model == "cases.case" and method == "guess_case_clients":
+            rows = []
+            operation = lambda: True
+        else:
+            raise FakeOdooError("Method " + method + " of " + model + " is not implemented by the fake Odoo server")
+        time.sleep(self.latency + self.row_latency * len(rows))
+        with self.lock:
+            failed = self.failure_rate and self.random.random() < self.failure_rate
+        if failed:
+            raise FakeOdooError("Injected failure of " + model + "." + method + " with " + str(len(rows)) + " rows")
+        if contains_marker(rows):
+            raise FakeOdooError("Injected failure of " + model + "." + method + ", a row contains " + failure_marker)
+        # A failed call created nothing, like a rolled back transaction
+        return operation(), len(rows)
+
+    # Time the request body takes on the link, one body at a time
+    def transfer(self, size):
+        if self.bandwidth:
+            with self.link:
+                time.sleep(size / self.bandwidth)
+
+    def dispatch(self, method, params, size):
+        if method == "authenticate":
+            return self.authenticate(*params)
+        if method == "version":
+            return {"server_version": "fake", "protocol_version": 1}
+        if method != "execute_kw":
+            raise FakeOdooError("Method " + method + " is not implemented by the fake Odoo server")
+        start = time.perf_counter()
+        rows = 0
+        failed = True
+        try:
+            result, rows = self.execute_kw(*params)
+            failed = False
+            return result
+        finally:
+            with self.lock:
+                self.calls.append((start, time.perf_counter(), params[3], params[4], rows, size, failed))
+
+    def summary(self):
+        totals = {}
+        with self.lock:
+            calls = list(self.calls)
+        for start, end, model, method, rows, size, failed in calls:
+            total = totals.setdefault((model, method), [0, 0, 0, 0])
+            total[0] += 1
+            total[1] += rows
+            total[2] += size
+            total[3] += failed
+        return totals
+
+
+class FakeOdooHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        size = len(body)
+        self.server.odoo.transfer(size)
+        encoding = self.headers.get("Content-Encoding")
+        if encoding and not self.server.odoo.compressed_requests:
+            self.send_error(415, "Compressed requests are not accepted")
+            return
+        if encoding:
+            body = decompress(body, encoding)
+        if self.path == "/jsonrpc":
+            response = self.handle_jsonrpc(body, size)
+            content_type = "application/json"
+        else:
+            response = self.handle_xmlrpc(body, size)
+            content_type = "text/xml"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def handle_xmlrpc(self, body, size):
+        params, method = xmlrpc.client.loads(body, use_builtin_types=True)
+        try:
+            result = self.server.odoo.dispatch(method, params, size)
+            return xmlrpc.client.dumps((result,), methodresponse=True, allow_none=True).encode("utf-8")
+        except Exception as e:
+            return xmlrpc.client.dumps(xmlrpc.client.Fault(1, str(e)), allow_none=True).encode("utf-8")
+
+    def handle_jsonrpc(self, body, size):
+        request = json.loads(body)
+        params = request["params"]
+        try:
+            result = self.server.odoo.dispatch(params["method"], params["args"], size)
+            response = {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+        except Exception as e:
+            response = {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": 200, "message": "Odoo Server Error",
+                                                                             "data": {"name": type(e).__name__, "message": str(e)}}}
+        return json.dumps(response).encode("utf-8")
+
+
+# Serves a FakeOdoo for both XML-RPC (/xmlrpc/2/common and /xmlrpc/2/object) and JSON-RPC (/jsonrpc)
+# on a thread. Port 0 picks a free port, see url.
+class FakeOdooServer:
+    def __init__(self, odoo, host="127.0.0.1", port=0):
+        self.odoo = odoo
+        self.server = ThreadingHTTPServer((host, port), FakeOdooHandler)
+        self.server.daemon_threads = True
+        self.server.odoo = odoo
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://" + host + ":" + str(port)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+def print_summary(odoo):
+    print("{:<24} {:<36} {:>7} {:>9} {:>14} {:>7}".format("model", "method", "calls", "rows", "bytes", "failed"))
+    for (model, method), (calls, rows, size, failed) in sorted(odoo.summary().items()):
+        print("{:<24} {:<36} {:>7} {:>9} {:>14} {:>7}".format(model, method, calls, rows, size, failed))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Serve a fake Odoo that answers the calls of the Themis migration")
+    parser.add_argument("-host", dest="host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-p", dest="port", type=int, default=8069, help="Port to listen on")
+    parser.add_argument("-l", dest="latency", type=float, default=0.0, help="Seconds added to every call")
+    parser.add_argument("-rl", dest="rowlatency", type=float, default=0.0, help="Seconds added to a call for every row in it")
+    parser.add_argument("-fr", dest="failurerate", type=float, default=0.0, help="Fraction of the calls that fail at random")
+    parser.add_argument("-seed", dest="seed", type=int, help="Seed of the random failures")
+    parser.add_argument("-bw", dest="bandwidth", type=float, help="Speed of the link the requests are sent over, in Mbit/s")
+    parser.add_argument("-plain", dest="plain", action="store_true", help="Refuse compressed requests, like Odoo without a proxy that decodes them")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    odoo = FakeOdoo(args.latency, args.rowlatency, args.failurerate, args.seed, args.bandwidth and args.bandwidth * 125000, not args.plain)
+    server = FakeOdooServer(odoo, args.host, args.port).start()
+    print("Fake Odoo listening on " + server.url + ", stop it with Ctrl+C to print the calls it answered.")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+        print_summary(odoo)
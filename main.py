@@ -1,10 +1,21 @@
 import csv
 import os
+import sys
 import argparse
 import logging
+import threading
+import subprocess
 from pathlib import Path
 
-from themis_helper import connect_to_db, get_table_rows, get_table_values
+from batch_helper import configure_batches
+from checkpoint_helper import CheckpointStore
+from document_helper import scan_document_folder
+from metrics_helper import metrics
+from stage_helper import StageScheduler, default_parallel_stages
+from rtf_helper import RtfConverter, default_rtf_memory_cache_size
+from snapshot_helper import check_snapshot, connect_to_snapshot, write_snapshot
+from themis_helper import check_identifier, connect_to_db, get_bound_ranges, get_partition_bounds, get_range_conditions, get_table_watermark, \
+    iter_partitioned_table_values, iter_table_row_batches, iter_table_values
 from odoo_helper import *
 
 
@@ -20,13 +31,13 @@ def get_db_tables(cr):
 
 
 def get_table_columns(cr, table_name):
-    sql_string = f"""
+    sql_string = """
                 select rdb$field_name
                 from rdb$relation_fields
-                where rdb$relation_name='{table_name}'
+                where rdb$relation_name = ?
                 order by rdb$field_position;
                 """
-    cr.execute(sql_string)
+    cr.execute(sql_string, [check_identifier(table_name)])
     return cr.fetchall()
 
 
@@ -45,13 +56,13 @@ def print_table_columns(cr, table_name):
 def print_table_info_for_id(cr, table_name, id_nr):
     table_cols = get_table_columns(cr, table_name)
     columns = [str(col[0]) for col in table_cols]
-    columns_string = ",".join(columns)
+    columns_string = ",".join(check_identifier(col) for col in columns)
     sql_string = f"""
                 select {columns_string}
-                from {table_name}
-                where id={str(id_nr)}
+                from {check_identifier(table_name)}
+                where id = ?
                 """
-    cr.execute(sql_string)
+    cr.execute(sql_string, [id_nr])
     record = cr.fetchall()[0]
     for name, value in zip(columns, record):
         print(name + ": " + str(value))
@@ -173,6 +184,7 @@ case_timesheet_value_mapping = {
 }
 
 timesheet_value_mapping = {
+    "ID": "id",
     "OMSCHRIJVING": "name",
     "TIJDTYPE_ID": "type_id",
     "DOSSIER_ID": "case_id",
@@ -197,6 +209,7 @@ case_cost_value_mapping = {
 }
 
 cost_value_mapping = {
+    "ID": "id",
     "OMSCHRIJVING": "name",
     "KOSTTYPE_ID": "type_id",
     "DOSSIER_ID": "case_id",
@@ -216,6 +229,7 @@ document_category_value_mapping = {
 # TODO archive documents of archived case
 # TODO create date and write date
 document_value_mapping = {
+    "ID": "id",
     "LINKEDTO_ID": "case_id",
     "OMSCHRIJVING": "name",
     "BESTAND": "filename",
@@ -225,6 +239,12 @@ document_value_mapping = {
     "AANPASDATUM": "write_date",
 }
 
+# Case and file name of a document, see the document index
+document_file_value_mapping = {
+    "LINKEDTO_ID": "case_id",
+    "BESTAND": "filename",
+}
+
 case_description_type_value_mapping = {
     "ID": "id",
     "N": "name",
@@ -236,6 +256,78 @@ case_description_value_mapping = {
     "OPMERKING": "description",
 }
 
+# Columns of the tables that only change by growing or that keep a modification date. A delta run
+# only reads the rows above the high-water mark of the previous run. Parties and case remarks only
+# have the case id, so only the parties and remarks of new cases are found: a remark added to a case
+# that was migrated before is missed, its description is only complete after a full run.
+watermark_columns = {
+    "BEDRIJF": ["ID", "CREATED", "MODIFIED"],
+    "ADRESBOEK": ["ID", "CREATED", "MODIFIED"],
+    "DOSSIER": ["ID", "MODIFIED"],
+    "DOSSIEROPMERKING": ["DOSSIER_ID"],
+    "DOSSIERADRESBOEK": ["DOSSIER_ID"],
+    "DOSSIERTIJD": ["ID"],
+    "DOSSIERKOST": ["ID"],
+    "DOSSIERDOCUMENT": ["ID"],
+}
+
+# Large tables that are read as compact record_helper.Record rows instead of dicts
+record_tables = ["DOSSIERTIJD", "DOSSIERKOST"]
+
+# Column the large tables are split on when they are read on several connections (-tp)
+partition_columns = {
+    "DOSSIEROPMERKING": "DOSSIER_ID",
+    "DOSSIERADRESBOEK": "DOSSIER_ID",
+    "DOSSIERTIJD": "ID",
+    "DOSSIERKOST": "ID",
+    "DOSSIERDOCUMENT": "ID",
+}
+
+# Column with the case of the rows of the tables that are read per case, see -cs
+case_columns = {
+    "DOSSIER": "ID",
+    "DOSSIEROPMERKING": "DOSSIER_ID",
+    "DOSSIERADRESBOEK": "DOSSIER_ID",
+    "DOSSIERTIJD": "DOSSIER_ID",
+    "DOSSIERTIJDTARIEF": "DOSSIER_ID",
+    "DOSSIERKOST": "DOSSIER_ID",
+    "DOSSIERKOSTTARIEF": "DOSSIER_ID",
+    "DOSSIERDOCUMENT": "LINKEDTO_ID",
+}
+
+# With case shards the coordinator runs the stages of the shared records once, and every shard
+# runs the stages of the cases in its range. The shards read the results of the shared stages
+# from the checkpoint of the coordinator.
+shared_stages = ["users", "companies", "contacts", "case categories", "party categories", "timesheet types", "cost types", "document categories"]
+case_stages = ["cases", "case descriptions", "parties", "timesheets and costs", "documents"]
+
+# Stages that run again in a delta run, the others keep the records of the previous run
+delta_stages = ["users", "companies", "contacts", "cases", "case descriptions", "parties", "timesheets and costs", "documents"]
+
+# Stages that keep the rows that failed as dead letters, which --retry-failed sends again
+retry_stages = ["parties", "timesheets and costs", "documents"]
+
+# Value mappings of the tables read by the stages, a snapshot has the columns of these tables
+table_value_mappings = {
+    "GEBRUIKER": user_value_mapping,
+    "ADRESCATEGORIE": party_category_value_mapping,
+    "BEDRIJF": company_value_mapping,
+    "ADRESBOEK": contact_value_mapping,
+    "DOSSIERCATEGORIE": case_category_value_mapping,
+    "DOSSIER": case_value_mapping,
+    "OPMERKINGTYPE": case_description_type_value_mapping,
+    "DOSSIEROPMERKING": case_description_value_mapping,
+    "DOSSIERADRESBOEK": party_value_mapping,
+    "TIJDTYPE": timesheet_type_value_mapping,
+    "DOSSIERTIJDTARIEF": case_timesheet_value_mapping,
+    "DOSSIERTIJD": timesheet_value_mapping,
+    "KOSTTYPE": cost_type_value_mapping,
+    "DOSSIERKOSTTARIEF": case_cost_value_mapping,
+    "DOSSIERKOST": cost_value_mapping,
+    "DOSSIERDOCUMENTMAP": document_category_value_mapping,
+    "DOSSIERDOCUMENT": document_value_mapping,
+}
+
 # def get_table_values(cr, table_name, value_mapping):
 #     columns = list(value_mapping.keys())
 #     records = get_table_rows(cr, table_name, columns)
@@ -250,23 +342,109 @@ def create_table_csv(cr, table_name, filename, columns=None):
     with open(filename, "w") as out:
         csv_out = csv.writer(out)
         csv_out.writerow(columns)
-        csv_out.writerows(get_table_rows(cr, table_name, columns))
+        for rows in iter_table_row_batches(cr, table_name, columns):
+            csv_out.writerows(rows)
+
+
+# The mapped columns of every table, with the columns that are only used to select and split the rows
+def get_snapshot_columns():
+    table_columns = {}
+    for table_name, value_mapping in table_value_mappings.items():
+        columns = list(value_mapping.keys())
+        for column in watermark_columns.get(table_name, []) + [partition_columns.get(table_name), case_columns.get(table_name)]:
+            if column and column not in columns:
+                columns.append(column)
+        table_columns[table_name] = columns
+    return table_columns
+
+
+# The file of a case shard next to the file of the coordinator, e.g. migration.shard0.log
+def get_shard_path(path, shard):
+    path = Path(path)
+    return str(path.with_suffix(".shard" + str(shard) + path.suffix))
+
+
+# Runs every case shard in its own process, with the arguments of this migration, and waits for them
+def run_case_shards(shard_count, logfile):
+    logger = logging.getLogger('ThemisMigration')
+    processes = []
+    for shard in range(shard_count):
+        command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--case-shard", str(shard)]
+        processes.append(subprocess.Popen(command))
+        logger.info("Started case shard " + str(shard) + ", logging to " + get_shard_path(logfile, shard) + ".")
+    failed = [shard for shard, process in enumerate(processes) if process.wait()]
+    if failed:
+        raise RuntimeError("Case shards " + ", ".join(str(shard) for shard in failed) + " failed, see " + ", ".join(get_shard_path(logfile, shard) for shard in failed))
+    logger.info("Migrated the cases in " + str(shard_count) + " shards.")
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Migrate Themis data to Odoo")
-    parser.add_argument("-tdb", dest="themisdb", required=True, help="Path to the Themis database")
-    parser.add_argument("-tdf", dest="documentpath", required=True, help="Path to the Themis documents folder")
-    parser.add_argument("-url", dest="url", required=True, help="Url of the Odoo database")
-    parser.add_argument("-odb", dest="odoodb", required=True, help="Name of the Odoo database")
-    parser.add_argument("-u", dest="user", required=True, help="Odoo user name")
-    parser.add_argument("-s", dest="secret", required=True, help="Odoo user password or API key")
+    parser.add_argument("-tdb", dest="themisdb", help="Path to the Themis database, required unless --from-snapshot is given")
+    parser.add_argument("-tdf", dest="documentpath", help="Path to the Themis documents folder")
+    parser.add_argument("-url", dest="url", help="Url of the Odoo database")
+    parser.add_argument("-odb", dest="odoodb", help="Name of the Odoo database")
+    parser.add_argument("-u", dest="user", help="Odoo user name")
+    parser.add_argument("-s", dest="secret", help="Odoo user password or API key")
     parser.add_argument("-lf", dest="logfile", required=True, help="File location for logs")
-    return parser.parse_args()
+    parser.add_argument("-br", dest="batchrows", type=int, help="Maximum number of records sent in one Odoo call")
+    parser.add_argument("-bb", dest="batchbytes", type=int, help="Maximum (estimated) number of bytes sent in one Odoo call")
+    parser.add_argument("-oc", dest="connections", type=int, default=1, help="Number of parallel keep-alive connections to Odoo")
+    parser.add_argument("-rpc", dest="protocol", choices=["xmlrpc", "jsonrpc"], default="xmlrpc", help="Protocol used for Odoo calls")
+    parser.add_argument("-cz", dest="compression", choices=["gzip", "zstd"], help="Compress the Odoo requests, when the server accepts it (zstd needs the zstandard package before Python 3.14)")
+    parser.add_argument("-dr", dest="documentreaders", type=int, default=4, help="Number of threads reading and encoding documents")
+    parser.add_argument("-dib", dest="documentinflightbytes", type=int, help="Maximum number of document bytes read but not uploaded yet")
+    parser.add_argument("-ddb", dest="documentdedupbytes", type=int, default=default_document_dedup_bytes,
+                        help="Documents of at least this many bytes are uploaded once per content, the others with the same content are copied in Odoo")
+    parser.add_argument("--no-document-index", dest="nodocumentindex", action="store_true", help="Look up every document on disk instead of listing the case folders of the documents folder up front")
+    parser.add_argument("-dic", dest="documentindexcache", help="Path of a cache of the document folder listings, a case folder that did not change since is not listed again. "
+                                                                "A file that is overwritten in place keeps the size and time of the cache.")
+    parser.add_argument("--upload-duplicates", dest="uploadduplicates", action="store_true", help="Upload every document, also when Odoo has its content already")
+    parser.add_argument("-cp", dest="checkpoint", help="Path of the checkpoint database, defaults to the log file path with a .checkpoint extension")
+    parser.add_argument("--resume", dest="resume", action="store_true", help="Resume the migration from the checkpoint database instead of starting over")
+    parser.add_argument("-dl", dest="deadletters", help="Path of the file with the documents that failed, defaults to the log file path with a .failed.jsonl extension")
+    parser.add_argument("--retry-failed", dest="retryfailed", action="store_true", help="Only send the documents, parties, timesheets and costs in the file of -dl again, after a migration that finished")
+    parser.add_argument("--delta", dest="delta", action="store_true", help="Only migrate the rows that changed since the run of the checkpoint database")
+    parser.add_argument("-rp", dest="rtfprocesses", type=int, help="Number of processes converting RTF case descriptions, defaults to the number of CPUs")
+    parser.add_argument("-rmc", dest="rtfmemorycache", type=int, default=default_rtf_memory_cache_size,
+                        help="Number of converted RTF remarks kept in memory, the others are read back from the RTF cache")
+    parser.add_argument("-rc", dest="rtfcache", help="Path of the RTF conversion cache, defaults to the log file path with a .rtfcache extension")
+    parser.add_argument("-tp", dest="themispartitions", type=int, default=1, help="Number of connections the large Themis tables are read on in parallel")
+    parser.add_argument("-ps", dest="parallelstages", type=int, default=default_parallel_stages, help="Maximum number of migration stages that run at the same time")
+    parser.add_argument("-cs", dest="caseshards", type=int, default=1,
+                        help="Number of processes the stages of the cases are run in, each on its own range of cases, after the shared records are migrated")
+    parser.add_argument("--case-shard", dest="caseshard", type=int, help="Only run the stages of this case shard (0 is the first), started by a migration with -cs")
+    parser.add_argument("-mb", dest="memorybudget", type=int, help="Memory budget in MB, above it the mappings that only later stages need are spilled to the folder of the log file")
+    parser.add_argument("-mr", dest="metricsreport", help="Path of the JSON report with the metrics of every stage, defaults to the log file path with a .metrics.json extension")
+    parser.add_argument("--extract", dest="extract", help="Only write the Themis tables read by the migration to a snapshot at this path")
+    parser.add_argument("--from-snapshot", dest="fromsnapshot", help="Read the Themis tables from a snapshot written with --extract instead of the Themis database")
+    args = parser.parse_args()
+    if not args.themisdb and not args.fromsnapshot:
+        parser.error("-tdb or --from-snapshot is required")
+    if args.retryfailed and args.delta:
+        parser.error("--retry-failed continues the run of the checkpoint database, it can not be combined with --delta")
+    if args.caseshards > 1 and (args.retryfailed or args.extract):
+        parser.error("-cs can not be combined with --retry-failed or --extract")
+    if args.caseshard is not None and not 0 <= args.caseshard < args.caseshards:
+        parser.error("--case-shard is started by a migration with -cs, it has to be below the number of shards")
+    if args.extract and args.fromsnapshot:
+        parser.error("--extract reads the Themis database, it can not be combined with --from-snapshot")
+    if not args.extract:
+        missing = [flag for flag, value in [("-tdf", args.documentpath), ("-url", args.url), ("-odb", args.odoodb), ("-u", args.user), ("-s", args.secret)] if not value]
+        if missing:
+            parser.error("the following arguments are required to migrate: " + ", ".join(missing))
+    return args
 
 
 if __name__ == '__main__':
     args = parse_arguments()
+    # A case shard writes its log, checkpoint, failed documents and metrics next to those of the coordinator
+    coordinator_logfile = args.logfile
+    coordinator_checkpoint_path = args.checkpoint or str(Path(coordinator_logfile).with_suffix(".checkpoint"))
+    if args.caseshard is not None:
+        args.logfile, args.checkpoint, args.deadletters, args.metricsreport = [path and get_shard_path(path, args.caseshard)
+                                                                              for path in [args.logfile, args.checkpoint, args.deadletters, args.metricsreport]]
+        args.rtfprocesses = args.rtfprocesses or max((os.cpu_count() or 1) // args.caseshards, 1)
 
     logfile = args.logfile
     logfilepath = Path(logfile)
@@ -278,53 +456,247 @@ if __name__ == '__main__':
                         level=logging.DEBUG)
     logger = logging.getLogger('ThemisMigration')
     logger.info("Starting Themis migration ...")
+    configure_batches(args.batchrows, args.batchbytes, args.connections)
 
     themis_db = args.themisdb
     # themis_db = "/Library/Frameworks/Firebird.framework/Versions/A/Resources/examples/empbuild/themis5.fdb"
-    con = connect_to_db(themis_db)
+    if args.extract:
+        write_snapshot(lambda: connect_to_db(themis_db), args.extract, get_snapshot_columns(), partition_columns)
+        sys.exit(0)
+
+    # A rehearsal can read the tables from a snapshot instead of the Themis database
+    def connect_to_themis():
+        if args.fromsnapshot:
+            return connect_to_snapshot(args.fromsnapshot)
+        return connect_to_db(themis_db)
+
+    metrics_path = args.metricsreport or str(logfilepath.with_suffix(".metrics.json"))
+    metrics.begin()
+    if args.fromsnapshot:
+        check_snapshot(args.fromsnapshot, get_snapshot_columns())
+        logger.info("Reading the Themis tables from snapshot " + args.fromsnapshot + ".")
+    con = connect_to_themis()
     cr = con.cursor()
-
-    user_vals = get_table_values(cr, "GEBRUIKER", user_value_mapping)
-    user_id_mapping, user_tariff_mapping = create_themis_users(args.url, args.odoodb, args.user, args.secret, user_vals)
-    country_code_id_mapping = get_country_code_id_mapping(args.url, args.odoodb, args.user, args.secret)
-    company_vals = get_table_values(cr, "BEDRIJF", company_value_mapping)
-    company_id_mapping, themis_company_category_id_mapping = create_themis_companies(args.url, args.odoodb, args.user, args.secret, company_vals, user_id_mapping, country_code_id_mapping)
-    contact_vals = get_table_values(cr, "ADRESBOEK", contact_value_mapping)
-    contact_id_mapping, themis_contact_category_id_mapping = create_themis_contacts(args.url, args.odoodb, args.user, args.secret, contact_vals, company_id_mapping, user_id_mapping, country_code_id_mapping)
-
-    case_category_vals = get_table_values(cr, "DOSSIERCATEGORIE", case_category_value_mapping)
-    case_category_id_mapping = create_themis_case_categories(args.url, args.odoodb, args.user, args.secret, case_category_vals)
-    case_vals = get_table_values(cr, "DOSSIER", case_value_mapping)
-    case_id_mapping, active_mapping, case_tariff_mapping = create_themis_cases(args.url, args.odoodb, args.user, args.secret, case_vals, company_id_mapping, contact_id_mapping, user_id_mapping, case_category_id_mapping)
-    case_description_type_vals = get_table_values(cr, "OPMERKINGTYPE", case_description_type_value_mapping)
-    case_description_vals = get_table_values(cr, "DOSSIEROPMERKING", case_description_value_mapping)
-    write_case_descriptions(args.url, args.odoodb, args.user, args.secret, case_description_vals, case_description_type_vals, case_id_mapping)
-
-    party_category_vals = get_table_values(cr, "ADRESCATEGORIE", party_category_value_mapping)
-    party_category_id_mapping = create_themis_party_categories(args.url, args.odoodb, args.user, args.secret, party_category_vals)
-    party_vals = get_table_values(cr, "DOSSIERADRESBOEK", party_value_mapping)
-    create_themis_parties(args.url, args.odoodb, args.user, args.secret, party_vals, company_id_mapping, contact_id_mapping, case_id_mapping, themis_company_category_id_mapping, themis_contact_category_id_mapping, party_category_id_mapping)
-
-    timesheet_type_vals = get_table_values(cr, "TIJDTYPE", timesheet_type_value_mapping)
-    timesheet_type_id_mapping, timesheet_type_price_mapping = create_themis_timesheet_types(args.url, args.odoodb, args.user, args.secret, timesheet_type_vals)
-
-    cost_type_vals = get_table_values(cr, "KOSTTYPE", cost_type_value_mapping)
-    cost_type_id_mapping, cost_type_price_mapping = create_themis_cost_types(args.url, args.odoodb, args.user, args.secret, cost_type_vals)
-
-    timesheet_vals = get_table_values(cr, "DOSSIERTIJD", timesheet_value_mapping)
-    case_timesheet_vals = get_table_values(cr, "DOSSIERTIJDTARIEF", case_timesheet_value_mapping)
-    cost_vals = get_table_values(cr, "DOSSIERKOST", cost_value_mapping)
-    case_cost_vals = get_table_values(cr, "DOSSIERKOSTTARIEF", case_cost_value_mapping)
-    timesheet_vals = list(filter(lambda x: x["billed"] != "T", timesheet_vals))
-    cost_vals = list(filter(lambda x: x["billed"] != "T", cost_vals))
-    create_themis_timesheets_costs(args.url, args.odoodb, args.user, args.secret, timesheet_vals, cost_vals, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, cost_type_id_mapping, cost_type_price_mapping, case_timesheet_vals, case_cost_vals)
-
-    document_category_vals = get_table_values(cr, "DOSSIERDOCUMENTMAP", document_category_value_mapping)
-    document_category_id_mapping = create_themis_document_categories(args.url, args.odoodb, args.user, args.secret, document_category_vals)
-    document_vals = get_table_values(cr, "DOSSIERDOCUMENT", document_value_mapping)
-    document_vals = list(filter(lambda x: x["case_id"], document_vals))
-    create_themis_documents(args.url, args.odoodb, args.user, args.secret, document_vals, args.documentpath, case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping)
-
+    session = connect_to_odoo(args.url, args.odoodb, args.user, args.secret, args.connections, args.protocol, args.compression)
+
+    checkpoint_path = args.checkpoint or str(logfilepath.with_suffix(".checkpoint"))
+    dead_letter_path = args.deadletters or str(logfilepath.with_suffix(".failed.jsonl"))
+    store = CheckpointStore(checkpoint_path, args.resume or args.retryfailed, args.delta, dead_letter_path)
+    logger.info(("Resuming from" if args.resume or args.retryfailed else "Checkpointing to") + " " + checkpoint_path + (" (delta)." if store.delta else "."))
+    if args.delta and not args.resume:
+        store.reset_stages(delta_stages)
+    if args.retryfailed:
+        unfinished_stages = [stage for stage in retry_stages if not store.is_finished(stage)]
+        if unfinished_stages:
+            raise RuntimeError("The " + ", ".join(unfinished_stages) + " of " + checkpoint_path + " are not migrated yet, finish the migration with --resume before retrying the failed rows")
+        failed_keys = dict((stage, list(store.load_dead_letters(stage))) for stage in retry_stages)
+        failed_document_ids = failed_keys["documents"]
+        failed_party_keys = set(key for name, key in failed_keys["parties"])
+        failed_timesheet_ids = [key for name, key in failed_keys["timesheets and costs"] if name == "timesheets"]
+        failed_cost_ids = [key for name, key in failed_keys["timesheets and costs"] if name == "costs"]
+        logger.info("Retrying " + str(len(failed_document_ids)) + " failed documents, " + str(len(failed_party_keys)) + " parties, " + str(len(failed_timesheet_ids))
+                    + " timesheets and " + str(len(failed_cost_ids)) + " costs of " + dead_letter_path + ".")
+        retried_stages = [stage for stage in retry_stages if failed_keys[stage]]
+        store.reset_stages(retried_stages)
+    # The case ranges of the shards are kept by a resumed or delta run, new cases belong to the last shard
+    case_range = None
+    if args.caseshard is not None:
+        coordinator_store = CheckpointStore(coordinator_checkpoint_path, resume=True)
+        case_range = get_bound_ranges(coordinator_store.load_setting("case_shard_bounds", []))[args.caseshard]
+        logger.info("Migrating the cases from " + str(case_range[0]) + " up to " + str(case_range[1]) + " of case shard " + str(args.caseshard) + ".")
+    elif args.caseshards > 1:
+        case_shard_bounds = store.load_setting("case_shard_bounds")
+        if case_shard_bounds is None:
+            case_shard_bounds = get_partition_bounds(cr, "DOSSIER", "ID", args.caseshards)
+            store.save_setting("case_shard_bounds", case_shard_bounds)
+        elif len(case_shard_bounds) + 1 != args.caseshards:
+            logger.warning("Keeping the " + str(len(case_shard_bounds) + 1) + " case shards of " + checkpoint_path + ".")
+    # The RTF cache is shared by the case shards
+    rtf_converter = RtfConverter(args.rtfprocesses, args.rtfcache or str(Path(coordinator_logfile).with_suffix(".rtfcache")), args.rtfmemorycache)
+
+    # Stages run on several threads and a Themis connection is not shared between threads, every
+    # stage thread opens its own connection.
+    thread_data = threading.local()
+    themis_connections = []
+
+    def get_themis_cursor():
+        if not hasattr(thread_data, "con"):
+            thread_data.con = connect_to_themis()
+            themis_connections.append(thread_data.con)
+        return thread_data.con.cursor()
+
+    # Every table is streamed in batches on its own cursor, so several streams can be consumed by one stage.
+    def stream_table_values(table_name, value_mapping, order_by=None, filters=None):
+        return iter_table_values(get_themis_cursor(), table_name, value_mapping, order_by=order_by, filters=filters, records=table_name in record_tables,
+                                 conditions=get_case_conditions(table_name))
+
+    # A case shard only reads the rows of the cases in its range
+    def get_case_conditions(table_name):
+        if case_range is None or table_name not in case_columns:
+            return None
+        return get_range_conditions(case_columns[table_name], *case_range)
+
+    # Stages without Odoo ids resume from the last committed group of their ordered rows, e.g. the ID
+    # of a timesheet, see checkpoint_helper.ResumePoint
+    def get_resume_conditions(stage, name, column):
+        return get_range_conditions(column, store.stage(stage).resume_point(name).group)
+
+    # The watermark is read before the rows, so rows that change while the stage runs are read again
+    # by the next delta run. It is saved when the stage finishes. The rows are read ahead on their own
+    # connection (one per partition for the tables of partition_columns), so extracting, preprocessing
+    # and sending the batches of a stage overlap.
+    def stream_changed_values(stage, table_name, value_mapping, order_by=None, filters=None, conditions=None):
+        table_cr = get_themis_cursor()
+        store.set_watermark(stage, table_name, get_table_watermark(table_cr, table_name, watermark_columns[table_name]))
+        watermark = store.load_watermark(table_name) if store.delta else None
+        records = table_name in record_tables
+        partitions = args.themispartitions if table_name in partition_columns else 1
+        return iter_partitioned_table_values(connect_to_themis, table_name, value_mapping, partition_columns.get(table_name, "ID"), partitions,
+                                             order_by=order_by, watermark=watermark, filters=filters, records=records,
+                                             conditions=(get_case_conditions(table_name) or []) + list(conditions or []))
+
+    # Stages with the mappings they need as arguments, see stage_helper.StageScheduler
+    def migrate_users():
+        user_vals = stream_table_values("GEBRUIKER", user_value_mapping)
+        return store.run("users", create_themis_users, session, user_vals, checkpoint=store.stage("users"))
+
+    def migrate_companies(user_id_mapping, country_code_id_mapping):
+        company_vals = stream_changed_values("companies", "BEDRIJF", company_value_mapping)
+        return store.run("companies", create_themis_companies, session, company_vals, user_id_mapping, country_code_id_mapping, checkpoint=store.stage("companies"))
+
+    def migrate_contacts(company_id_mapping, user_id_mapping, country_code_id_mapping):
+        contact_vals = stream_changed_values("contacts", "ADRESBOEK", contact_value_mapping)
+        return store.run("contacts", create_themis_contacts, session, contact_vals, company_id_mapping, user_id_mapping, country_code_id_mapping, checkpoint=store.stage("contacts"))
+
+    def migrate_case_categories():
+        case_category_vals = stream_table_values("DOSSIERCATEGORIE", case_category_value_mapping)
+        return store.run("case categories", create_themis_case_categories, session, case_category_vals)
+
+    def migrate_cases(company_id_mapping, contact_id_mapping, user_id_mapping, case_category_id_mapping):
+        case_vals = stream_changed_values("cases", "DOSSIER", case_value_mapping)
+        return store.run("cases", create_themis_cases, session, case_vals, company_id_mapping, contact_id_mapping, user_id_mapping, case_category_id_mapping, checkpoint=store.stage("cases"))
+
+    def migrate_case_descriptions(case_id_mapping):
+        case_description_type_vals = stream_table_values("OPMERKINGTYPE", case_description_type_value_mapping)
+        case_description_vals = stream_changed_values("case descriptions", "DOSSIEROPMERKING", case_description_value_mapping, ["DOSSIER_ID"])
+        store.run("case descriptions", write_case_descriptions, session, case_description_vals, case_description_type_vals, case_id_mapping, rtf_converter, checkpoint=store.stage("case descriptions"))
+
+    def migrate_party_categories():
+        party_category_vals = stream_table_values("ADRESCATEGORIE", party_category_value_mapping)
+        return store.run("party categories", create_themis_party_categories, session, party_category_vals)
+
+    def migrate_parties(company_id_mapping, contact_id_mapping, case_id_mapping, themis_company_category_id_mapping, themis_contact_category_id_mapping, party_category_id_mapping):
+        party_order = ["DOSSIER_ID", "ADRESBOEK_ID", "BEDRIJF_ID", "DOSSIERADRESCATEGORIE_ID"]
+        if args.retryfailed:
+            failed_case_ids = sorted(set(key[0] for key in failed_party_keys if key[0] is not None))
+            party_vals = stream_table_values("DOSSIERADRESBOEK", party_value_mapping, party_order, [("DOSSIER_ID", "in", failed_case_ids)])
+            party_vals = (vals for vals in party_vals if tuple(get_party_key(vals)[1]) in failed_party_keys)
+        else:
+            party_vals = stream_changed_values("parties", "DOSSIERADRESBOEK", party_value_mapping, party_order,
+                                               conditions=get_resume_conditions("parties", "parties", "DOSSIER_ID"))
+        store.run("parties", create_themis_parties, session, party_vals, company_id_mapping, contact_id_mapping, case_id_mapping, themis_company_category_id_mapping, themis_contact_category_id_mapping, party_category_id_mapping, checkpoint=store.stage("parties"),
+                  guess_clients=args.caseshard is None)
+
+    def migrate_timesheet_types():
+        timesheet_type_vals = stream_table_values("TIJDTYPE", timesheet_type_value_mapping)
+        return store.run("timesheet types", create_themis_timesheet_types, session, timesheet_type_vals)
+
+    def migrate_cost_types():
+        cost_type_vals = stream_table_values("KOSTTYPE", cost_type_value_mapping)
+        return store.run("cost types", create_themis_cost_types, session, cost_type_vals)
+
+    def migrate_timesheets_costs(user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, cost_type_id_mapping, cost_type_price_mapping):
+        # Billed timesheets and costs are not migrated
+        if args.retryfailed:
+            timesheet_vals = stream_table_values("DOSSIERTIJD", timesheet_value_mapping, ["ID"], [("GEFACTUREERD", "!=", "T"), ("ID", "in", failed_timesheet_ids)])
+            cost_vals = stream_table_values("DOSSIERKOST", cost_value_mapping, ["ID"], [("GEFACTUREERD", "!=", "T"), ("ID", "in", failed_cost_ids)])
+        else:
+            timesheet_vals = stream_changed_values("timesheets and costs", "DOSSIERTIJD", timesheet_value_mapping, ["ID"], [("GEFACTUREERD", "!=", "T")],
+                                                   get_resume_conditions("timesheets and costs", "timesheets", "ID"))
+            cost_vals = stream_changed_values("timesheets and costs", "DOSSIERKOST", cost_value_mapping, ["ID"], [("GEFACTUREERD", "!=", "T")],
+                                              get_resume_conditions("timesheets and costs", "costs", "ID"))
+        case_timesheet_vals = stream_table_values("DOSSIERTIJDTARIEF", case_timesheet_value_mapping)
+        case_cost_vals = stream_table_values("DOSSIERKOSTTARIEF", case_cost_value_mapping)
+        store.run("timesheets and costs", create_themis_timesheets_costs, session, timesheet_vals, cost_vals, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, cost_type_id_mapping, cost_type_price_mapping, case_timesheet_vals, case_cost_vals, checkpoint=store.stage("timesheets and costs"))
+
+    def migrate_document_categories():
+        document_category_vals = stream_table_values("DOSSIERDOCUMENTMAP", document_category_value_mapping)
+        return store.run("document categories", create_themis_document_categories, session, document_category_vals)
+
+    # Only the failed documents are retried, whatever the watermark, which is left as it is
+    def get_document_filters():
+        if args.retryfailed:
+            return [("LINKEDTO_ID", "!=", None), ("ID", "in", failed_document_ids)]
+        return [("LINKEDTO_ID", "!=", None)]
+
+    # The case folders are listed while the cases are migrated, a case shard only lists the folders of its
+    # cases. The documents that have no file are reported from their case and file name.
+    def migrate_document_index():
+        if args.nodocumentindex:
+            return None
+        watermark = store.load_watermark("DOSSIERDOCUMENT") if store.delta and not args.retryfailed else None
+        documents = ((vals["case_id"], vals["filename"]) for vals in iter_table_values(get_themis_cursor(), "DOSSIERDOCUMENT", document_file_value_mapping, watermark=watermark,
+                                                                                       filters=get_document_filters(), conditions=get_case_conditions("DOSSIERDOCUMENT")))
+        return scan_document_folder(args.documentpath, cache_path=args.documentindexcache, case_range=case_range, documents=documents)
+
+    def migrate_documents(case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping, document_index):
+        if args.retryfailed:
+            document_vals = stream_table_values("DOSSIERDOCUMENT", document_value_mapping, filters=get_document_filters())
+        else:
+            document_vals = stream_changed_values("documents", "DOSSIERDOCUMENT", document_value_mapping, filters=get_document_filters())
+        store.run("documents", create_themis_documents, session, document_vals, args.documentpath, case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping, args.documentreaders, args.documentinflightbytes,
+                  None if args.uploadduplicates else args.documentdedupbytes, checkpoint=store.stage("documents"), document_index=document_index)
+
+    # The folder of the log file is on disk, unlike /tmp on some small VMs
+    scheduler = StageScheduler(args.parallelstages, args.memorybudget and args.memorybudget * 1000000, str(logfilepath.parent))
+
+    # A case shard reads the results of the shared stages from the checkpoint of the coordinator
+    def add_stage(name, function, inputs=(), outputs=()):
+        if args.caseshard is not None and name in shared_stages:
+            scheduler.add(name, lambda: coordinator_store.load_result(name), outputs=outputs)
+        else:
+            scheduler.add(name, function, inputs, outputs)
+
+    add_stage("users", migrate_users, outputs=["user_id_mapping", "user_tariff_mapping"])
+    add_stage("country codes", lambda: get_country_code_id_mapping(session), outputs=["country_code_id_mapping"])
+    add_stage("companies", migrate_companies, ["user_id_mapping", "country_code_id_mapping"], ["company_id_mapping", "themis_company_category_id_mapping"])
+    add_stage("contacts", migrate_contacts, ["company_id_mapping", "user_id_mapping", "country_code_id_mapping"], ["contact_id_mapping", "themis_contact_category_id_mapping"])
+    add_stage("case categories", migrate_case_categories, outputs=["case_category_id_mapping"])
+    add_stage("cases", migrate_cases, ["company_id_mapping", "contact_id_mapping", "user_id_mapping", "case_category_id_mapping"], ["case_id_mapping", "active_mapping", "case_tariff_mapping"])
+    add_stage("case descriptions", migrate_case_descriptions, ["case_id_mapping"])
+    add_stage("party categories", migrate_party_categories, outputs=["party_category_id_mapping"])
+    add_stage("parties", migrate_parties, ["company_id_mapping", "contact_id_mapping", "case_id_mapping", "themis_company_category_id_mapping", "themis_contact_category_id_mapping", "party_category_id_mapping"])
+    add_stage("timesheet types", migrate_timesheet_types, outputs=["timesheet_type_id_mapping", "timesheet_type_price_mapping"])
+    add_stage("cost types", migrate_cost_types, outputs=["cost_type_id_mapping", "cost_type_price_mapping"])
+    add_stage("timesheets and costs", migrate_timesheets_costs, ["user_id_mapping", "user_tariff_mapping", "case_id_mapping", "case_tariff_mapping", "timesheet_type_id_mapping", "timesheet_type_price_mapping", "cost_type_id_mapping", "cost_type_price_mapping"])
+    add_stage("document categories", migrate_document_categories, outputs=["document_category_id_mapping"])
+    add_stage("document index", migrate_document_index, outputs=["document_index"])
+    add_stage("documents", migrate_documents, ["case_id_mapping", "active_mapping", "user_id_mapping", "document_category_id_mapping", "document_index"])
+    if args.retryfailed:
+        scheduler.select(retried_stages)
+    elif args.caseshard is not None:
+        scheduler.select(case_stages)
+    elif args.caseshards > 1:
+        scheduler.select(shared_stages)
+    try:
+        scheduler.run()
+        if args.caseshard is None and args.caseshards > 1:
+            with metrics.stage("case shards"):
+                run_case_shards(len(case_shard_bounds) + 1, logfile)
+            # Once for the parties of all shards, instead of a pass over all cases in every shard
+            guess_case_clients(session)
+    finally:
+        metrics.finish()
+        metrics.write_report(metrics_path)
+        logger.info("Wrote the metrics report to " + metrics_path + ".")
+
+    rtf_converter.close()
+    store.close()
+    if args.caseshard is not None:
+        coordinator_store.close()
+    session.close()
+    for themis_connection in themis_connections:
+        themis_connection.close()
     cr.close()
     con.close()
 
@@ -332,8 +704,8 @@ if __name__ == '__main__':
     # con = connect_to_db(themis_db)
     # cr = con.cursor()
     # (url, database, username, secret) = (args.url, args.odoodb, args.user, args.secret)
-    # models, uid = connect_to_odoo(url, database, username, secret)
-    # models.execute_kw(database, uid, secret, "cases.case", "write_from_themis", [write_dict])
+    # session = connect_to_odoo(url, database, username, secret)
+    # session.execute_kw("cases.case", "write_from_themis", [write_dict])
     # print_db_tables(cr)
     # print_table_columns(cr, "DOCUMENTTYPE")
     # print_table_info_for_id(cr, "DOSSIER", 2835)
@@ -0,0 +1,154 @@
+import threading
+from array import array
+from bisect import bisect_left
+
+
+# New keys are collected in a dict and merged into the sorted arrays once there are this many, or
+# an eighth of the merged keys when that is more
+min_merge_size = 4096
+
+
+missing = object()
+
+
+def is_id(value):
+    return type(value) is int or value is False
+
+
+# Compact Themis id -> Odoo id mapping, e.g. the id_mapping of a stage, that can be used like the
+# dict it replaces. The ids are kept in two sorted arrays of 64-bit integers, 16 bytes per id
+# instead of the 100 or so of a dict entry with two int objects. Lookups are a binary search.
+# False values (rows that failed) are stored as 0 and come back as False. Lookups from other
+# threads can run while a single thread adds ids.
+class IdMapping:
+    def __init__(self, items=()):
+        self.lock = threading.Lock()
+        self.arrays = (array("q"), array("q"))
+        self.pending = {}
+        self.update(items)
+
+    def find(self, key):
+        keys, values = self.arrays
+        index = bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            return index
+        return -1
+
+    def __len__(self):
+        return len(self.arrays[0]) + len(self.pending)
+
+    def __contains__(self, key):
+        if type(key) is not int:
+            return False
+        return key in self.pending or self.find(key) >= 0
+
+    def __getitem__(self, key):
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        if type(key) is not int:
+            return default
+        pending = self.pending
+        if key in pending:
+            return pending[key] or False
+        keys, values = self.arrays
+        index = bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            return values[index] or False
+        return default
+
+    def __setitem__(self, key, value):
+        if not is_id(key) or not is_id(value):
+            raise TypeError("IdMapping only maps integer ids to integer ids or False, not " + repr(key) + " to " + repr(value))
+        with self.lock:
+            keys, values = self.arrays
+            if keys and key <= keys[-1]:
+                index = self.find(key)
+                if index >= 0:
+                    values[index] = value
+                    return
+            self.pending[key] = int(value)
+            if len(self.pending) >= max(min_merge_size, len(self.arrays[0]) // 8):
+                self.merge()
+
+    def update(self, items=()):
+        for key, value in items.items() if hasattr(items, "items") else items:
+            self[key] = value
+
+    # Ids that are read in order, like most Themis tables, are appended to the arrays. Otherwise
+    # the runs of merged ids between the pending ids are copied as slices. A reader finds an id in
+    # the pending ids until they are dropped, after the arrays are complete.
+    def merge(self):
+        keys, values = self.arrays
+        pending = sorted(self.pending.items())
+        if not keys or pending[0][0] > keys[-1]:
+            values.extend(value for key, value in pending)
+            keys.extend(key for key, value in pending)
+        else:
+            new_keys = array("q")
+            new_values = array("q")
+            start = 0
+            for key, value in pending:
+                index = bisect_left(keys, key, start)
+                new_keys += keys[start:index]
+                new_values += values[start:index]
+                new_keys.append(key)
+                new_values.append(value)
+                start = index
+            new_keys += keys[start:]
+            new_values += values[start:]
+            self.arrays = (new_keys, new_values)
+        self.pending = {}
+
+    def __iter__(self):
+        return (key for key, value in self.items())
+
+    def keys(self):
+        return iter(self)
+
+    # Generates the items, without a list of them all
+    def items(self):
+        with self.lock:
+            keys, values = self.arrays
+            count = len(keys)
+            pending = list(self.pending.items())
+        for index in range(count):
+            yield keys[index], values[index] or False
+        for key, value in pending:
+            yield key, value or False
+
+    def nbytes(self):
+        keys, values = self.arrays
+        return keys.itemsize * len(keys) + values.itemsize * len(values) + 100 * len(self.pending)
+
+    def __repr__(self):
+        return "IdMapping(" + str(len(self)) + " ids)"
+
+    # Pickled as the merged arrays, e.g. when StageScheduler spills the mapping to disk
+    def __getstate__(self):
+        with self.lock:
+            if self.pending:
+                self.merge()
+            return self.arrays
+
+    def __setstate__(self, state):
+        self.lock = threading.Lock()
+        self.arrays = state
+        self.pending = {}
+
+
+# An IdMapping of the items when they are all ids, or else a dict
+def compact_mapping(items):
+    mapping = IdMapping()
+    items = iter(items.items() if hasattr(items, "items") else items)
+    for key, value in items:
+        if not is_id(key) or not is_id(value):
+            result = dict(mapping.items())
+            result[key] = value
+            result.update(items)
+            return result
+        mapping[key] = value
+    return mapping
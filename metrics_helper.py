@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import logging
+import datetime
+import threading
+import contextvars
+from functools import partial, wraps
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('Metrics')
+
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+# Counters of every stage, times are in seconds
+counter_names = ["extract", "transform", "rpc", "rpc_calls", "request_bytes", "rows", "retries", "failed_rows"]
+
+
+# Resident memory of the process. Without /proc (e.g. macOS) only the peak of the process so far is known.
+def get_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+# Runs function in a copy of the current context, so the work a stage hands to other threads is
+# still counted for that stage. Every call needs its own copy, a context can only run on one thread.
+def in_current_context(function):
+    return partial(contextvars.copy_context().run, function)
+
+
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.end = None
+        self.peak_rss = 0
+        self.counters = dict((counter_name, 0) for counter_name in counter_names)
+
+    def to_dict(self, run_start):
+        wall = (self.end or time.perf_counter()) - self.start if self.start is not None else 0.0
+        result = {
+            "stage": self.name,
+            "start": self.start - run_start if self.start is not None else None,
+            "wall": wall,
+        }
+        result.update(self.counters)
+        result["rows_per_second"] = self.counters["rows"] / wall if wall else 0.0
+        result["bytes_per_second"] = self.counters["request_bytes"] / wall if wall else 0.0
+        result["peak_rss"] = self.peak_rss
+        return result
+
+
+# Collects per stage the wall time, the time spent reading Themis (extract), preprocessing
+# (transform) and in Odoo calls (rpc), and counters like the request bytes and retries. Work is
+# counted for the stage of the context it runs in, see stage and in_current_context, or else for
+# "other". Times are summed over all threads of a stage, so with parallel connections or workers
+# they can add up to more than the wall time. A timer that runs inside another one on the same
+# thread, like a Themis read while a generator is preprocessed, is only counted for itself.
+class Metrics:
+    def __init__(self, sample_interval=0.2):
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.running = set()
+        self.methods = {}
+        self.start = time.perf_counter()
+        self.started = datetime.datetime.now()
+        self.peak_rss = 0
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def get_stage(self, name=None):
+        name = name or current_stage.get() or "other"
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name)
+        return self.stages[name]
+
+    def count(self, counter_name, value=1):
+        with self.lock:
+            self.get_stage().counters[counter_name] += value
+
+    @contextmanager
+    def timer(self, counter_name):
+        stack = getattr(self.local, "timers", None)
+        if stack is None:
+            stack = self.local.timers = []
+        start = time.perf_counter()
+        # Time of the timers that run inside this one
+        stack.append(0.0)
+        try:
+            yield
+        finally:
+            inner = stack.pop()
+            duration = time.perf_counter() - start
+            if stack:
+                stack[-1] += duration
+            self.count(counter_name, duration - inner)
+
+    # Decorates a function to count its time, e.g. @metrics.timed("transform")
+    def timed(self, counter_name):
+        def decorate(function):
+            @wraps(function)
+            def timed_function(*args, **kwargs):
+                with self.timer(counter_name):
+                    return function(*args, **kwargs)
+            return timed_function
+        return decorate
+
+    def count_call(self, model, method, duration):
+        with self.lock:
+            counters = self.methods.setdefault((model, method), [0, 0.0])
+            counters[0] += 1
+            counters[1] += duration
+
+    @contextmanager
+    def stage(self, name):
+        token = current_stage.set(name)
+        with self.lock:
+            stage = self.get_stage(name)
+            stage.start = time.perf_counter()
+            stage.end = None
+            self.running.add(stage)
+        self.sample()
+        try:
+            yield stage
+        finally:
+            self.sample()
+            with self.lock:
+                stage.end = time.perf_counter()
+                self.running.discard(stage)
+            current_stage.reset(token)
+
+    def sample(self):
+        rss = get_rss()
+        if rss is None:
+            return
+        with self.lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            for stage in self.running:
+                stage.peak_rss = max(stage.peak_rss, rss)
+
+    def run_sampler(self):
+        while not self.stopped.wait(self.sample_interval):
+            self.sample()
+
+    # Starts the run and samples the memory of the process until finish
+    def begin(self):
+        self.start = time.perf_counter()
+        self.started = datetime.datetime.now()
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self.run_sampler, daemon=True)
+        self.sampler.start()
+
+    def finish(self):
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def report(self):
+        self.sample()
+        end = time.perf_counter()
+        with self.lock:
+            stages = sorted(self.stages.values(), key=lambda stage: (stage.start is None, stage.start or 0))
+            stage_reports = [stage.to_dict(self.start) for stage in stages]
+            methods = [{"model": model, "method": method, "calls": calls, "rpc": duration}
+                       for (model, method), (calls, duration) in sorted(self.methods.items())]
+        total = {"stage": "total", "start": 0.0, "wall": end - self.start}
+        for counter_name in counter_names:
+            total[counter_name] = sum(stage[counter_name] for stage in stage_reports)
+        total["rows_per_second"] = total["rows"] / total["wall"] if total["wall"] else 0.0
+        total["bytes_per_second"] = total["request_bytes"] / total["wall"] if total["wall"] else 0.0
+        total["peak_rss"] = self.peak_rss
+        return {"started": self.started.isoformat(" ", "seconds"), "stages": stage_reports, "total": total, "methods": methods}
+
+    def write_report(self, path):
+        report = self.report()
+        with open(path, "w") as output:
+            json.dump(report, output, indent=2)
+        self.log_report(report)
+        return report
+
+    def log_report(self, report):
+        logger.info("Migration metrics, times in seconds (extract, transform and rpc are summed over the threads of a stage):")
+        logger.info("  {:<22} {:>8} {:>8} {:>9} {:>8} {:>7} {:>9} {:>9} {:>10} {:>7} {:>7} {:>8}".format(
+            "stage", "wall", "extract", "transform", "rpc", "calls", "rows", "rows/s", "MB sent", "retries", "failed", "peak MB"))
+        for stage in report["stages"] + [report["total"]]:
+            logger.info("  {:<22} {:>8.2f} {:>8.2f} {:>9.2f} {:>8.2f} {:>7} {:>9} {:>9.0f} {:>10.2f} {:>7} {:>7} {:>8.1f}".format(
+                stage["stage"], stage["wall"], stage["extract"], stage["transform"], stage["rpc"], stage["rpc_calls"], stage["rows"],
+                stage["rows_per_second"], stage["request_bytes"] / 1000000, stage["retries"], stage["failed_rows"], stage["peak_rss"] / 1000000))
+
+
+metrics = Metrics()
@@ -0,0 +1,131 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from fake_odoo import FakeOdoo, FakeOdooServer
+
+
+stage_pattern = re.compile(r"StageScheduler INFO Stage (.+) finished in ")
+
+
+def read_rss(pid):
+    try:
+        with open("/proc/" + str(pid) + "/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+# Follows a running migration: samples its resident memory and reads its log for the stages that
+# finished. Stages run one at a time, so a stage spans from the end of the previous stage to its
+# own end, with the peak memory and the calls to the fake Odoo server in between.
+def monitor_migration(process, log_path, interval=0.05):
+    stages = []
+    stage_start = time.perf_counter()
+    peak_rss = 0
+    log_position = 0
+    while True:
+        running = process.poll() is None
+        rss = read_rss(process.pid)
+        if rss:
+            peak_rss = max(peak_rss, rss)
+        if os.path.exists(log_path):
+            with open(log_path) as log:
+                log.seek(log_position)
+                lines = log.readlines()
+                log_position = log.tell()
+            for line in lines:
+                match = stage_pattern.search(line)
+                if match:
+                    stage_end = time.perf_counter()
+                    stages.append({"stage": match.group(1), "start": stage_start, "end": stage_end, "peak_rss": peak_rss})
+                    stage_start = stage_end
+                    peak_rss = rss or 0
+        if not running:
+            return stages
+        time.sleep(interval)
+
+
+def add_call_totals(stages, calls):
+    for stage in stages:
+        stage_calls = [call for call in calls if stage["start"] <= call[0] < stage["end"]]
+        stage["seconds"] = stage["end"] - stage["start"]
+        stage["calls"] = len(stage_calls)
+        stage["rows"] = sum(call[4] for call in stage_calls)
+        stage["bytes"] = sum(call[5] for call in stage_calls)
+        stage["failed_calls"] = sum(1 for call in stage_calls if call[6])
+        stage["rows_per_second"] = stage["rows"] / max(stage["seconds"], 1e-6)
+        stage["bytes_per_second"] = stage["bytes"] / max(stage["seconds"], 1e-6)
+    return stages
+
+
+def print_report(stages, total):
+    print("{:<22} {:>8} {:>7} {:>9} {:>10} {:>10} {:>9} {:>7} {:>9}".format(
+        "stage", "seconds", "calls", "rows", "rows/s", "MB sent", "MB/s", "failed", "peak MB"))
+    for stage in stages + [total]:
+        print("{:<22} {:>8.2f} {:>7} {:>9} {:>10.0f} {:>10.2f} {:>9.2f} {:>7} {:>9.1f}".format(
+            stage["stage"], stage["seconds"], stage["calls"], stage["rows"], stage["rows_per_second"],
+            stage["bytes"] / 1000000, stage["bytes_per_second"] / 1000000, stage["failed_calls"], stage["peak_rss"] / 1000000))
+
+
+def run_benchmark(snapshot_path, document_path, odoo, migration_args, keep=False):
+    server = FakeOdooServer(odoo).start()
+    work_path = tempfile.mkdtemp(prefix="themis-benchmark-")
+    log_path = os.path.join(work_path, "migration.log")
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+               "--from-snapshot", snapshot_path, "-tdf", document_path, "-url", server.url, "-odb", "benchmark", "-u", "admin", "-s", "admin",
+               "-lf", log_path, "-cp", os.path.join(work_path, "migration.checkpoint"), "-rc", os.path.join(work_path, "migration.rtfcache")] \
+        + migration_args + ["-ps", "1"]
+    start = time.perf_counter()
+    try:
+        process = subprocess.Popen(command)
+        stages = monitor_migration(process, log_path)
+        end = time.perf_counter()
+    finally:
+        server.stop()
+    if process.returncode:
+        raise RuntimeError("The migration failed with exit code " + str(process.returncode) + ", see " + log_path)
+    stages = add_call_totals(stages, odoo.calls)
+    total = add_call_totals([{"stage": "total", "start": start, "end": end, "peak_rss": max([stage["peak_rss"] for stage in stages] or [0])}], odoo.calls)[0]
+    # Seconds since the start of the run
+    for stage in stages + [total]:
+        stage["start"] -= start
+        stage["end"] -= start
+    if not keep:
+        shutil.rmtree(work_path)
+    return stages, total
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Run the migration from a snapshot against a fake Odoo server and report the throughput of every stage. "
+                                                 "Other arguments are passed on to main.py, e.g. -rpc jsonrpc -oc 4.")
+    parser.add_argument("--from-snapshot", dest="fromsnapshot", required=True, help="Snapshot to migrate, see main.py --extract and synthetic_themis.py")
+    parser.add_argument("-tdf", dest="documentpath", required=True, help="Path to the documents folder of the snapshot")
+    parser.add_argument("-l", dest="latency", type=float, default=0.0, help="Seconds the fake Odoo server adds to every call")
+    parser.add_argument("-rl", dest="rowlatency", type=float, default=0.0, help="Seconds the fake Odoo server adds to a call for every row in it")
+    parser.add_argument("-fr", dest="failurerate", type=float, default=0.0, help="Fraction of the calls that the fake Odoo server fails at random")
+    parser.add_argument("-seed", dest="seed", type=int, default=1, help="Seed of the random failures")
+    parser.add_argument("-bw", dest="bandwidth", type=float, help="Speed of the link to the fake Odoo server in Mbit/s, e.g. 20 for a WAN link")
+    parser.add_argument("-plain", dest="plain", action="store_true", help="The fake Odoo server refuses compressed requests, like Odoo without a proxy that decodes them")
+    parser.add_argument("-json", dest="output", help="Path of a JSON file to write the report to")
+    parser.add_argument("-k", dest="keep", action="store_true", help="Keep the log, checkpoint and RTF cache of the migration")
+    return parser.parse_known_args()
+
+
+if __name__ == '__main__':
+    args, migration_args = parse_arguments()
+    odoo = FakeOdoo(args.latency, args.rowlatency, args.failurerate, args.seed, args.bandwidth and args.bandwidth * 125000, not args.plain)
+    stages, total = run_benchmark(args.fromsnapshot, args.documentpath, odoo, migration_args, args.keep)
+    print_report(stages, total)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"arguments": migration_args, "stages": stages, "total": total}, output, indent=2)
@@ -1,15 +1,33 @@
 import os
-import sys
-import base64
 import logging
-import xmlrpc.client
-from striprtf.striprtf import rtf_to_text
+import threading
+from itertools import repeat
+
+from batch_helper import BatchLoader, split_every
+from session_helper import OdooSession
+from document_helper import DocumentPipeline, default_readers, hash_file
+from transport_helper import DocumentFile
+from checkpoint_helper import no_checkpoint
+from mapping_helper import IdMapping
+from rtf_helper import RtfConverter
+from record_helper import Schema, omitted
+from metrics_helper import metrics
 
 
 themis_datetime_format = "%Y-%m-%d %H:%M:%S"
 odoo_datetime_format = "%Y-%m-%d %H:%M:%S"
 odoo_date_format = "%Y-%m-%d"
 
+max_document_batch_bytes = 30000000
+# A failing document batch is sent again in batches of at most this size, see BatchLoader
+document_probe_bytes = 3000000
+# Documents of at least this size are uploaded once per content, see create_themis_documents
+default_document_dedup_bytes = 65536
+# Module of the external ids of the migrated records and the key of the external id in the values
+# of a new record, see ExternalIds
+external_id_module = "themis"
+external_id_field = "xml_id"
+
 
 language_mapping = {
     "N": "nl_BE",
@@ -21,18 +39,77 @@ language_mapping = {
 logger = logging.getLogger('OdooHelper')
 
 
-def connect_to_odoo(url, database, username, secret):
-    common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url))
-    uid = common.authenticate(database, username, secret, {})
-    models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url), allow_none=True)
-    return models, uid
-
-
-def preprocess_user_values(user_vals):
+def connect_to_odoo(url, database, username, secret, connections=1, protocol="xmlrpc", compression=None):
+    return OdooSession(url, database, username, secret, connections, protocol, compression)
+
+
+def execute_batch_method(session, model, method):
+    def execute(batch):
+        return session.execute_kw(model, method, [batch])
+    return execute
+
+
+# Writes the values of records that were migrated by a previous run, write_vals holds
+# (Odoo id, values) pairs. write_from_themis takes a dict of values by Odoo id.
+def write_themis_records(session, model, write_vals, label):
+    def write_records(batch):
+        session.execute_kw(model, "write_from_themis", [dict((str(odoo_id), vals) for odoo_id, vals in batch)])
+        return [True] * len(batch)
+
+    loader = BatchLoader(write_records, label)
+    response = loader.load(write_vals)
+    return len(response) - loader.failed_count
+
+
+# External ids (ir.model.data) of the migrated records, e.g. themis.bedrijf_123 for the partner of
+# company 123. The values of a new record carry its external id in external_id_field, and the
+# create_from_themis methods of the Odoo module create it in the same transaction as the record, so
+# a record never ends up in Odoo without one. A stage looks up the records of a batch that it does
+# not know from its checkpoint with one search_read, so a run on a database that was (partly)
+# migrated before skips or writes them instead of creating them again, also when the checkpoint is
+# gone. Parties, timesheets and costs have no external id, without their checkpoint they are
+# created again.
+class ExternalIds:
+    def __init__(self, session, model, prefix, module=external_id_module):
+        self.session = session
+        self.model = model
+        self.prefix = prefix
+        self.module = module
+
+    def get_name(self, themis_id):
+        return self.prefix + "_" + str(themis_id)
+
+    # Themis id: Odoo id of the themis_ids that have an external id
+    def lookup(self, themis_ids):
+        names = dict((self.get_name(themis_id), themis_id) for themis_id in themis_ids)
+        if not names:
+            return {}
+        response = self.session.execute_kw("ir.model.data", "search_read",
+                                           [[("module", "=", self.module), ("model", "=", self.model), ("name", "in", list(names))]],
+                                           {"fields": ["name", "res_id"]})
+        return dict((names[vals["name"]], vals["res_id"]) for vals in response)
+
+    # Adds the records of themis_ids that are in Odoo but not in id_mapping to id_mapping and the checkpoint
+    def add_migrated(self, themis_ids, id_mapping, checkpoint=no_checkpoint, name="id_mapping"):
+        migrated_id_mapping = self.lookup([themis_id for themis_id in themis_ids if themis_id not in id_mapping])
+        if migrated_id_mapping:
+            id_mapping.update(migrated_id_mapping)
+            checkpoint.save_mapping(name, migrated_id_mapping.items())
+            logger.info("Found " + str(len(migrated_id_mapping)) + " " + self.model + " records of " + self.prefix + " that were migrated before.")
+        return migrated_id_mapping
+
+    # Gives the record that is created from vals the external id of themis_id
+    def tag(self, vals, themis_id):
+        vals[external_id_field] = self.module + "." + self.get_name(themis_id)
+
+
+@metrics.timed("transform")
+def preprocess_user_values(user_vals, duplicate_logins=None):
     id_list = []
     inactive_id_list = []
     user_tariff_mapping = {}
-    duplicate_logins = {}
+    if duplicate_logins is None:
+        duplicate_logins = {}
     for vals in user_vals:
         user_id = vals.pop("id")
         id_list.append(user_id)
@@ -50,23 +127,40 @@ def preprocess_user_values(user_vals):
     return id_list, inactive_id_list, user_tariff_mapping
 
 
-def create_themis_users(url, database, username, secret, user_vals):
+def create_themis_users(session, user_vals, checkpoint=no_checkpoint):
     logger.info("Migrating Themis users ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list, inactive_id_list, user_tariff_mapping = preprocess_user_values(user_vals)
-    response = models.execute_kw(database, uid, secret, "res.users", "create_from_themis", [user_vals])
-    logger.info("Created " + str(len(response)) + " users.")
-    id_mapping = dict(zip(id_list, response))
+    id_mapping = checkpoint.load_mapping("id_mapping", IdMapping)
+    external_ids = ExternalIds(session, "res.users", "gebruiker")
+    id_list = []
+    inactive_id_list = []
+    user_tariff_mapping = {}
+    duplicate_logins = {}
+
+    def preprocessed_vals():
+        for batch in split_every(user_vals):
+            batch_id_list, batch_inactive_id_list, batch_tariff_mapping = preprocess_user_values(batch, duplicate_logins)
+            inactive_id_list.extend(batch_inactive_id_list)
+            user_tariff_mapping.update(batch_tariff_mapping)
+            external_ids.add_migrated(batch_id_list, id_mapping, checkpoint)
+            for user_id, vals in zip(batch_id_list, batch):
+                if user_id not in id_mapping:
+                    id_list.append(user_id)
+                    external_ids.tag(vals, user_id)
+                    yield vals
+
+    loader = BatchLoader(execute_batch_method(session, "res.users", "create_from_themis"), "users",
+                         on_result=checkpoint.mapping_committer("id_mapping", id_list, id_mapping))
+    response = loader.load(preprocessed_vals())
+    logger.info("Created " + str(len(response) - loader.failed_count) + " users.")
     to_write_ids = []
     for inactive_id in inactive_id_list:
         to_write_ids.append(id_mapping.get(inactive_id, False))
-    models.execute_kw(database, uid, secret, "res.users", "write", [to_write_ids, {'active': False}])
+    session.execute_kw("res.users", "write", [to_write_ids, {'active': False}])
     return id_mapping, user_tariff_mapping
 
 
-def get_country_code_id_mapping(url, database, username, secret):
-    models, uid = connect_to_odoo(url, database, username, secret)
-    response = models.execute_kw(database, uid, secret, 'res.country', 'search_read', [[]], {'fields': ['code', 'id']})
+def get_country_code_id_mapping(session):
+    response = session.execute_kw('res.country', 'search_read', [[]], {'fields': ['code', 'id']})
     code_id_mapping = {}
     for vals in response:
         code_id_mapping[vals["code"]] = vals["id"]
@@ -79,6 +173,7 @@ def convert_values_to_bytes(dic, keys):
             dic[key] = bytes(str(dic[key] or ''), 'utf-8')
 
 
+@metrics.timed("transform")
 def preprocess_party_category_values(party_category_vals):
     id_list = []
     for vals in party_category_vals:
@@ -86,14 +181,28 @@ def preprocess_party_category_values(party_category_vals):
     return id_list
 
 
-def create_themis_party_categories(url, database, username, secret, party_category_vals):
+def create_themis_party_categories(session, party_category_vals):
     logger.info("Migrating Themis party categories ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list = preprocess_party_category_values(party_category_vals)
-    party_category_response = models.execute_kw(database, uid, secret, "cases.party_category", "create", [party_category_vals])
+    external_ids = ExternalIds(session, "cases.party_category", "adrescategorie")
+    id_list = []
+    migrated_id_mapping = {}
+
+    def preprocessed_vals():
+        for batch in split_every(party_category_vals):
+            batch_id_list = preprocess_party_category_values(batch)
+            external_ids.add_migrated(batch_id_list, migrated_id_mapping)
+            for category_id, vals in zip(batch_id_list, batch):
+                if category_id not in migrated_id_mapping:
+                    id_list.append(category_id)
+                    external_ids.tag(vals, category_id)
+                    yield vals
+
+    loader = BatchLoader(execute_batch_method(session, "cases.party_category", "create_from_themis"), "party categories")
+    party_category_response = loader.load(preprocessed_vals())
     if len(id_list) == len(party_category_response):
         logger.info("Created " + str(len(id_list)) + " party categories.")
         party_category_id_mapping = dict(zip(id_list, party_category_response))
+        party_category_id_mapping.update(migrated_id_mapping)
     else:
         party_category_id_mapping = {}
     return party_category_id_mapping
@@ -118,6 +227,7 @@ def preprocess_create_write_dates(vals):
     vals["write_date"] = vals["write_date"] and correct_year_format(vals["write_date"].strftime(odoo_datetime_format))
 
 
+@metrics.timed("transform")
 def preprocess_company_values(company_vals, user_id_mapping, country_code_id_mapping):
     id_list = []
     category_id_list = []
@@ -151,19 +261,55 @@ def preprocess_company_values(company_vals, user_id_mapping, country_code_id_map
     return id_list, category_id_mapping, company_bank_vals
 
 
-def create_themis_companies(url, database, username, secret, company_vals, user_id_mapping, country_code_id_mapping):
+def create_themis_companies(session, company_vals, user_id_mapping, country_code_id_mapping, checkpoint=no_checkpoint):
     logger.info("Migrating Themis companies ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list, category_id_mapping, bank_vals = preprocess_company_values(company_vals, user_id_mapping, country_code_id_mapping)
-    response = models.execute_kw(database, uid, secret, "res.partner", "create_from_themis", [company_vals])
-    logger.info("Created " + str(len(response)) + " companies.")
-    id_mapping = dict(zip(id_list, response))
-    for vals in bank_vals:
-        vals["partner_id"] = id_mapping.get(vals["partner_id"], False)
-    models.execute_kw(database, uid, secret, "res.partner.bank", "create", [bank_vals])
+    id_mapping = checkpoint.load_mapping("id_mapping", IdMapping)
+    external_ids = ExternalIds(session, "res.partner", "bedrijf")
+    # Changed values of records that were migrated before, only collected in a delta run
+    write_vals = []
+    bank_id_mapping = checkpoint.load_mapping("bank_id_mapping", IdMapping)
+    id_list = []
+    category_id_mapping = {}
+    bank_vals = []
+
+    def preprocessed_vals():
+        for batch in split_every(company_vals):
+            batch_id_list, batch_category_id_mapping, batch_bank_vals = preprocess_company_values(batch, user_id_mapping, country_code_id_mapping)
+            category_id_mapping.update(batch_category_id_mapping)
+            bank_vals.extend(vals for vals in batch_bank_vals if vals["partner_id"] not in bank_id_mapping)
+            external_ids.add_migrated(batch_id_list, id_mapping, checkpoint)
+            for company_id, vals in zip(batch_id_list, batch):
+                if company_id not in id_mapping:
+                    id_list.append(company_id)
+                    external_ids.tag(vals, company_id)
+                    yield vals
+                elif checkpoint.delta:
+                    write_vals.append((id_mapping[company_id], vals))
+
+    loader = BatchLoader(execute_batch_method(session, "res.partner", "create_from_themis"), "companies",
+                         on_result=checkpoint.mapping_committer("id_mapping", id_list, id_mapping))
+    response = loader.load(preprocessed_vals())
+    logger.info("Created " + str(len(response) - loader.failed_count) + " companies.")
+    if write_vals:
+        logger.info("Updated " + str(write_themis_records(session, "res.partner", write_vals, "companies")) + " companies.")
+    # The bank accounts are keyed by the Themis id of their partner
+    bank_external_ids = ExternalIds(session, "res.partner.bank", "bedrijfbankrekening")
+    bank_id_list = []
+    unmigrated_bank_vals = []
+    for batch in split_every(bank_vals):
+        bank_external_ids.add_migrated([vals["partner_id"] for vals in batch], bank_id_mapping, checkpoint, "bank_id_mapping")
+        for vals in batch:
+            if vals["partner_id"] not in bank_id_mapping:
+                bank_id_list.append(vals["partner_id"])
+                bank_external_ids.tag(vals, vals["partner_id"])
+                vals["partner_id"] = id_mapping.get(vals["partner_id"], False)
+                unmigrated_bank_vals.append(vals)
+    BatchLoader(execute_batch_method(session, "res.partner.bank", "create_from_themis"), "bank accounts",
+                on_result=checkpoint.mapping_committer("bank_id_mapping", bank_id_list, bank_id_mapping)).load(unmigrated_bank_vals)
     return id_mapping, category_id_mapping
 
 
+@metrics.timed("transform")
 def preprocess_contact_values(contact_vals, company_id_mapping, user_id_mapping, country_code_id_mapping):
     id_list = []
     category_id_list = []
@@ -207,19 +353,55 @@ def preprocess_contact_values(contact_vals, company_id_mapping, user_id_mapping,
     return id_list, category_id_mapping, contact_bank_vals
 
 
-def create_themis_contacts(url, database, username, secret, contact_vals, company_id_mapping, user_id_mapping, country_code_id_mapping):
+def create_themis_contacts(session, contact_vals, company_id_mapping, user_id_mapping, country_code_id_mapping, checkpoint=no_checkpoint):
     logger.info("Migrating Themis contacts ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list, category_id_mapping, bank_vals = preprocess_contact_values(contact_vals, company_id_mapping, user_id_mapping, country_code_id_mapping)
-    response = models.execute_kw(database, uid, secret, "res.partner", "create_from_themis", [contact_vals])
-    logger.info("Created " + str(len(response)) + " contacts.")
-    id_mapping = dict(zip(id_list, response))
-    for vals in bank_vals:
-        vals["partner_id"] = id_mapping.get(vals["partner_id"], False)
-    models.execute_kw(database, uid, secret, "res.partner.bank", "create", [bank_vals])
+    id_mapping = checkpoint.load_mapping("id_mapping", IdMapping)
+    external_ids = ExternalIds(session, "res.partner", "adresboek")
+    # Changed values of records that were migrated before, only collected in a delta run
+    write_vals = []
+    bank_id_mapping = checkpoint.load_mapping("bank_id_mapping", IdMapping)
+    id_list = []
+    category_id_mapping = {}
+    bank_vals = []
+
+    def preprocessed_vals():
+        for batch in split_every(contact_vals):
+            batch_id_list, batch_category_id_mapping, batch_bank_vals = preprocess_contact_values(batch, company_id_mapping, user_id_mapping, country_code_id_mapping)
+            category_id_mapping.update(batch_category_id_mapping)
+            bank_vals.extend(vals for vals in batch_bank_vals if vals["partner_id"] not in bank_id_mapping)
+            external_ids.add_migrated(batch_id_list, id_mapping, checkpoint)
+            for contact_id, vals in zip(batch_id_list, batch):
+                if contact_id not in id_mapping:
+                    id_list.append(contact_id)
+                    external_ids.tag(vals, contact_id)
+                    yield vals
+                elif checkpoint.delta:
+                    write_vals.append((id_mapping[contact_id], vals))
+
+    loader = BatchLoader(execute_batch_method(session, "res.partner", "create_from_themis"), "contacts",
+                         on_result=checkpoint.mapping_committer("id_mapping", id_list, id_mapping))
+    response = loader.load(preprocessed_vals())
+    logger.info("Created " + str(len(response) - loader.failed_count) + " contacts.")
+    if write_vals:
+        logger.info("Updated " + str(write_themis_records(session, "res.partner", write_vals, "contacts")) + " contacts.")
+    # The bank accounts are keyed by the Themis id of their partner
+    bank_external_ids = ExternalIds(session, "res.partner.bank", "adresboekbankrekening")
+    bank_id_list = []
+    unmigrated_bank_vals = []
+    for batch in split_every(bank_vals):
+        bank_external_ids.add_migrated([vals["partner_id"] for vals in batch], bank_id_mapping, checkpoint, "bank_id_mapping")
+        for vals in batch:
+            if vals["partner_id"] not in bank_id_mapping:
+                bank_id_list.append(vals["partner_id"])
+                bank_external_ids.tag(vals, vals["partner_id"])
+                vals["partner_id"] = id_mapping.get(vals["partner_id"], False)
+                unmigrated_bank_vals.append(vals)
+    BatchLoader(execute_batch_method(session, "res.partner.bank", "create_from_themis"), "bank accounts",
+                on_result=checkpoint.mapping_committer("bank_id_mapping", bank_id_list, bank_id_mapping)).load(unmigrated_bank_vals)
     return id_mapping, category_id_mapping
 
 
+@metrics.timed("transform")
 def preprocess_case_category_values(case_category_vals):
     id_list = []
     for vals in case_category_vals:
@@ -227,19 +409,34 @@ def preprocess_case_category_values(case_category_vals):
     return id_list
 
 
-def create_themis_case_categories(url, database, username, secret, case_category_vals):
+def create_themis_case_categories(session, case_category_vals):
     logger.info("Migrating Themis case categories ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list = preprocess_case_category_values(case_category_vals)
-    response = models.execute_kw(database, uid, secret, "cases.case_category", "create", [case_category_vals])
+    external_ids = ExternalIds(session, "cases.case_category", "dossiercategorie")
+    id_list = []
+    migrated_id_mapping = {}
+
+    def preprocessed_vals():
+        for batch in split_every(case_category_vals):
+            batch_id_list = preprocess_case_category_values(batch)
+            external_ids.add_migrated(batch_id_list, migrated_id_mapping)
+            for category_id, vals in zip(batch_id_list, batch):
+                if category_id not in migrated_id_mapping:
+                    id_list.append(category_id)
+                    external_ids.tag(vals, category_id)
+                    yield vals
+
+    loader = BatchLoader(execute_batch_method(session, "cases.case_category", "create_from_themis"), "case categories")
+    response = loader.load(preprocessed_vals())
     if len(id_list) == len(response):
         logger.info("Created " + str(len(id_list)) + " case categories.")
         id_mapping = dict(zip(id_list, response))
+        id_mapping.update(migrated_id_mapping)
         return id_mapping
     else:
         return {}
 
 
+@metrics.timed("transform")
 def preprocess_case_values(case_vals, company_id_mapping, contact_id_mapping, user_id_mapping, case_category_id_mapping):
     id_list = []
     active_list = []
@@ -267,51 +464,97 @@ def preprocess_case_values(case_vals, company_id_mapping, contact_id_mapping, us
     return id_list, active_mapping, case_tariff_mapping
 
 
-def create_themis_cases(url, database, username, secret, case_vals, company_id_mapping, contact_id_mapping, user_id_mapping, case_category_id_mapping):
+def create_themis_cases(session, case_vals, company_id_mapping, contact_id_mapping, user_id_mapping, case_category_id_mapping, checkpoint=no_checkpoint):
     logger.info("Migrating Themis cases ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list, active_mapping, case_tariff_mapping = preprocess_case_values(case_vals, company_id_mapping, contact_id_mapping, user_id_mapping, case_category_id_mapping)
-    response = models.execute_kw(database, uid, secret, "cases.case", "create_from_themis", [case_vals])
+    id_mapping = checkpoint.load_mapping("id_mapping", IdMapping)
+    external_ids = ExternalIds(session, "cases.case", "dossier")
+    # Changed values of records that were migrated before, only collected in a delta run
+    write_vals = []
+    id_list = []
+    active_mapping = {}
+    case_tariff_mapping = {}
+
+    def preprocessed_vals():
+        for batch in split_every(case_vals):
+            batch_id_list, batch_active_mapping, batch_tariff_mapping = preprocess_case_values(batch, company_id_mapping, contact_id_mapping, user_id_mapping, case_category_id_mapping)
+            active_mapping.update(batch_active_mapping)
+            case_tariff_mapping.update(batch_tariff_mapping)
+            external_ids.add_migrated(batch_id_list, id_mapping, checkpoint)
+            for case_id, vals in zip(batch_id_list, batch):
+                if case_id not in id_mapping:
+                    id_list.append(case_id)
+                    external_ids.tag(vals, case_id)
+                    yield vals
+                elif checkpoint.delta:
+                    write_vals.append((id_mapping[case_id], vals))
+
+    loader = BatchLoader(execute_batch_method(session, "cases.case", "create_from_themis"), "cases",
+                         on_result=checkpoint.mapping_committer("id_mapping", id_list, id_mapping))
+    response = loader.load(preprocessed_vals())
     if len(id_list) == len(response):
-        logger.info("Created " + str(len(id_list)) + " cases.")
-        id_mapping = dict(zip(id_list, response))
+        logger.info("Created " + str(len(id_list) - loader.failed_count) + " cases.")
+        if write_vals:
+            logger.info("Updated " + str(write_themis_records(session, "cases.case", write_vals, "cases")) + " cases.")
         return id_mapping, active_mapping, case_tariff_mapping
     else:
         return {}, {}, {}
 
 
-def preprocess_case_description_vals(case_description_vals, case_description_type_vals, case_id_mapping):
-    write_dict = {}
-    case_description_name_mapping = {}
-    for type_vals in case_description_type_vals:
-        case_description_name_mapping[type_vals["id"]] = type_vals["name"]
-    for vals in case_description_vals:
-        case_id = case_id_mapping.get(vals["case_id"], False)
-        if case_id and vals["description"]:
-            description_name = case_description_name_mapping.get(vals["type_id"], False) or ""
-            description_name = description_name and (description_name + ":")
-            if type(vals["description"]) is not bytes:
-                desc_bytes = vals["description"].read()
-            else:
-                desc_bytes = vals["description"]
-            text = rtf_to_text(desc_bytes.decode("cp1252")).replace("\n", "<br>\n")
-            text = description_name + "<br>\n" + text + "<br>\n"
-            if str(case_id) in write_dict:
-                logger.info(case_id)
-                write_dict[str(case_id)]["description"] += text
-            else:
-                write_dict[str(case_id)] = {"description": text}
-    return write_dict
-
-
-def write_case_descriptions(url, database, username, secret, case_description_vals, case_description_type_vals, case_id_mapping):
+# The RTF of a batch of remarks is converted at once, see rtf_helper.RtfConverter. Returns the
+# (Odoo case id, text) of the remarks in their order.
+@metrics.timed("transform")
+def preprocess_case_description_vals(case_description_vals, case_description_name_mapping, case_id_mapping, converter):
+    batch = [vals for vals in case_description_vals if case_id_mapping.get(vals["case_id"], False) and vals["description"]]
+    rtf_list = []
+    for vals in batch:
+        if type(vals["description"]) is not bytes:
+            rtf_list.append(vals["description"].read())
+        else:
+            rtf_list.append(vals["description"])
+    texts = []
+    for vals, html in zip(batch, converter.convert_all(rtf_list)):
+        description_name = case_description_name_mapping.get(vals["type_id"], False) or ""
+        description_name = description_name and (description_name + ":")
+        texts.append((case_id_mapping[vals["case_id"]], description_name + "<br>\n" + html + "<br>\n"))
+    return texts
+
+
+# The remarks are read ordered by case, the description of a case is written as soon as its last
+# remark is converted, so only the remarks of a batch and the descriptions waiting to be sent are
+# kept in memory.
+def write_case_descriptions(session, case_description_vals, case_description_type_vals, case_id_mapping, converter=None, checkpoint=no_checkpoint):
     logger.info("Migrating Themis case descriptions ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    write_dict = preprocess_case_description_vals(case_description_vals, case_description_type_vals, case_id_mapping)
-    models.execute_kw(database, uid, secret, "cases.case", "write_from_themis", [write_dict])
+    converter = converter or RtfConverter(processes=1)
+    case_description_name_mapping = dict((type_vals["id"], type_vals["name"]) for type_vals in case_description_type_vals)
+    written_mapping = checkpoint.load_mapping("written_mapping")
+    id_list = []
+
+    def description_items():
+        case_id = None
+        description = ""
+        for batch in split_every(case_description_vals):
+            for text_case_id, text in preprocess_case_description_vals(batch, case_description_name_mapping, case_id_mapping, converter):
+                text_case_id = str(text_case_id)
+                if text_case_id != case_id:
+                    if case_id is not None and case_id not in written_mapping:
+                        id_list.append(case_id)
+                        yield case_id, {"description": description}
+                    case_id = text_case_id
+                    description = ""
+                description += text
+        if case_id is not None and case_id not in written_mapping:
+            id_list.append(case_id)
+            yield case_id, {"description": description}
+
+    def write_descriptions(batch):
+        session.execute_kw("cases.case", "write_from_themis", [dict(batch)])
+        return [True] * len(batch)
+
+    BatchLoader(write_descriptions, "case descriptions", on_result=checkpoint.mapping_committer("written_mapping", id_list, written_mapping)).load(description_items())
     logger.info("Themis case descriptions migrated.")
 
 
+@metrics.timed("transform")
 def preprocess_party_values(party_vals, company_id_mapping, contact_id_mapping, case_id_mapping, themis_company_category_id_mapping, themis_contact_category_id_mapping, party_category_id_mapping):
     for vals in party_vals:
         themis_company_id = vals.pop("company_id")
@@ -337,16 +580,38 @@ def preprocess_party_values(party_vals, company_id_mapping, contact_id_mapping,
         vals["party_category_ids"] = category_id and [(6, 0, [category_id])]
 
 
-def create_themis_parties(url, database, username, secret, party_vals, company_id_mapping, contact_id_mapping, case_id_mapping, themis_company_category_id_mapping, themis_contact_category_id_mapping, party_category_id_mapping):
+# Parties have no id in Themis, a party is the row of its case, contact, company and category
+def get_party_key(vals):
+    return vals["case_id"], [vals["case_id"], vals["contact_id"], vals["company_id"], vals["category_id"]]
+
+
+# Sets the clients of all cases from their parties
+def guess_case_clients(session):
+    logger.info("Guessing the clients of the cases ...")
+    session.execute_kw("cases.case", "guess_case_clients", [])
+
+
+# A case shard leaves guess_clients to the coordinator, which guesses them once for all shards
+def create_themis_parties(session, party_vals, company_id_mapping, contact_id_mapping, case_id_mapping, themis_company_category_id_mapping, themis_contact_category_id_mapping, party_category_id_mapping, checkpoint=no_checkpoint,
+                          guess_clients=True):
     logger.info("Migrating Themis parties ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    preprocess_party_values(party_vals, company_id_mapping, contact_id_mapping, case_id_mapping, themis_company_category_id_mapping, themis_contact_category_id_mapping, party_category_id_mapping)
-    response = models.execute_kw(database, uid, secret, "cases.party", "create", [party_vals])
-    models.execute_kw(database, uid, secret, "cases.case", "guess_case_clients", [])
-    logger.info("Created " + str(len(response)) + " parties.")
+    resume_point = checkpoint.resume_point("parties")
+
+    def preprocessed_vals():
+        for batch in split_every(party_vals):
+            batch = resume_point.track(batch, get_party_key)
+            preprocess_party_values(batch, company_id_mapping, contact_id_mapping, case_id_mapping, themis_company_category_id_mapping, themis_contact_category_id_mapping, party_category_id_mapping)
+            yield from batch
+
+    loader = BatchLoader(execute_batch_method(session, "cases.party", "create"), "parties", on_result=resume_point.commit, on_failure=resume_point.fail)
+    response = loader.load(preprocessed_vals())
+    if guess_clients:
+        guess_case_clients(session)
+    logger.info("Created " + str(len(response) - loader.failed_count) + " parties.")
     return response
 
 
+@metrics.timed("transform")
 def preprocess_timesheet_type_values(timesheet_type_vals):
     id_list = []
     timesheet_type_price_mapping = {}
@@ -359,19 +624,36 @@ def preprocess_timesheet_type_values(timesheet_type_vals):
     return id_list, timesheet_type_price_mapping
 
 
-def create_themis_timesheet_types(url, database, username, secret, timesheet_type_vals):
+def create_themis_timesheet_types(session, timesheet_type_vals):
     logger.info("Migrating Themis timesheet types ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list, timesheet_type_price_mapping = preprocess_timesheet_type_values(timesheet_type_vals)
-    response = models.execute_kw(database, uid, secret, "product.template", "create_timesheet_types_from_themis", [timesheet_type_vals])
+    external_ids = ExternalIds(session, "product.template", "tijdtype")
+    id_list = []
+    migrated_id_mapping = {}
+    timesheet_type_price_mapping = {}
+
+    def preprocessed_vals():
+        for batch in split_every(timesheet_type_vals):
+            batch_id_list, batch_price_mapping = preprocess_timesheet_type_values(batch)
+            timesheet_type_price_mapping.update(batch_price_mapping)
+            external_ids.add_migrated(batch_id_list, migrated_id_mapping)
+            for type_id, vals in zip(batch_id_list, batch):
+                if type_id not in migrated_id_mapping:
+                    id_list.append(type_id)
+                    external_ids.tag(vals, type_id)
+                    yield vals
+
+    loader = BatchLoader(execute_batch_method(session, "product.template", "create_timesheet_types_from_themis"), "timesheet types")
+    response = loader.load(preprocessed_vals())
     if len(id_list) == len(response):
         logger.info("Created " + str(len(id_list)) + " timesheet types.")
         id_mapping = dict(zip(id_list, response))
+        id_mapping.update(migrated_id_mapping)
         return id_mapping, timesheet_type_price_mapping
     else:
         return {}, timesheet_type_price_mapping
 
 
+@metrics.timed("transform")
 def process_case_timesheet_values(case_timesheet_vals):
     case_timesheet_mapping = {}
     for vals in case_timesheet_vals:
@@ -380,37 +662,80 @@ def process_case_timesheet_values(case_timesheet_vals):
     return case_timesheet_mapping
 
 
-def preprocess_timesheet_values(timesheet_vals, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, case_timesheet_vals):
-    case_timesheet_mapping = process_case_timesheet_values(case_timesheet_vals)
-    for vals in timesheet_vals:
-        themis_type_id = vals["type_id"]
-        vals["type_id"] = timesheet_type_id_mapping.get(themis_type_id, False)
-        themis_case_id = vals["case_id"]
-        vals["case_id"] = case_id_mapping.get(themis_case_id, False)
-        themis_user_id = vals["user_id"]
-        vals["user_id"] = user_id_mapping.get(themis_user_id, False)
-        minutes = vals.pop("minutes") or 0
-        vals["unit_amount"] = minutes / 60
-        price_unit = vals["price_unit"]
-        if not price_unit and price_unit != 0:
-            case_user_tariff = case_timesheet_mapping.get((themis_case_id, themis_user_id), None)
-            if not case_user_tariff and case_user_tariff != 0:
-                user_tariff = user_tariff_mapping.get(themis_user_id, None)
-                if not user_tariff and user_tariff != 0:
-                    case_tariff = case_tariff_mapping.get(themis_case_id, None)
-                    if not case_tariff and case_tariff != 0:
-                        vals["price_unit"] = timesheet_type_price_mapping.get(themis_type_id, None) or 0
-                    else:
-                        vals["price_unit"] = case_tariff
-                else:
-                    vals["price_unit"] = user_tariff
-            else:
-                vals["price_unit"] = case_user_tariff
-        vals["date"] = vals["date"] and correct_year_format(vals["date"].strftime(odoo_date_format))
-        vals["billable"] = vals["billable"] == "T"
-        vals["billed"] = vals["billed"] == "T"
+timesheet_schema = Schema(["name", "type_id", "case_id", "user_id", "price_unit", "date", "billable", "billed", "unit_amount"])
 
 
+# Themis leaves tariffs empty with NULL, a tariff of 0 is a price
+def has_price(price):
+    return bool(price) or price == 0
+
+
+def first_price(*prices):
+    for price in prices:
+        if has_price(price):
+            return price
+    return None
+
+
+# Resolves the prices of a batch in one pass: rows with a price keep it, the others get the price of
+# their key, which resolve_key looks up once for every distinct key in the batch.
+def resolve_batch_prices(prices, keys, resolve_key):
+    key_prices = dict((key, resolve_key(key)) for price, key in zip(prices, keys) if not has_price(price))
+    return [price if has_price(price) else key_prices[key] for price, key in zip(prices, keys)]
+
+
+# Formats every distinct date of a batch once, timesheets of the same day share a date
+def format_batch_dates(dates, date_format):
+    formatted_dates = dict((date, date and correct_year_format(date.strftime(date_format))) for date in set(dates))
+    return [formatted_dates[date] for date in dates]
+
+
+# Splits the values of a batch of records into one tuple per field
+def get_batch_columns(records, fields):
+    positions = records[0].schema.positions
+    columns = list(zip(*[record.values for record in records]))
+    return [columns[positions[field]] for field in fields]
+
+
+def set_batch_columns(records, schema, columns):
+    for record, values in zip(records, zip(*columns)):
+        record.schema = schema
+        record.values = values
+
+
+# Timesheets are record_helper.Record objects read with the fields of main.timesheet_value_mapping,
+# their values are replaced by a tuple with the fields of timesheet_schema, converted column by column
+# for the whole batch. A timesheet without price gets the tariff of its case and user, else of its
+# user, else of its case, else the price of its timesheet type.
+@metrics.timed("transform")
+def preprocess_timesheet_values(timesheet_vals, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, case_timesheet_mapping):
+    if not timesheet_vals:
+        return
+    names, type_ids, case_ids, user_ids, minutes, price_units, dates, billables, billeds = get_batch_columns(
+        timesheet_vals, ["name", "type_id", "case_id", "user_id", "minutes", "price_unit", "date", "billable", "billed"])
+
+    def resolve_tariff(key):
+        themis_case_id, themis_user_id, themis_type_id = key
+        tariff = first_price(case_timesheet_mapping.get((themis_case_id, themis_user_id), None),
+                             user_tariff_mapping.get(themis_user_id, None), case_tariff_mapping.get(themis_case_id, None))
+        if tariff is None:
+            return timesheet_type_price_mapping.get(themis_type_id, None) or 0
+        return tariff
+
+    set_batch_columns(timesheet_vals, timesheet_schema, [
+        names,
+        map(timesheet_type_id_mapping.get, type_ids, repeat(False)),
+        map(case_id_mapping.get, case_ids, repeat(False)),
+        map(user_id_mapping.get, user_ids, repeat(False)),
+        resolve_batch_prices(price_units, list(zip(case_ids, user_ids, type_ids)), resolve_tariff),
+        format_batch_dates(dates, odoo_date_format),
+        [billable == "T" for billable in billables],
+        [billed == "T" for billed in billeds],
+        [(minute_count or 0) / 60 for minute_count in minutes],
+    ])
+
+
+@metrics.timed("transform")
 def preprocess_cost_type_values(cost_type_vals):
     id_list = []
     cost_type_price_mapping = {}
@@ -423,19 +748,36 @@ def preprocess_cost_type_values(cost_type_vals):
     return id_list, cost_type_price_mapping
 
 
-def create_themis_cost_types(url, database, username, secret, cost_type_vals):
+def create_themis_cost_types(session, cost_type_vals):
     logger.info("Migrating Themis cost types ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list, cost_type_price_mapping = preprocess_cost_type_values(cost_type_vals)
-    response = models.execute_kw(database, uid, secret, "product.template", "create", [cost_type_vals])
+    external_ids = ExternalIds(session, "product.template", "kosttype")
+    id_list = []
+    migrated_id_mapping = {}
+    cost_type_price_mapping = {}
+
+    def preprocessed_vals():
+        for batch in split_every(cost_type_vals):
+            batch_id_list, batch_price_mapping = preprocess_cost_type_values(batch)
+            cost_type_price_mapping.update(batch_price_mapping)
+            external_ids.add_migrated(batch_id_list, migrated_id_mapping)
+            for type_id, vals in zip(batch_id_list, batch):
+                if type_id not in migrated_id_mapping:
+                    id_list.append(type_id)
+                    external_ids.tag(vals, type_id)
+                    yield vals
+
+    loader = BatchLoader(execute_batch_method(session, "product.template", "create_from_themis"), "cost types")
+    response = loader.load(preprocessed_vals())
     if len(id_list) == len(response):
         logger.info("Created " + str(len(id_list)) + " cost types.")
         id_mapping = dict(zip(id_list, response))
+        id_mapping.update(migrated_id_mapping)
         return id_mapping, cost_type_price_mapping
     else:
         return {}, cost_type_price_mapping
 
 
+@metrics.timed("transform")
 def process_case_cost_values(case_cost_vals):
     case_cost_mapping = {}
     for vals in case_cost_vals:
@@ -444,44 +786,85 @@ def process_case_cost_values(case_cost_vals):
     return case_cost_mapping
 
 
-def preprocess_cost_values(cost_vals, case_id_mapping, cost_type_id_mapping, cost_type_price_mapping, case_cost_vals):
+cost_schema = Schema(["name", "type_id", "case_id", "amount", "price", "price_unit", "billable", "billed"])
+
+
+# Costs are record_helper.Record objects read with the fields of main.cost_value_mapping, their
+# values are replaced by a tuple with the fields of cost_schema, converted column by column for the
+# whole batch. A cost with an amount is sent with a unit price instead of its price: the price
+# divided by the amount, else its own unit price, else the tariff of its case and cost type, else
+# the price of its cost type.
+@metrics.timed("transform")
+def preprocess_cost_values(cost_vals, case_id_mapping, cost_type_id_mapping, cost_type_price_mapping, case_cost_mapping):
+    if not cost_vals:
+        return
+    names, type_ids, case_ids, amounts, prices, price_units, billables, billeds = get_batch_columns(
+        cost_vals, ["name", "type_id", "case_id", "amount", "price", "price_unit", "billable", "billed"])
+
+    def resolve_tariff(key):
+        themis_case_id, themis_type_id = key
+        tariff = case_cost_mapping.get(key, None)
+        if not has_price(tariff):
+            return cost_type_price_mapping.get(themis_type_id, None) or 0
+        return tariff
+
+    amount_price_units = resolve_batch_prices(
+        [price / amount if amount and has_price(price) else price_unit for amount, price, price_unit in zip(amounts, prices, price_units)],
+        list(zip(case_ids, type_ids)), resolve_tariff)
+    set_batch_columns(cost_vals, cost_schema, [
+        names,
+        map(cost_type_id_mapping.get, type_ids, repeat(False)),
+        map(case_id_mapping.get, case_ids, repeat(False)),
+        amounts,
+        [omitted if amount else price for amount, price in zip(amounts, prices)],
+        [amount_price_unit if amount else price_unit for amount, amount_price_unit, price_unit in zip(amounts, amount_price_units, price_units)],
+        [billable == "T" for billable in billables],
+        [billed == "T" for billed in billeds],
+    ])
+
+
+# Timesheets and costs are read in the order of their Themis id, see checkpoint_helper.ResumePoint
+def get_record_key(vals):
+    return vals["id"], vals["id"]
+
+
+def create_themis_timesheets_costs(session, timesheet_vals, cost_vals, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, cost_type_id_mapping, cost_type_price_mapping, case_timesheet_vals, case_cost_vals, checkpoint=no_checkpoint):
+    logger.info("Migrating Themis timesheets and costs ...")
+    timesheet_resume_point = checkpoint.resume_point("timesheets")
+    cost_resume_point = checkpoint.resume_point("costs")
+    case_timesheet_mapping = process_case_timesheet_values(case_timesheet_vals)
     case_cost_mapping = process_case_cost_values(case_cost_vals)
-    for vals in cost_vals:
-        themis_type_id = vals["type_id"]
-        vals["type_id"] = cost_type_id_mapping.get(themis_type_id, False)
-        themis_case_id = vals["case_id"]
-        vals["case_id"] = case_id_mapping.get(themis_case_id, False)
-        # vals["date"] = vals["date"] and correct_year_format(vals["date"].strftime(odoo_date_format))
-        amount = vals["amount"]
-        if amount:
-            price = vals.pop("price")
-            if not price and price != 0:
-                price_unit = vals["price_unit"]
-                if not price_unit and price_unit != 0:
-                    case_cost = case_cost_mapping.get((themis_case_id, themis_type_id), None)
-                    if not case_cost and case_cost != 0:
-                        vals["price_unit"] = cost_type_price_mapping.get(themis_type_id, None) or 0
-                    else:
-                        vals["price_unit"] = case_cost
-                else:
-                    vals["price_unit"] = price_unit
-            else:
-                vals["price_unit"] = price / amount
-        vals["billable"] = vals["billable"] == "T"
-        vals["billed"] = vals["billed"] == "T"
-
 
-def create_themis_timesheets_costs(url, database, username, secret, timesheet_vals, cost_vals, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, cost_type_id_mapping, cost_type_price_mapping, case_timesheet_vals, case_cost_vals):
-    logger.info("Migrating Themis timesheets and costs ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    preprocess_timesheet_values(timesheet_vals, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, case_timesheet_vals)
-    preprocess_cost_values(cost_vals, case_id_mapping, cost_type_id_mapping, cost_type_price_mapping, case_cost_vals)
-    response = models.execute_kw(database, uid, secret, "cases.case", "create_timesheets_costs_from_themis", [timesheet_vals, cost_vals])
+    def preprocessed_timesheet_vals():
+        for batch in split_every(timesheet_vals):
+            batch = timesheet_resume_point.track(batch, get_record_key)
+            preprocess_timesheet_values(batch, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, case_timesheet_mapping)
+            yield from batch
+
+    def preprocessed_cost_vals():
+        for batch in split_every(cost_vals):
+            batch = cost_resume_point.track(batch, get_record_key)
+            preprocess_cost_values(batch, case_id_mapping, cost_type_id_mapping, cost_type_price_mapping, case_cost_mapping)
+            yield from batch
+
+    # create_timesheets_costs_from_themis only returns the number of created records per list
+    def create_timesheets(batch):
+        return [True] * session.execute_kw("cases.case", "create_timesheets_costs_from_themis", [batch, []])[0]
+
+    def create_costs(batch):
+        return [True] * session.execute_kw("cases.case", "create_timesheets_costs_from_themis", [[], batch])[1]
+
+    timesheet_response = BatchLoader(create_timesheets, "timesheets", on_result=timesheet_resume_point.commit, on_failure=timesheet_resume_point.fail)\
+        .load(preprocessed_timesheet_vals())
+    cost_response = BatchLoader(create_costs, "costs", on_result=cost_resume_point.commit, on_failure=cost_resume_point.fail)\
+        .load(preprocessed_cost_vals())
+    response = [timesheet_response.count(True), cost_response.count(True)]
     logger.info("Created " + str(response[0]) + " timesheets.")
     logger.info("Created " + str(response[1]) + " costs.")
     return response
 
 
+@metrics.timed("transform")
 def preprocess_document_category_values(document_category_vals):
     id_list = []
     for vals in document_category_vals:
@@ -489,29 +872,46 @@ def preprocess_document_category_values(document_category_vals):
     return id_list
 
 
-def create_themis_document_categories(url, database, username, secret, document_category_vals):
+def create_themis_document_categories(session, document_category_vals):
     logger.info("Migrating Themis document categories ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    id_list = preprocess_document_category_values(document_category_vals)
-    response = models.execute_kw(database, uid, secret, "cases.document_category", "create", [document_category_vals])
+    external_ids = ExternalIds(session, "cases.document_category", "dossierdocumentmap")
+    id_list = []
+    migrated_id_mapping = {}
+
+    def preprocessed_vals():
+        for batch in split_every(document_category_vals):
+            batch_id_list = preprocess_document_category_values(batch)
+            external_ids.add_migrated(batch_id_list, migrated_id_mapping)
+            for category_id, vals in zip(batch_id_list, batch):
+                if category_id not in migrated_id_mapping:
+                    id_list.append(category_id)
+                    external_ids.tag(vals, category_id)
+                    yield vals
+
+    loader = BatchLoader(execute_batch_method(session, "cases.document_category", "create_from_themis"), "document categories")
+    response = loader.load(preprocessed_vals())
     if len(id_list) == len(response):
         logger.info("Created " + str(len(id_list)) + " document categories.")
         id_mapping = dict(zip(id_list, response))
+        id_mapping.update(migrated_id_mapping)
         return id_mapping
     else:
         return {}
 
 
-def preprocess_document_values(vals, document_path, case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping):
+@metrics.timed("transform")
+def preprocess_document_values(vals, document_path, case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping, document_index=None):
     if "case_id" in vals:
         dir_nb = vals["case_id"]
         filepath = os.path.join(document_path, str(dir_nb) + "/" + vals["filename"])
         try:
-            with open(filepath, "rb") as data:
-                datas = base64.b64encode(data.read()).decode("utf-8")
-                # datas = base64.b64encode(data.read()).decode("utf-8", errors="replace").replace("\x00", "\uFFFD")
+            # The file is only read and base64 encoded while the request is sent
+            if document_index:
+                datas = DocumentFile(filepath, *document_index.stat(str(dir_nb), vals["filename"]))
+            else:
+                datas = DocumentFile(filepath)
         except FileNotFoundError:
-            # logger.info("File at " + str(filepath) + " not found.")
+            logger.debug("File at " + str(filepath) + " not found.")
             return False
         else:
             vals["datas"] = datas
@@ -527,43 +927,225 @@ def preprocess_document_values(vals, document_path, case_id_mapping, active_mapp
         return False
 
 
-def create_documents(models, database, uid, secret, vals_list):
-    if vals_list:
-        try:
-            response = models.execute_kw(database, uid, secret, "cases.document", "create_from_themis", [vals_list])
-        except Exception as e:
-            if len(vals_list) == 1:
-                logger.info("Error occured when migrating document: \n", e)
-                logger.info("Document name: " + str(vals_list[0].get("filename", "")))
-                logger.info("Odoo case id: " + str(vals_list[0].get("case_id", "")))
-            else:
-                logger.info("Error occured when migrating documents: \n", e)
-                logger.info("Splitting documents into 2 ...")
-                lst1 = vals_list[:len(vals_list) // 2]
-                create_documents(models, database, uid, secret, lst1)
-                lst2 = vals_list[len(vals_list) // 2:]
-                create_documents(models, database, uid, secret, lst2)
-        else:
-            logger.info("Created " + str(len(response)) + " documents.")
-
-
-def create_themis_documents(url, database, username, secret, document_vals, document_path, case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping):
+# Documents of at least dedup_bytes are uploaded once per content (see document_helper.hash_file),
+# the other documents with the same content are created as a copy: create_from_themis takes their
+# content from content_document_id, the uploaded document in Odoo, so it is not sent again. Content
+# can only be a copy of content of the same size: the first document of a size is uploaded right
+# away and hashed while it is sent, only documents of a size that was seen before are read to hash
+# them first (and the first one of their size, when it is still being sent). A copy of content that
+# is still being uploaded is held by the pipeline until that upload is done, then it is sent with the
+# next batch. A copy that fails is uploaded after all. The hashes of the files and the uploaded
+# content are kept in the checkpoint, so later runs neither hash a file again nor upload content twice.
+# Without dedup_bytes every document is uploaded. With a document_index (see
+# document_helper.scan_document_folder) the files are looked up in memory instead of on disk.
+def create_themis_documents(session, document_vals, document_path, case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping, readers=default_readers, max_inflight_bytes=None,
+                            dedup_bytes=default_document_dedup_bytes, checkpoint=no_checkpoint, document_index=None):
     logger.info("Migrating Themis documents ...")
-    models, uid = connect_to_odoo(url, database, username, secret)
-    temp_vals = []
-    temp_size = 0
-    max_size = 30000000
-    while len(document_vals) > 0:
-        vals = document_vals.pop()
-        if preprocess_document_values(vals, document_path, case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping):
-            data_size = sys.getsizeof(vals["datas"])
-            if temp_size + data_size < max_size:
-                temp_vals.append(vals)
-                temp_size += data_size
+    id_mapping = checkpoint.load_mapping("id_mapping", IdMapping)
+    external_ids = ExternalIds(session, "cases.document", "dossierdocument")
+    # File path: [size, modification time, hash] and content hash: Odoo id of the uploaded document
+    file_hashes = checkpoint.load_mapping("file_hashes")
+    content_mapping = checkpoint.load_mapping("content_mapping")
+    # Themis ids and content hashes of the documents that are being sent, by the id() of their values
+    upload_id_mapping = {}
+    upload_hash_mapping = {}
+    # Content hash: the held documents with that content, of the content that is being uploaded
+    uploading_hashes = {}
+    # Files of the copies by the id() of their values, they are uploaded when the copy fails
+    copy_files = {}
+    copied_count = 0
+    copied_bytes = 0
+    # Files that are hashed by this run, their hash is saved with the document
+    hashed_paths = set()
+    # Sizes of the content in Odoo or being uploaded, the uploads that are hashed while they are sent
+    # by their size and the id() of the ones that are still being sent
+    content_sizes = set(file_hash[0] for file_hash in file_hashes.values())
+    streaming_vals = {}
+    streaming_ids = set()
+    lock = threading.Lock()
+    streaming_lock = threading.Lock()
+
+    def get_file_stat(datas):
+        if datas.mtime_ns is None:
+            stat = os.stat(datas.path)
+            return [stat.st_size, stat.st_mtime_ns]
+        return [datas.size, datas.mtime_ns]
+
+    # The hash of an unchanged file from the checkpoint, or None
+    def get_cached_hash(datas, file_stat):
+        file_hash = file_hashes.get(datas.path)
+        if file_hash and file_hash[:2] == file_stat:
+            return file_hash[2]
+        return None
+
+    def set_file_hash(datas, file_stat, content_hash):
+        file_hashes[datas.path] = file_stat + [content_hash]
+        hashed_paths.add(datas.path)
+
+    def get_document_file(vals):
+        return vals.get("datas") or copy_files.get(id(vals))
+
+    def prepare_document(vals):
+        document_id = vals.pop("id")
+        if document_id in id_mapping:
+            return False
+        upload_id_mapping[id(vals)] = document_id
+        external_ids.tag(vals, document_id)
+        if not preprocess_document_values(vals, document_path, case_id_mapping, active_mapping, user_id_mapping, document_category_id_mapping, document_index):
+            upload_id_mapping.pop(id(vals))
+            return False
+        datas = vals["datas"]
+        if dedup_bytes is not None and datas.size >= dedup_bytes:
+            file_stat = get_file_stat(datas)
+            content_hash = get_cached_hash(datas, file_stat)
+            with lock:
+                if content_hash is None and datas.size not in content_sizes:
+                    content_sizes.add(datas.size)
+                    streaming_vals[datas.size] = vals
+                    streaming_ids.add(id(vals))
+                    datas.hash_content = True
+                    return True
+            hash_streaming_file(datas.size)
+            if content_hash is None:
+                content_hash = hash_file(datas.path)
+                set_file_hash(datas, file_stat, content_hash)
+            upload_hash_mapping[id(vals)] = content_hash
+            return route_document(vals, content_hash)
+        return True
+
+    def make_copy(vals, source_id):
+        copy_files[id(vals)] = vals.pop("datas")
+        vals["content_document_id"] = source_id
+
+    # A document is copied when its content is in Odoo, held when its content is being uploaded
+    # (returns None) and else uploaded
+    def route_document(vals, content_hash):
+        with lock:
+            source_id = content_mapping.get(content_hash)
+            if source_id is None:
+                if content_hash in uploading_hashes:
+                    uploading_hashes[content_hash].append(vals)
+                    return None
+                uploading_hashes[content_hash] = []
+                return True
+            make_copy(vals, source_id)
+        return True
+
+    # A document of the size of an upload that is still being sent may be a copy of it, so that file
+    # is hashed now, once for its size
+    def hash_streaming_file(size):
+        with streaming_lock:
+            with lock:
+                streaming = streaming_vals.pop(size, None)
+            if streaming is not None:
+                content_hash = hash_file(streaming["datas"].path)
+                with lock:
+                    if id(streaming) in streaming_ids:
+                        upload_hash_mapping[id(streaming)] = content_hash
+                        uploading_hashes.setdefault(content_hash, [])
+
+    # A document was sent: returns its content hash and the held documents that can be sent now. They
+    # are copies when the content is in Odoo, else the first one uploads it and the others stay held.
+    def finish_upload(vals, odoo_id):
+        datas = vals.get("datas")
+        with lock:
+            streaming_ids.discard(id(vals))
+            if datas is not None and streaming_vals.get(datas.size) is vals:
+                streaming_vals.pop(datas.size)
+            content_hash = upload_hash_mapping.pop(id(vals), None)
+            if content_hash is None and datas is not None and datas.hash_content:
+                content_hash = datas.content_hash
+            if content_hash is None:
+                return None, []
+            if odoo_id and content_hash not in content_mapping:
+                content_mapping[content_hash] = odoo_id
+            if content_hash in content_mapping:
+                held_vals = uploading_hashes.pop(content_hash, [])
+                for held in held_vals:
+                    make_copy(held, content_mapping[content_hash])
+                return content_hash, held_vals
+            if uploading_hashes.get(content_hash):
+                return content_hash, [uploading_hashes[content_hash].pop(0)]
+            uploading_hashes.pop(content_hash, None)
+            return content_hash, []
+
+    def get_document_details(vals):
+        datas = get_document_file(vals)
+        return {"filename": vals.get("filename"), "path": getattr(datas, "path", None), "size": getattr(datas, "size", None)}
+
+    # Documents that failed on their own are written to the dead-letter file right away, a copy
+    # that failed is uploaded instead. The loader still passes them to commit_documents without an id.
+    def fail_document(vals, reason):
+        if "content_document_id" in vals:
+            logger.warning("Uploading " + str(vals.get("filename")) + " instead of copying document " + str(vals["content_document_id"]) + ".")
+            upload = dict((key, value) for key, value in vals.items() if key != "content_document_id")
+            upload["datas"] = copy_files.pop(id(vals))
+            upload_id_mapping[id(upload)] = upload_id_mapping.pop(id(vals))
+            upload_hash_mapping[id(upload)] = upload_hash_mapping.pop(id(vals), None)
+            pipeline.release(upload)
+            return
+        content_hash, held_vals = finish_upload(vals, False)
+        document_id = upload_id_mapping.pop(id(vals), None)
+        if document_id is not None:
+            checkpoint.add_dead_letter(document_id, reason, get_document_details(vals))
+        for held in held_vals:
+            pipeline.release(held)
+
+    def commit_documents(batch, result):
+        nonlocal copied_count, copied_bytes
+        items = []
+        content_items = []
+        file_items = []
+        held = []
+        for vals, odoo_id in zip(batch, result):
+            document_id = upload_id_mapping.pop(id(vals), None)
+            if document_id is None:
+                continue
+            content_hash, held_vals = finish_upload(vals, odoo_id)
+            held.extend(held_vals)
+            datas = get_document_file(vals)
+            copy_files.pop(id(vals), None)
+            if datas.hash_content and datas.content_hash:
+                set_file_hash(datas, get_file_stat(datas), datas.content_hash)
+            if odoo_id:
+                items.append((document_id, odoo_id))
+                if "content_document_id" in vals:
+                    copied_count += 1
+                    copied_bytes += datas.encoded_size
+                elif content_hash and content_mapping.get(content_hash) == odoo_id:
+                    content_items.append((content_hash, odoo_id))
+                if content_hash and datas.path in hashed_paths:
+                    file_items.append((datas.path, file_hashes[datas.path]))
             else:
-                create_documents(models, database, uid, secret, temp_vals)
-                temp_vals = [vals]
-                temp_size = data_size
-    if temp_vals:
-        response = models.execute_kw(database, uid, secret, "cases.document", "create_from_themis", [temp_vals])
-        logger.info("Created " + str(len(response)) + " documents.")
+                checkpoint.add_dead_letter(document_id, "Odoo did not return an id for the document", get_document_details(vals))
+        checkpoint.save_mapping("id_mapping", items)
+        checkpoint.save_mapping("content_mapping", content_items)
+        checkpoint.save_mapping("file_hashes", file_items)
+        checkpoint.resolve_dead_letters([document_id for document_id, odoo_id in items])
+        for vals in held:
+            pipeline.release(vals)
+
+    loader = BatchLoader(execute_batch_method(session, "cases.document", "create_from_themis"), "documents", max_bytes=max_document_batch_bytes,
+                         size_function=session.encoded_size, on_result=commit_documents, on_failure=fail_document, probe_bytes=document_probe_bytes)
+    pipeline = DocumentPipeline(loader, prepare_document, readers, max_inflight_bytes)
+
+    def unmigrated_document_vals():
+        for batch in split_every(document_vals):
+            migrated_id_mapping = external_ids.add_migrated([vals["id"] for vals in batch], id_mapping, checkpoint)
+            checkpoint.resolve_dead_letters(list(migrated_id_mapping))
+            yield from batch
+
+    created_count = pipeline.run(unmigrated_document_vals())
+    # Documents that are still held lost the upload of their content in a way that could not
+    # release them, they are sent again by a retry run
+    for held_vals in uploading_hashes.values():
+        for vals in held_vals:
+            document_id = upload_id_mapping.pop(id(vals), None)
+            if document_id is not None:
+                checkpoint.add_dead_letter(document_id, "The upload of the content of the document did not finish", get_document_details(vals))
+    if copied_count:
+        logger.info("Copied " + str(copied_count) + " documents with the content of an uploaded document, "
+                    + str(copied_bytes) + " encoded bytes were not sent again.")
+    logger.info("Created " + str(created_count) + " documents.")
+    if document_index and document_index.missing_count:
+        logger.warning(str(document_index.missing_count) + " documents were skipped, their file is not in the index of " + document_path + ".")
@@ -0,0 +1,35 @@
+# Compact rows for the large tables: a Record holds a tuple of values and a Schema with the field
+# names that is shared by all records of a table, instead of a dict per row. Records are only turned
+# into dicts while they are written to a request, see transport_helper.
+
+
+class Schema:
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.positions = dict((field, position) for position, field in enumerate(self.fields))
+
+
+class Omitted:
+    def __repr__(self):
+        return "omitted"
+
+
+# Value of a field that is left out when the record is sent
+omitted = Omitted()
+
+
+class Record:
+    __slots__ = ("schema", "values")
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    def __getitem__(self, field):
+        return self.values[self.schema.positions[field]]
+
+    def to_dict(self):
+        return dict((field, value) for field, value in zip(self.schema.fields, self.values) if value is not omitted)
+
+    def __repr__(self):
+        return repr(self.to_dict())
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from striprtf.striprtf import rtf_to_text
+
+
+default_rtf_processes = os.cpu_count() or 1
+# Converted remarks kept in memory, the most recently used ones, the others are in the SQLite cache
+default_rtf_memory_cache_size = 10000
+
+logger = logging.getLogger('RtfHelper')
+
+
+def rtf_to_html(rtf_bytes):
+    return rtf_to_text(rtf_bytes.decode("cp1252")).replace("\n", "<br>\n")
+
+
+# Converts RTF remarks to HTML on a pool of processes, striprtf is pure Python and would keep one
+# core busy for a long time. Results are cached by the SHA-256 of the RTF, in an optional SQLite
+# file and for the memory_cache_size most recently used remarks in memory, so identical template
+# remarks and the remarks of a previous run are only converted once. The pool uses spawn, forking
+# a process with running stage threads is not safe.
+class RtfConverter:
+    def __init__(self, processes=default_rtf_processes, cache_path=None, memory_cache_size=default_rtf_memory_cache_size):
+        self.processes = processes or default_rtf_processes
+        self.memory_cache_size = memory_cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.connection = None
+        if cache_path:
+            self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+            self.connection.execute("create table if not exists rtf (hash text primary key, html text)")
+            self.connection.commit()
+        self.converted_count = 0
+        self.cached_count = 0
+
+    def load_cached(self, hashes):
+        if not self.connection or not hashes:
+            return {}
+        cached = {}
+        hashes = list(hashes)
+        # SQLite limits the number of bound parameters
+        for start in range(0, len(hashes), 500):
+            part = hashes[start:start + 500]
+            rows = self.connection.execute("select hash, html from rtf where hash in (" + ",".join("?" * len(part)) + ")", part)
+            cached.update(rows)
+        return cached
+
+    def save_cached(self, items):
+        if self.connection and items:
+            self.connection.executemany("insert or replace into rtf (hash, html) values (?, ?)", items)
+            self.connection.commit()
+
+    def convert_all(self, rtf_list):
+        rtf_by_hash = {}
+        hashes = []
+        for rtf_bytes in rtf_list:
+            rtf_hash = hashlib.sha256(rtf_bytes).hexdigest()
+            hashes.append(rtf_hash)
+            rtf_by_hash[rtf_hash] = rtf_bytes
+        with self.lock:
+            html_by_hash = {}
+            for rtf_hash in rtf_by_hash:
+                if rtf_hash in self.cache:
+                    self.cache.move_to_end(rtf_hash)
+                    html_by_hash[rtf_hash] = self.cache[rtf_hash]
+            html_by_hash.update(self.load_cached([rtf_hash for rtf_hash in rtf_by_hash if rtf_hash not in html_by_hash]))
+            missing = [rtf_hash for rtf_hash in rtf_by_hash if rtf_hash not in html_by_hash]
+            html_list = self.convert_missing([rtf_by_hash[rtf_hash] for rtf_hash in missing])
+            html_by_hash.update(zip(missing, html_list))
+            self.save_cached(list(zip(missing, html_list)))
+            self.converted_count += len(missing)
+            self.cached_count += len(hashes) - len(missing)
+            self.remember(html_by_hash)
+            return [html_by_hash[rtf_hash] for rtf_hash in hashes]
+
+    def remember(self, html_by_hash):
+        self.cache.update(html_by_hash)
+        while len(self.cache) > self.memory_cache_size:
+            self.cache.popitem(last=False)
+
+    def convert_missing(self, rtf_list):
+        if self.processes <= 1 or len(rtf_list) < 2:
+            return [rtf_to_html(rtf_bytes) for rtf_bytes in rtf_list]
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+        chunksize = max(1, len(rtf_list) // (self.processes * 4))
+        return list(self.executor.map(rtf_to_html, rtf_list, chunksize=chunksize))
+
+    def close(self):
+        logger.info("Converted " + str(self.converted_count) + " RTF remarks, " + str(self.cached_count) + " taken from the cache.")
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.connection:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,83 @@
+import time
+import queue
+import logging
+from contextlib import contextmanager
+
+from transport_helper import get_compressor, transports
+from metrics_helper import metrics
+
+
+logger = logging.getLogger('OdooSession')
+
+
+# Authenticates once and keeps a pool of transport connections (XML-RPC or JSON-RPC, see
+# transport_helper). Every connection keeps its HTTP(S) connection alive between calls, so the
+# TCP and TLS handshakes are paid once per pooled connection instead of once per execute_kw.
+# Connections are not thread safe: a connection is only used by one thread at a time.
+# With compression ("gzip" or "zstd") request bodies are compressed once a compressed version call
+# shows that the server (or a proxy in front of it) accepts that content encoding. Odoo itself does
+# not decode request bodies, so otherwise the session falls back to uncompressed requests.
+class OdooSession:
+    def __init__(self, url, database, username, secret, connections=1, protocol="xmlrpc", compression=None):
+        self.url = url
+        self.database = database
+        self.username = username
+        self.secret = secret
+        self.protocol = protocol
+        self.compression = None
+        self.pool_size = max(connections, 1)
+        self.pool = queue.LifoQueue()
+        for i in range(self.pool_size):
+            self.pool.put(self.new_connection())
+        with self.connection() as connection:
+            self.uid = connection.call("common", "authenticate", database, username, secret, {})
+        logger.info("Authenticated on " + url + " as user " + str(self.uid) + " with " + str(self.pool_size) + " " + protocol + " connection(s).")
+        if compression:
+            self.negotiate_compression(compression)
+
+    def new_connection(self):
+        return transports[self.protocol](self.url, self.compression)
+
+    def negotiate_compression(self, compression):
+        # Raises when the compression is not available, e.g. zstd without the zstandard package
+        get_compressor(compression)
+        probe = transports[self.protocol](self.url, compression)
+        try:
+            probe.call("common", "version")
+        except Exception as e:
+            logger.warning("The server does not accept " + compression + " compressed requests, sending them uncompressed: " + str(e))
+            return
+        finally:
+            probe.close()
+        self.compression = compression
+        for connection in list(self.pool.queue):
+            connection.compression = compression
+        logger.info("Sending " + compression + " compressed requests.")
+
+    @contextmanager
+    def connection(self):
+        connection = self.pool.get()
+        try:
+            yield connection
+        finally:
+            self.pool.put(connection)
+
+    def execute_kw(self, model, method, args, kwargs=None):
+        with self.connection() as connection:
+            start = time.perf_counter()
+            try:
+                with metrics.timer("rpc"):
+                    if kwargs:
+                        return connection.call("object", "execute_kw", self.database, self.uid, self.secret, model, method, args, kwargs)
+                    return connection.call("object", "execute_kw", self.database, self.uid, self.secret, model, method, args)
+            finally:
+                metrics.count("rpc_calls")
+                metrics.count_call(model, method, time.perf_counter() - start)
+
+    # Exact number of bytes the value takes in a request body, including any DocumentFile content
+    def encoded_size(self, value):
+        return transports[self.protocol].encoded_size(value)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import datetime
+from decimal import Decimal
+from pathlib import Path
+
+from themis_helper import check_identifier, default_batch_size, execute_table_select
+
+
+logger = logging.getLogger('SnapshotHelper')
+
+# SQLite column types of the values read from Themis. The first word selects the converter used when
+# the snapshot is read, TEXT makes SQLite keep the exact text, e.g. the scale of a decimal.
+column_types = [
+    (bool, "BOOLEAN"),
+    (int, "INTEGER"),
+    (float, "REAL"),
+    (Decimal, "DECIMAL TEXT"),
+    (datetime.datetime, "TIMESTAMP TEXT"),
+    (datetime.date, "DATE TEXT"),
+    (datetime.time, "TIME TEXT"),
+    (str, "TEXT"),
+    (bytes, "BLOB"),
+]
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+sqlite3.register_adapter(datetime.time, lambda value: value.isoformat())
+sqlite3.register_converter("BOOLEAN", lambda value: value == b"1")
+sqlite3.register_converter("DECIMAL", lambda value: Decimal(value.decode()))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("DATE", lambda value: datetime.date.fromisoformat(value.decode()))
+sqlite3.register_converter("TIME", lambda value: datetime.time.fromisoformat(value.decode()))
+
+
+def get_column_type(type_code, values):
+    for python_type, column_type in column_types:
+        if isinstance(type_code, type) and issubclass(type_code, python_type):
+            return column_type
+    # Firebird reports the Python type of every column, other drivers may not
+    for value in values:
+        if value is not None:
+            return get_column_type(type(value), [])
+    return ""
+
+
+# Blobs that are larger than the stream threshold of the driver are read as a BlobReader
+def read_row(row):
+    return tuple(value.read() if hasattr(value, "read") else value for value in row)
+
+
+# Writes tables to a SQLite snapshot next to snapshot_path, which close() only replaces when the
+# snapshot is complete.
+class SnapshotWriter:
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        self.temporary_path = snapshot_path + ".tmp"
+        if os.path.exists(self.temporary_path):
+            os.remove(self.temporary_path)
+        self.connection = sqlite3.connect(self.temporary_path)
+        self.connection.execute("create table snapshot_table (name text primary key, columns text, row_count integer)")
+
+    # row_batches are lists of rows with a value for every column. The column types are taken from
+    # type_codes, the Python type of every column, or else from the values of the first batch.
+    def write_table(self, table_name, columns, row_batches, type_codes=None):
+        row_count = 0
+        insert_sql = None
+        for rows in row_batches:
+            if insert_sql is None:
+                insert_sql = self.create_table(table_name, columns, type_codes, rows)
+            self.connection.executemany(insert_sql, rows)
+            row_count += len(rows)
+        if insert_sql is None:
+            self.create_table(table_name, columns, type_codes, [])
+        self.connection.execute("insert into snapshot_table (name, columns, row_count) values (?, ?, ?)", [table_name, json.dumps(columns), row_count])
+        return row_count
+
+    def create_table(self, table_name, columns, type_codes, rows):
+        column_definitions = []
+        for index, column in enumerate(columns):
+            column_type = get_column_type(type_codes and type_codes[index], [row[index] for row in rows])
+            column_definitions.append((check_identifier(column) + " " + column_type).strip())
+        self.connection.execute(f"create table {check_identifier(table_name)} ({', '.join(column_definitions)})")
+        return f"insert into {check_identifier(table_name)} values ({','.join('?' * len(columns))})"
+
+    def create_index(self, table_name, column):
+        self.connection.execute(f"create index {check_identifier(table_name + '_' + column)} on {check_identifier(table_name)} ({check_identifier(column)})")
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+        os.replace(self.temporary_path, self.snapshot_path)
+
+    def discard(self):
+        self.connection.close()
+        os.remove(self.temporary_path)
+
+
+def extract_table(cr, writer, table_name, columns):
+    start = time.perf_counter()
+    execute_table_select(cr, table_name, columns)
+    type_codes = [column[1] for column in cr.description]
+    row_batches = ([read_row(row) for row in rows] for rows in iter(lambda: cr.fetchmany(default_batch_size), []))
+    row_count = writer.write_table(table_name, columns, row_batches, type_codes)
+    logger.info("Extracted " + str(row_count) + " rows of " + table_name + " in " + format(time.perf_counter() - start, ".2f") + "s.")
+    return row_count
+
+
+# Writes the columns of the tables (table_columns maps a table name to its columns) to a SQLite
+# snapshot, read on one connection opened with connect(). index_columns maps a table name to a
+# column that is indexed, e.g. the partition column used by themis_helper.iter_partitioned_table_values.
+def write_snapshot(connect, snapshot_path, table_columns, index_columns=None):
+    logger.info("Extracting " + str(len(table_columns)) + " Themis tables to " + snapshot_path + " ...")
+    start = time.perf_counter()
+    writer = SnapshotWriter(snapshot_path)
+    try:
+        con = connect()
+        try:
+            for table_name, columns in table_columns.items():
+                extract_table(con.cursor(), writer, table_name, columns)
+        finally:
+            con.close()
+        for table_name, column in (index_columns or {}).items():
+            if table_name in table_columns and column in table_columns[table_name]:
+                writer.create_index(table_name, column)
+    except BaseException:
+        writer.discard()
+        raise
+    writer.close()
+    logger.info("Extracted the Themis tables in " + format(time.perf_counter() - start, ".2f") + "s.")
+
+
+# A snapshot connection can be used like a Firebird connection by themis_helper, the selects only
+# use SQL that both understand. Stage threads open their own connection, main closes them all.
+def connect_to_snapshot(snapshot_path):
+    uri = Path(snapshot_path).resolve().as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+
+
+# Raises when tables or columns that are read by the migration are not in the snapshot
+def check_snapshot(snapshot_path, table_columns):
+    if not os.path.exists(snapshot_path):
+        raise FileNotFoundError("Snapshot " + snapshot_path + " does not exist")
+    con = connect_to_snapshot(snapshot_path)
+    try:
+        snapshot_columns = dict((name, json.loads(columns)) for name, columns in con.execute("select name, columns from snapshot_table"))
+    finally:
+        con.close()
+    missing = []
+    for table_name, columns in table_columns.items():
+        if table_name not in snapshot_columns:
+            missing.append(table_name)
+        else:
+            missing.extend(table_name + "." + column for column in columns if column not in snapshot_columns[table_name])
+    if missing:
+        raise ValueError("Snapshot " + snapshot_path + " was extracted without " + ", ".join(missing) + ", extract it again")
@@ -0,0 +1,210 @@
+import os
+import time
+import pickle
+import shutil
+import logging
+import tempfile
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from metrics_helper import metrics, get_rss
+
+
+default_parallel_stages = 4
+
+logger = logging.getLogger('StageScheduler')
+
+
+class Stage:
+    def __init__(self, name, function, inputs=(), outputs=()):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+# Runs stages as a DAG: a stage is started as soon as all of its inputs, the named values
+# returned by other stages, are available, with at most parallel_stages stages at a time.
+# Ready stages are started in the order they were added, so parallel_stages=1 runs them one by
+# one in that order. A stage function is called with its inputs as keyword arguments and
+# returns its outputs, a tuple when it has more than one.
+# A value is released as soon as no waiting stage needs it. When the resident memory of the process
+# is over memory_budget (bytes) after a stage, the values that only waiting stages need are spilled
+# to a temporary folder in spill_path and read back when the first of them starts.
+class StageScheduler:
+    def __init__(self, parallel_stages=default_parallel_stages, memory_budget=None, spill_path=None):
+        self.parallel_stages = max(parallel_stages, 1)
+        self.memory_budget = memory_budget
+        self.spill_path = spill_path
+        self.spill_folder = None
+        self.stages = []
+        self.producers = {}
+        self.values = {}
+        # Name: file of the values that are spilled
+        self.spilled = {}
+        self.spill_numbers = count()
+
+    def add(self, name, function, inputs=(), outputs=()):
+        stage = Stage(name, function, inputs, outputs)
+        for output in stage.outputs:
+            if output in self.producers:
+                raise ValueError("Value " + output + " of stage " + name + " is already returned by stage " + self.producers[output].name)
+            self.producers[output] = stage
+        self.stages.append(stage)
+        return stage
+
+    # Only keeps the named stages and the stages they depend on
+    def select(self, names):
+        selected = set()
+        pending = [stage for stage in self.stages if stage.name in names]
+        while pending:
+            stage = pending.pop()
+            if stage.name not in selected:
+                selected.add(stage.name)
+                pending.extend(self.producers[name] for name in stage.inputs if name in self.producers)
+        self.stages = [stage for stage in self.stages if stage.name in selected]
+
+    def check(self):
+        for stage in self.stages:
+            for name in stage.inputs:
+                if name not in self.producers:
+                    raise ValueError("Input " + name + " of stage " + stage.name + " is not returned by any stage")
+        # Depth first search for cycles
+        state = {}
+
+        def visit(stage, path):
+            if state.get(stage.name) == "done":
+                return
+            if state.get(stage.name) == "visiting":
+                raise ValueError("Stages depend on each other: " + " -> ".join(path + [stage.name]))
+            state[stage.name] = "visiting"
+            for name in stage.inputs:
+                visit(self.producers[name], path + [stage.name])
+            state[stage.name] = "done"
+
+        for stage in self.stages:
+            visit(stage, [])
+
+    def run_stage(self, stage, inputs):
+        stage.start = time.perf_counter()
+        try:
+            with metrics.stage(stage.name):
+                return stage.function(**inputs)
+        finally:
+            stage.end = time.perf_counter()
+            logger.info("Stage " + stage.name + " finished in " + format(stage.duration, ".2f") + "s.")
+
+    def store_outputs(self, stage, result):
+        if len(stage.outputs) == 1:
+            self.values[stage.outputs[0]] = result
+        elif stage.outputs:
+            self.values.update(zip(stage.outputs, result))
+
+    def release_values(self, waiting):
+        needed = set(name for stage in waiting for name in stage.inputs)
+        for name in [name for name in self.values if name not in needed]:
+            logger.debug("Released value " + name + ".")
+            del self.values[name]
+
+    def spill_values(self, running):
+        rss = get_rss()
+        if not self.memory_budget or rss is None or rss <= self.memory_budget:
+            return
+        used = set(name for stage in running for name in stage.inputs)
+        names = [name for name in self.values if name not in used]
+        if not names:
+            return
+        if self.spill_folder is None:
+            self.spill_folder = tempfile.mkdtemp(prefix="themis-spill-", dir=self.spill_path)
+        start = time.perf_counter()
+        for name in names:
+            path = os.path.join(self.spill_folder, str(next(self.spill_numbers)) + ".pickle")
+            with open(path, "wb") as spill_file:
+                pickle.dump(self.values.pop(name), spill_file, pickle.HIGHEST_PROTOCOL)
+            self.spilled[name] = path
+        logger.info("Memory " + format(rss / 1000000, ".0f") + " MB is over the budget of " + format(self.memory_budget / 1000000, ".0f")
+                    + " MB, spilled " + ", ".join(names) + " to " + self.spill_folder + " in " + format(time.perf_counter() - start, ".2f") + "s.")
+
+    def load_value(self, name):
+        if name in self.spilled:
+            path = self.spilled.pop(name)
+            with open(path, "rb") as spill_file:
+                self.values[name] = pickle.load(spill_file)
+            os.remove(path)
+            logger.info("Read spilled value " + name + " back.")
+        return self.values[name]
+
+    def run(self):
+        self.check()
+        self.start = time.perf_counter()
+        try:
+            self.run_stages()
+        finally:
+            if self.spill_folder is not None:
+                shutil.rmtree(self.spill_folder)
+                self.spill_folder = None
+                self.spilled = {}
+        self.end = time.perf_counter()
+        self.log_report()
+        return self.values
+
+    def run_stages(self):
+        waiting = list(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.parallel_stages) as executor:
+            while waiting or running:
+                for stage in list(waiting):
+                    if len(running) >= self.parallel_stages:
+                        break
+                    if all(name in self.values or name in self.spilled for name in stage.inputs):
+                        waiting.remove(stage)
+                        running[executor.submit(self.run_stage, stage, dict((name, self.load_value(name)) for name in stage.inputs))] = stage
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        self.store_outputs(stage, future.result())
+                    except Exception:
+                        logger.error("Stage " + stage.name + " failed, waiting for the running stages: " + ", ".join(running[future].name for future in running))
+                        wait(running)
+                        raise
+                # The futures keep the results of their stages
+                done = future = None
+                self.release_values(waiting)
+                self.spill_values(running.values())
+
+    # The chain of inputs that determined the total run time: starting from the stage that finished
+    # last, every stage is preceded by the producer of the input that was ready last. Time a stage
+    # waited for a place among the parallel_stages is not on the path.
+    def critical_path(self):
+        finished = [stage for stage in self.stages if stage.end is not None]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda stage: stage.end)
+        path = [stage]
+        while True:
+            producers = [self.producers[name] for name in stage.inputs if self.producers[name].end is not None]
+            if not producers:
+                return path
+            stage = max(producers, key=lambda stage: stage.end)
+            path.insert(0, stage)
+
+    def log_report(self):
+        logger.info("Stage timings (start, duration, end in seconds since the start of the run):")
+        for stage in sorted(self.stages, key=lambda stage: stage.start):
+            logger.info("  " + stage.name.ljust(24) + format(stage.start - self.start, "9.2f") + format(stage.duration, "9.2f")
+                        + format(stage.end - self.start, "9.2f"))
+        path = self.critical_path()
+        logger.info("Critical path: " + " -> ".join(stage.name + " (" + format(stage.duration, ".2f") + "s)" for stage in path))
+        if not path:
+            return
+        waited = path[-1].end - self.start - sum(stage.duration for stage in path)
+        logger.info("Critical path " + format(sum(stage.duration for stage in path), ".2f") + "s of "
+                    + format(self.end - self.start, ".2f") + "s total run time with " + str(self.parallel_stages) + " parallel stages, its stages waited "
+                    + format(waited, ".2f") + "s for a place.")
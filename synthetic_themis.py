@@ -0,0 +1,351 @@
+import os
+import random
+import argparse
+import datetime
+
+from batch_helper import split_every
+from fake_odoo import failure_marker
+from snapshot_helper import SnapshotWriter, connect_to_snapshot
+from main import get_snapshot_columns, partition_columns
+
+
+# Rows per table at scale 1, about a law firm with 40 users and 15 years of cases. The lookup
+# tables keep their size at every scale.
+table_sizes = {
+    "GEBRUIKER": 40,
+    "ADRESCATEGORIE": 12,
+    "DOSSIERCATEGORIE": 25,
+    "OPMERKINGTYPE": 6,
+    "TIJDTYPE": 30,
+    "KOSTTYPE": 20,
+    "DOSSIERDOCUMENTMAP": 15,
+    "BEDRIJF": 12000,
+    "ADRESBOEK": 30000,
+    "DOSSIER": 15000,
+    "DOSSIEROPMERKING": 20000,
+    "DOSSIERADRESBOEK": 45000,
+    "DOSSIERTIJDTARIEF": 1500,
+    "DOSSIERTIJD": 500000,
+    "DOSSIERKOSTTARIEF": 800,
+    "DOSSIERKOST": 120000,
+    "DOSSIERDOCUMENT": 40000,
+}
+lookup_tables = ["GEBRUIKER", "ADRESCATEGORIE", "DOSSIERCATEGORIE", "OPMERKINGTYPE", "TIJDTYPE", "KOSTTYPE", "DOSSIERDOCUMENTMAP"]
+
+# Types of the columns that are not text, like the Firebird driver reports them
+column_types = {
+    "ID": int, "BEDRIJF_ID": int, "ADRESBOEK_ID": int, "DOSSIER_ID": int, "ADRESCATEGORIE_ID": int, "CREATEDBY_ID": int,
+    "KANTOORBEHEERDER_ID": int, "FACTURATIEADRESBOEK_ID": int, "FACTURATIEBEDRIJF_ID": int, "DOSSIERCATEGORIE_ID": int,
+    "REGISTREERDER_ID": int, "OPMERKINGTYPE_ID": int, "DOSSIERADRESCATEGORIE_ID": int, "TIJDTYPE_ID": int, "GEBRUIKER_ID": int,
+    "KOSTTYPE_ID": int, "LINKEDTO_ID": int, "DOCUMENTMAP_ID": int, "AANMAKER_ID": int, "MINUTEN": int,
+    "UURTARIEF": float, "EENHEIDSBEDRAG": float, "AANTAL": float, "BEDRAG": float, "KOSTEENHEIDSBEDRAG": float,
+    "CREATED": datetime.datetime, "MODIFIED": datetime.datetime, "OPENINGSDATUM": datetime.datetime,
+    "AANMAAKDATUM": datetime.datetime, "AANPASDATUM": datetime.datetime,
+    "GEBOORTEDATUM": datetime.date, "DATUM": datetime.date,
+}
+blob_columns = {"DOSSIEROPMERKING": ["OPMERKING"]}
+
+first_names = ["Jan", "Marie", "Pieter", "Sofie", "Luc", "An", "Koen", "Els", "Tom", "Lieve", "Jean", "Isabelle", "Marc", "Nathalie", "Dirk", "Fatima", "Mohamed", "Julie"]
+last_names = ["Peeters", "Janssens", "Maes", "Jacobs", "Mertens", "Willems", "Claes", "Goossens", "Wouters", "De Smet", "Dubois", "Lambert", "Dupont", "Van den Broeck"]
+streets = ["Kerkstraat", "Stationsstraat", "Dorpsstraat", "Rue de la Gare", "Nieuwstraat", "Molenstraat", "Avenue Louise", "Grote Markt", "Schoolstraat"]
+cities = [("1000", "Brussel"), ("2000", "Antwerpen"), ("9000", "Gent"), ("3000", "Leuven"), ("8000", "Brugge"), ("4000", "Liège"), ("3500", "Hasselt"), ("2800", "Mechelen")]
+company_forms = ["NV", "BV", "VZW", "CV", "SA", "SRL", None]
+remark_templates = [
+    "Dossier geopend na eerste consultatie.",
+    "Klant wenst enkel schriftelijke communicatie.",
+    "Provisie gevraagd, nog niet ontvangen.",
+    "Zie ook het dossier van de tegenpartij.",
+]
+start_date = datetime.datetime(2009, 1, 1)
+
+
+class SyntheticThemis:
+    def __init__(self, scale=1.0, seed=1, failure_fraction=0.0):
+        self.random = random.Random(seed)
+        self.failure_fraction = failure_fraction
+        self.sizes = dict((table_name, size if table_name in lookup_tables else max(1, int(size * scale))) for table_name, size in table_sizes.items())
+
+    def choice(self, values):
+        return self.random.choice(values)
+
+    def maybe(self, value, fraction=0.5):
+        return value if self.random.random() < fraction else None
+
+    def ref(self, table_name, fraction=1.0):
+        return self.maybe(self.random.randint(1, self.sizes[table_name]), fraction)
+
+    def timestamp(self, days=5500):
+        return start_date + datetime.timedelta(days=self.random.randint(0, days), seconds=self.random.randint(28800, 64800))
+
+    # Names of the rows that the fake Odoo server will refuse, see fake_odoo.failure_marker
+    def name(self, name):
+        if self.failure_fraction and self.random.random() < self.failure_fraction:
+            return name + " " + failure_marker
+        return name
+
+    def person(self):
+        return self.choice(first_names), self.choice(last_names)
+
+    def address(self):
+        zip_code, city = self.choice(cities)
+        return {
+            "ADRES": self.choice(streets) + " " + str(self.random.randint(1, 250)),
+            "POSTCODE": zip_code,
+            "GEMEENTE": city,
+            "LANDCODE": self.choice(["BE"] * 8 + ["NL", "FR", None]),
+            "TELEFOON": self.maybe("0" + str(self.random.randint(10000000, 99999999)), 0.7),
+            "TELEFOON2": self.maybe("0" + str(self.random.randint(10000000, 99999999)), 0.1),
+            "MOBIEL": self.maybe("04" + str(self.random.randint(70000000, 99999999)), 0.5),
+            "TAALCODE": self.choice(["N"] * 6 + ["F"] * 3 + ["E", "D", None]),
+            "BANKREKENING": self.maybe("BE" + str(self.random.randint(10, 99)) + " " + " ".join(str(self.random.randint(1000, 9999)) for i in range(3)), 0.4),
+            "OPMERKING": self.maybe("Opmerking\nover de relatie", 0.2),
+        }
+
+    def users(self):
+        for user_id in range(1, self.sizes["GEBRUIKER"] + 1):
+            first_name, last_name = self.person()
+            yield {
+                "ID": user_id,
+                "NAAM": first_name + " " + last_name,
+                "TEL_MOBIEL": self.maybe("0475" + str(user_id).zfill(6)),
+                "EMAILADRES": self.maybe(first_name.lower() + "@kantoor.be", 0.9),
+                "UURTARIEF": self.maybe(float(self.choice([95, 120, 150, 175, 200])), 0.6),
+                "ACTIEF": "T" if self.random.random() < 0.8 else "F",
+            }
+
+    def named_rows(self, table_name, name_column, name):
+        for row_id in range(1, self.sizes[table_name] + 1):
+            yield {"ID": row_id, name_column: name + " " + str(row_id)}
+
+    def companies(self):
+        for company_id in range(1, self.sizes["BEDRIJF"] + 1):
+            created = self.timestamp()
+            vals = self.address()
+            vals.update({
+                "ID": company_id,
+                "NAAM": self.name(self.choice(last_names) + " " + self.choice(["Bouw", "Consult", "Invest", "Immo", "Transport"])),
+                "ONDERNEMINGSNUMMER": self.maybe("0" + str(self.random.randint(200000000, 999999999)), 0.8),
+                "BTWNUMMER": self.maybe(str(self.random.randint(200000000, 999999999)).zfill(10), 0.6),
+                "EMAIL": self.maybe("info@bedrijf" + str(company_id) + ".be", 0.7),
+                "EMAIL2": self.maybe("boekhouding@bedrijf" + str(company_id) + ".be", 0.1),
+                "EMAIL3": None,
+                "URL": self.maybe("www.bedrijf" + str(company_id) + ".be", 0.3),
+                "VENNOOTSCHAPSNAAM": self.choice(company_forms),
+                "ADRESCATEGORIE_ID": self.ref("ADRESCATEGORIE", 0.7),
+                "CREATED": created,
+                "CREATEDBY_ID": self.ref("GEBRUIKER"),
+                "MODIFIED": created + datetime.timedelta(days=self.random.randint(0, 900)),
+            })
+            yield vals
+
+    def contacts(self):
+        for contact_id in range(1, self.sizes["ADRESBOEK"] + 1):
+            first_name, last_name = self.person()
+            created = self.timestamp()
+            vals = self.address()
+            # Typing errors in Themis left some dates of birth before the year 1000
+            birth_year = self.choice([self.random.randint(1930, 2005)] * 50 + [self.random.randint(100, 999)])
+            vals.update({
+                "ID": contact_id,
+                "BEDRIJF_ID": self.ref("BEDRIJF", 0.3),
+                "NAAMVOORNAAM": self.name(last_name + " " + first_name),
+                "MANUALZIP": None,
+                "EMAIL": self.maybe(first_name.lower() + "." + last_name.lower().replace(" ", "") + "@mail.be", 0.6),
+                "EMAIL2": self.maybe(first_name.lower() + "@werk.be", 0.1),
+                "EMAIL3": None,
+                "BEROEP": self.maybe(self.choice(["Bediende", "Arbeider", "Zelfstandige", "Gepensioneerd"]), 0.3),
+                "NAAM": last_name,
+                "VOORNAAM": first_name,
+                "AANSPREKING_TITEL": self.choice(["Dhr.", "Mevr.", None]),
+                "AANSPREKING_GEACHTE": self.maybe("Geachte", 0.5),
+                "GESLACHT": self.choice(["M", "V", None]),
+                "GEBOORTEDATUM": self.maybe(datetime.date(birth_year, self.random.randint(1, 12), self.random.randint(1, 28)), 0.4),
+                "GEBOORTEPLAATS": self.maybe(self.choice(cities)[1], 0.3),
+                "NATIONALITEIT": self.maybe("Belg", 0.3),
+                "INSZ": self.maybe(str(self.random.randint(10000000000, 99999999999)), 0.3),
+                "URL": None,
+                "ADRESCATEGORIE_ID": self.ref("ADRESCATEGORIE", 0.7),
+                "CREATED": created,
+                "CREATEDBY_ID": self.ref("GEBRUIKER"),
+                "MODIFIED": created + datetime.timedelta(days=self.random.randint(0, 900)),
+            })
+            yield vals
+
+    def cases(self):
+        for case_id in range(1, self.sizes["DOSSIER"] + 1):
+            opened = self.timestamp()
+            yield {
+                "ID": case_id,
+                "OMSCHRIJVING": self.name(self.choice(last_names) + " / " + self.choice(last_names)),
+                "NUMMER": str(opened.year) + "/" + str(case_id).zfill(5),
+                "KANTOORBEHEERDER_ID": self.ref("GEBRUIKER"),
+                "FACTURATIEADRESBOEK_ID": self.ref("ADRESBOEK", 0.6),
+                "FACTURATIEBEDRIJF_ID": self.ref("BEDRIJF", 0.3),
+                "DOSSIERCATEGORIE_ID": self.ref("DOSSIERCATEGORIE", 0.9),
+                "GEARCHIVEERD": "T" if opened.year < 2020 and self.random.random() < 0.7 else "F",
+                "REGISTREERDER_ID": self.ref("GEBRUIKER"),
+                "OPENINGSDATUM": opened,
+                "MODIFIED": opened + datetime.timedelta(days=self.random.randint(0, 1500)),
+                "UURTARIEF": self.maybe(float(self.choice([110, 135, 160, 185])), 0.15),
+            }
+
+    def case_descriptions(self):
+        for index in range(self.sizes["DOSSIEROPMERKING"]):
+            # Most remarks are one of a few templates, see rtf_helper.RtfConverter
+            if self.random.random() < 0.6:
+                text = self.choice(remark_templates)
+            else:
+                text = "Gesprek met " + " ".join(self.person()) + " op " + self.timestamp().strftime("%d/%m/%Y") + ".\\par " + "Verdere opvolging nodig. " * self.random.randint(1, 40)
+            rtf = "{\\rtf1\\ansi\\ansicpg1252\\deff0{\\fonttbl{\\f0 Arial;}}\\f0\\fs20 " + text + "\\par}"
+            yield {
+                "DOSSIER_ID": self.ref("DOSSIER"),
+                "OPMERKINGTYPE_ID": self.ref("OPMERKINGTYPE"),
+                "OPMERKING": rtf.encode("cp1252"),
+            }
+
+    def parties(self):
+        for index in range(self.sizes["DOSSIERADRESBOEK"]):
+            contact_id = self.ref("ADRESBOEK", 0.7)
+            yield {
+                "DOSSIER_ID": self.ref("DOSSIER"),
+                "ADRESBOEK_ID": contact_id,
+                "DOSSIERADRESCATEGORIE_ID": self.ref("ADRESCATEGORIE", 0.5),
+                "BEDRIJF_ID": None if contact_id else self.ref("BEDRIJF"),
+            }
+
+    def typed_rows(self, table_name, name_column, price_column, prices):
+        for row_id in range(1, self.sizes[table_name] + 1):
+            yield {"ID": row_id, name_column: table_name.lower() + " " + str(row_id), price_column: self.maybe(float(self.choice(prices)), 0.8)}
+
+    def case_tariffs(self, table_name, column, reference_table, price_column, prices):
+        for index in range(self.sizes[table_name]):
+            yield {"DOSSIER_ID": self.ref("DOSSIER"), column: self.ref(reference_table), price_column: self.maybe(float(self.choice(prices)), 0.9)}
+
+    def timesheets(self):
+        for timesheet_id in range(1, self.sizes["DOSSIERTIJD"] + 1):
+            date = self.timestamp().date()
+            yield {
+                "ID": timesheet_id,
+                "OMSCHRIJVING": self.name(self.choice(["Bespreking", "Opstellen conclusie", "Zitting", "Telefoon", "Mail", "Studie dossier"])),
+                "TIJDTYPE_ID": self.ref("TIJDTYPE", 0.95),
+                "DOSSIER_ID": self.ref("DOSSIER"),
+                "REGISTREERDER_ID": self.ref("GEBRUIKER"),
+                "MINUTEN": self.maybe(self.choice([6, 12, 15, 30, 45, 60, 90, 120, 240]), 0.97),
+                "UURTARIEF": self.maybe(float(self.choice([0, 95, 120, 150])), 0.2),
+                "DATUM": date,
+                "AANREKENEN": "T" if self.random.random() < 0.85 else "F",
+                "GEFACTUREERD": "T" if date.year < 2022 and self.random.random() < 0.9 else self.maybe("F", 0.9),
+            }
+
+    def costs(self):
+        for cost_id in range(1, self.sizes["DOSSIERKOST"] + 1):
+            amount = self.choice([None, 0.0, 1.0, 1.0, 1.0, 2.0, 3.0, 10.0, 25.0])
+            yield {
+                "ID": cost_id,
+                "OMSCHRIJVING": self.name(self.choice(["Dactylo", "Kopies", "Verplaatsing", "Griffierechten", "Aangetekende zending"])),
+                "KOSTTYPE_ID": self.ref("KOSTTYPE", 0.95),
+                "DOSSIER_ID": self.ref("DOSSIER"),
+                "AANTAL": amount,
+                "BEDRAG": self.maybe(float(self.random.randint(1, 500)), 0.3),
+                "KOSTEENHEIDSBEDRAG": self.maybe(float(self.choice([0.25, 0.5, 8.5, 12.0])), 0.4),
+                "AANREKENEN": "T" if self.random.random() < 0.9 else "F",
+                "GEFACTUREERD": "T" if self.random.random() < 0.7 else self.maybe("F", 0.9),
+            }
+
+    def documents(self):
+        for document_id in range(1, self.sizes["DOSSIERDOCUMENT"] + 1):
+            created = self.timestamp()
+            yield {
+                "ID": document_id,
+                "LINKEDTO_ID": self.ref("DOSSIER", 0.98),
+                "OMSCHRIJVING": self.name(self.choice(["Brief aan klant", "Conclusie", "Vonnis", "Dagvaarding", "Factuur", "Mail"])),
+                "BESTAND": "document" + str(document_id) + self.choice([".pdf", ".pdf", ".docx", ".msg", ".jpg"]),
+                "DOCUMENTMAP_ID": self.ref("DOSSIERDOCUMENTMAP", 0.8),
+                "AANMAKER_ID": self.ref("GEBRUIKER"),
+                "AANMAAKDATUM": created,
+                "AANPASDATUM": created + datetime.timedelta(days=self.random.randint(0, 30)),
+            }
+
+    def table_rows(self):
+        yield "GEBRUIKER", self.users()
+        yield "ADRESCATEGORIE", self.named_rows("ADRESCATEGORIE", "OMSCHRIJVING", "Adrescategorie")
+        yield "BEDRIJF", self.companies()
+        yield "ADRESBOEK", self.contacts()
+        yield "DOSSIERCATEGORIE", self.named_rows("DOSSIERCATEGORIE", "NEDERLANDS", "Dossiercategorie")
+        yield "DOSSIER", self.cases()
+        yield "OPMERKINGTYPE", self.named_rows("OPMERKINGTYPE", "N", "Opmerkingtype")
+        yield "DOSSIEROPMERKING", self.case_descriptions()
+        yield "DOSSIERADRESBOEK", self.parties()
+        yield "TIJDTYPE", self.typed_rows("TIJDTYPE", "OMSCHRIJVING", "UURTARIEF", [0, 85, 120, 150])
+        yield "DOSSIERTIJDTARIEF", self.case_tariffs("DOSSIERTIJDTARIEF", "GEBRUIKER_ID", "GEBRUIKER", "UURTARIEF", [0, 100, 125, 175])
+        yield "DOSSIERTIJD", self.timesheets()
+        yield "KOSTTYPE", self.typed_rows("KOSTTYPE", "N", "EENHEIDSBEDRAG", [0.25, 0.5, 8.5, 12.0, 50.0])
+        yield "DOSSIERKOSTTARIEF", self.case_tariffs("DOSSIERKOSTTARIEF", "KOSTTYPE_ID", "KOSTTYPE", "EENHEIDSBEDRAG", [0.2, 0.4, 10.0])
+        yield "DOSSIERKOST", self.costs()
+        yield "DOSSIERDOCUMENTMAP", self.named_rows("DOSSIERDOCUMENTMAP", "OMSCHRIJVING", "Map")
+        yield "DOSSIERDOCUMENT", self.documents()
+
+    # Document sizes vary from a few kB to several MB around median_size, some documents are
+    # copies of the same letter template (duplicate_fraction of them, out of 20 templates) and some
+    # files are missing, like in a real document folder.
+    def write_document_files(self, snapshot_path, document_path, median_size, duplicate_fraction=0.1):
+        templates = [os.urandom(int(median_size * self.random.uniform(0.5, 2))) for i in range(20)]
+        con = connect_to_snapshot(snapshot_path)
+        file_count = 0
+        byte_count = 0
+        try:
+            for case_id, filename in con.execute("select LINKEDTO_ID, BESTAND from DOSSIERDOCUMENT where LINKEDTO_ID is not null"):
+                if self.random.random() < 0.03:
+                    continue
+                if self.random.random() < duplicate_fraction:
+                    content = self.choice(templates)
+                else:
+                    content = os.urandom(min(int(self.random.lognormvariate(0, 1) * median_size), 50000000))
+                case_path = os.path.join(document_path, str(case_id))
+                os.makedirs(case_path, exist_ok=True)
+                with open(os.path.join(case_path, filename), "wb") as document:
+                    document.write(content)
+                file_count += 1
+                byte_count += len(content)
+        finally:
+            con.close()
+        return file_count, byte_count
+
+
+def write_synthetic_snapshot(snapshot_path, scale=1.0, seed=1, failure_fraction=0.0):
+    synthetic = SyntheticThemis(scale, seed, failure_fraction)
+    table_columns = get_snapshot_columns()
+    writer = SnapshotWriter(snapshot_path)
+    try:
+        for table_name, rows in synthetic.table_rows():
+            columns = table_columns[table_name]
+            type_codes = [bytes if column in blob_columns.get(table_name, []) else column_types.get(column, str) for column in columns]
+            row_batches = ([tuple(vals.get(column) for column in columns) for vals in batch] for batch in split_every(rows))
+            print("{:<20} {:>9} rows".format(table_name, writer.write_table(table_name, columns, row_batches, type_codes)))
+        for table_name, column in partition_columns.items():
+            writer.create_index(table_name, column)
+    except BaseException:
+        writer.discard()
+        raise
+    writer.close()
+    return synthetic
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Write a synthetic Themis snapshot and document folder for migration benchmarks")
+    parser.add_argument("-ss", dest="snapshot", required=True, help="Path of the snapshot to write, see main.py --from-snapshot")
+    parser.add_argument("-tdf", dest="documentpath", help="Documents folder to write the document files to, no files are written if not given")
+    parser.add_argument("-sc", dest="scale", type=float, default=1.0, help="Scale of the table sizes, 1 is a law firm with 500000 timesheets")
+    parser.add_argument("-dkb", dest="documentkb", type=int, default=16, help="Median size of a document file in kB")
+    parser.add_argument("-df", dest="duplicatefraction", type=float, default=0.1, help="Fraction of the document files that have the same content as other files")
+    parser.add_argument("-fm", dest="failurefraction", type=float, default=0.0, help="Fraction of the rows that the fake Odoo server refuses")
+    parser.add_argument("-seed", dest="seed", type=int, default=1, help="Seed of the generated data")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    synthetic = write_synthetic_snapshot(args.snapshot, args.scale, args.seed, args.failurefraction)
+    if args.documentpath:
+        file_count, byte_count = synthetic.write_document_files(args.snapshot, args.documentpath, args.documentkb * 1000, args.duplicatefraction)
+        print("Wrote " + str(file_count) + " document files, " + format(byte_count / 1000000, ".1f") + " MB to " + args.documentpath)
@@ -0,0 +1,158 @@
+import random
+from datetime import date
+from decimal import Decimal
+
+from record_helper import Record, Schema, omitted
+from odoo_helper import correct_year_format, cost_schema, odoo_date_format, preprocess_cost_values, preprocess_timesheet_values, timesheet_schema
+
+
+# Equivalence of the batch preprocessors of timesheets and costs with the row by row cascade they
+# replaced, kept below as the reference, on random batches. Themis leaves prices empty with NULL
+# or '', and 0 is a price, so the prices are drawn from all of them and the mappings miss keys.
+
+timesheet_fields = ["id", "name", "type_id", "case_id", "user_id", "minutes", "price_unit", "date", "billable", "billed"]
+cost_fields = ["id", "name", "type_id", "case_id", "amount", "price", "price_unit", "billable", "billed"]
+
+prices = [None, "", 0, 0.0, Decimal("0"), Decimal("0.00"), 7, 12.5, Decimal("45.75")]
+amounts = [None, 0, 1, 3, 8]
+flags = [None, "T", "F"]
+dates = [None, date(2021, 3, 4), date(1999, 12, 31), date(21, 1, 2)]
+
+
+def reference_preprocess_timesheet_values(timesheet_vals, user_id_mapping, user_tariff_mapping, case_id_mapping, case_tariff_mapping, timesheet_type_id_mapping, timesheet_type_price_mapping, case_timesheet_mapping):
+    for record in timesheet_vals:
+        vals = dict(zip(record.schema.fields, record.values))
+        themis_type_id = vals["type_id"]
+        themis_case_id = vals["case_id"]
+        themis_user_id = vals["user_id"]
+        price_unit = vals["price_unit"]
+        if not price_unit and price_unit != 0:
+            case_user_tariff = case_timesheet_mapping.get((themis_case_id, themis_user_id), None)
+            if not case_user_tariff and case_user_tariff != 0:
+                user_tariff = user_tariff_mapping.get(themis_user_id, None)
+                if not user_tariff and user_tariff != 0:
+                    case_tariff = case_tariff_mapping.get(themis_case_id, None)
+                    if not case_tariff and case_tariff != 0:
+                        price_unit = timesheet_type_price_mapping.get(themis_type_id, None) or 0
+                    else:
+                        price_unit = case_tariff
+                else:
+                    price_unit = user_tariff
+            else:
+                price_unit = case_user_tariff
+        record.schema = timesheet_schema
+        record.values = (
+            vals["name"],
+            timesheet_type_id_mapping.get(themis_type_id, False),
+            case_id_mapping.get(themis_case_id, False),
+            user_id_mapping.get(themis_user_id, False),
+            price_unit,
+            vals["date"] and correct_year_format(vals["date"].strftime(odoo_date_format)),
+            vals["billable"] == "T",
+            vals["billed"] == "T",
+            (vals["minutes"] or 0) / 60,
+        )
+
+
+def reference_preprocess_cost_values(cost_vals, case_id_mapping, cost_type_id_mapping, cost_type_price_mapping, case_cost_mapping):
+    for record in cost_vals:
+        vals = dict(zip(record.schema.fields, record.values))
+        themis_type_id = vals["type_id"]
+        themis_case_id = vals["case_id"]
+        amount = vals["amount"]
+        price = vals["price"]
+        price_unit = vals["price_unit"]
+        if amount:
+            if not price and price != 0:
+                if not price_unit and price_unit != 0:
+                    case_cost = case_cost_mapping.get((themis_case_id, themis_type_id), None)
+                    if not case_cost and case_cost != 0:
+                        price_unit = cost_type_price_mapping.get(themis_type_id, None) or 0
+                    else:
+                        price_unit = case_cost
+            else:
+                price_unit = price / amount
+            price = omitted
+        record.schema = cost_schema
+        record.values = (
+            vals["name"],
+            cost_type_id_mapping.get(themis_type_id, False),
+            case_id_mapping.get(themis_case_id, False),
+            amount,
+            price,
+            price_unit,
+            vals["billable"] == "T",
+            vals["billed"] == "T",
+        )
+
+
+# Maps some of the ids, to Odoo ids or to one of the prices
+def random_mapping(rng, keys, values):
+    return dict((key, rng.choice(values)) for key in keys if rng.random() < 0.6)
+
+
+def random_mappings(rng):
+    ids = [None] + list(range(1, 6))
+    return {
+        "user_id_mapping": random_mapping(rng, ids, range(100, 200)),
+        "user_tariff_mapping": random_mapping(rng, ids, prices),
+        "case_id_mapping": random_mapping(rng, ids, range(200, 300)),
+        "case_tariff_mapping": random_mapping(rng, ids, prices),
+        "type_id_mapping": random_mapping(rng, ids, range(300, 400)),
+        "type_price_mapping": random_mapping(rng, ids, prices),
+        "case_user_mapping": random_mapping(rng, [(case_id, user_id) for case_id in ids for user_id in ids], prices),
+        "case_type_mapping": random_mapping(rng, [(case_id, type_id) for case_id in ids for type_id in ids], prices),
+    }
+
+
+def random_timesheets(rng, count):
+    schema = Schema(timesheet_fields)
+    return [(index, "timesheet " + str(index), rng.choice([None, 1, 2, 3, 4]), rng.choice([None, 1, 2, 3, 5]), rng.choice([None, 1, 2, 4, 5]),
+             rng.choice([None, 0, 15, 90]), rng.choice(prices), rng.choice(dates), rng.choice(flags), rng.choice(flags))
+            for index in range(count)], schema
+
+
+def random_costs(rng, count):
+    schema = Schema(cost_fields)
+    return [(index, "cost " + str(index), rng.choice([None, 1, 2, 3, 4]), rng.choice([None, 1, 2, 3, 5]), rng.choice(amounts),
+             rng.choice(prices), rng.choice(prices), rng.choice(flags), rng.choice(flags))
+            for index in range(count)], schema
+
+
+# Values and their types, so 0, 0.0 and Decimal("0") are told apart
+def typed_values(records):
+    return [[(value, type(value)) for value in record.values] for record in records]
+
+
+def test_timesheet_prices_match_reference():
+    rng = random.Random(14)
+    for batch_number in range(300):
+        mappings = random_mappings(rng)
+        rows, schema = random_timesheets(rng, rng.randint(1, 60))
+        batch = [Record(schema, row) for row in rows]
+        reference = [Record(schema, row) for row in rows]
+        arguments = [mappings["user_id_mapping"], mappings["user_tariff_mapping"], mappings["case_id_mapping"], mappings["case_tariff_mapping"],
+                     mappings["type_id_mapping"], mappings["type_price_mapping"], mappings["case_user_mapping"]]
+        preprocess_timesheet_values(batch, *arguments)
+        reference_preprocess_timesheet_values(reference, *arguments)
+        assert [record.schema for record in batch] == [timesheet_schema] * len(batch)
+        assert typed_values(batch) == typed_values(reference), "batch " + str(batch_number)
+
+
+def test_cost_prices_match_reference():
+    rng = random.Random(15)
+    for batch_number in range(300):
+        mappings = random_mappings(rng)
+        rows, schema = random_costs(rng, rng.randint(1, 60))
+        batch = [Record(schema, row) for row in rows]
+        reference = [Record(schema, row) for row in rows]
+        arguments = [mappings["case_id_mapping"], mappings["type_id_mapping"], mappings["type_price_mapping"], mappings["case_type_mapping"]]
+        preprocess_cost_values(batch, *arguments)
+        reference_preprocess_cost_values(reference, *arguments)
+        assert [record.schema for record in batch] == [cost_schema] * len(batch)
+        assert typed_values(batch) == typed_values(reference), "batch " + str(batch_number)
+
+
+def test_empty_batches():
+    preprocess_timesheet_values([], {}, {}, {}, {}, {}, {}, {})
+    preprocess_cost_values([], {}, {}, {}, {})
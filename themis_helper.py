@@ -1,8 +1,26 @@
 # import firebirdsql
-from firebird.driver import connect
+import re
+import queue
+import threading
 
+from metrics_helper import metrics, in_current_context
+from record_helper import Record, Schema
 
+
+default_batch_size = 1000
+default_partitions = 4
+default_prefetch_batches = 16
+
+identifier_pattern = re.compile(r"^[A-Za-z][A-Za-z0-9_$]*$")
+filter_operators = ["=", "!=", "<", "<=", ">", ">=", "in", "not in"]
+# Firebird takes at most 1500 values in one in list, longer lists are split
+max_in_values = 1500
+
+
+# The driver is only imported when the Themis database is read, a snapshot (see snapshot_helper)
+# is read without it.
 def connect_to_db(database):
+    from firebird.driver import connect
     conn = connect(
         database=database,
         charset='ISO8859_1',
@@ -21,37 +39,258 @@ def connect_to_db(database):
 #     return conn
 
 
+# Table and column names can not be bound parameters, they are checked before they are put in SQL.
+# Firebird pads the names in its system tables with spaces.
+def check_identifier(name):
+    name = str(name).strip()
+    if not identifier_pattern.match(name):
+        raise ValueError("Invalid table or column name: " + repr(name))
+    return name
+
+
 def get_table_columns(cr, table_name):
-    sql_string = f"""
+    sql_string = """
                 select rdb$field_name
                 from rdb$relation_fields
-                where rdb$relation_name='{table_name}'
+                where rdb$relation_name = ?
                 order by rdb$field_position;
                 """
-    cr.execute(sql_string)
+    cr.execute(sql_string, [check_identifier(table_name)])
     return cr.fetchall()
 
 
-def get_table_rows(cr, table_name, columns=None):
+# Highest value of each of the columns, e.g. ID, CREATED and MODIFIED, used as the high-water
+# mark of a table for delta migrations.
+def get_table_watermark(cr, table_name, columns):
+    columns_string = ",".join(f"max({check_identifier(col)})" for col in columns)
+    sql_string = f"""
+                select {columns_string}
+                from {check_identifier(table_name)}
+                """
+    cr.execute(sql_string)
+    return dict(zip(columns, cr.fetchone()))
+
+
+# Selects the rows where any of the columns is above its watermark value. Columns without a
+# value (empty table) are left out, without any column every row is selected.
+def get_watermark_condition(watermark):
+    columns = [col for col in watermark if watermark[col] is not None]
+    condition = " or ".join(f"{check_identifier(col)} > ?" for col in columns)
+    return condition, [watermark[col] for col in columns]
+
+
+# Filters are (column, operator, value) triples that all have to hold, e.g. ("GEFACTUREERD", "!=", "T").
+# Like in Python, null is only equal to None, so != and not in also select the rows without a value.
+def get_filter_conditions(filters):
+    conditions = []
+    for col, operator, value in filters or []:
+        col = check_identifier(col)
+        if operator not in filter_operators:
+            raise ValueError("Invalid filter operator: " + repr(operator))
+        if value is None:
+            if operator not in ["=", "!="]:
+                raise ValueError("Only = and != can compare with None")
+            conditions.append((f"{col} is not null" if operator == "!=" else f"{col} is null", []))
+        elif operator in ["in", "not in"]:
+            values = list(value)
+            if not values:
+                conditions.append(("1 = 1" if operator == "not in" else "1 = 0", []))
+                continue
+            value_lists = [values[start:start + max_in_values] for start in range(0, len(values), max_in_values)]
+            if operator == "in":
+                condition = " or ".join(f"{col} in ({','.join('?' * len(value_list))})" for value_list in value_lists)
+            else:
+                condition = "(" + " and ".join(f"{col} not in ({','.join('?' * len(value_list))})" for value_list in value_lists) + f") or {col} is null"
+            conditions.append((condition, values))
+        elif operator == "!=":
+            conditions.append((f"{col} <> ? or {col} is null", [value]))
+        else:
+            conditions.append((f"{col} {operator} ?", [value]))
+    return conditions
+
+
+# Only the columns are read and only the rows selected by the filters, the watermark and conditions,
+# a list of (condition, params) pairs like the ID range of a partition. order_by is a list of columns.
+def execute_table_select(cr, table_name, columns=None, order_by=None, watermark=None, conditions=None, filters=None):
     if not columns:
         table_cols = get_table_columns(cr, table_name)
         columns = [str(col[0]) for col in table_cols]
-    columns_string = ",".join(columns)
+    columns_string = ",".join(check_identifier(col) for col in columns)
     sql_string = f"""
                 select {columns_string}
-                from {table_name}
+                from {check_identifier(table_name)}
                 """
-    cr.execute(sql_string)
+    conditions = list(conditions or []) + get_filter_conditions(filters)
+    watermark_condition, watermark_params = get_watermark_condition(watermark or {})
+    if watermark_condition:
+        conditions.append((watermark_condition, watermark_params))
+    params = []
+    if conditions:
+        sql_string += "where " + " and ".join(f"({condition})" for condition, condition_params in conditions) + "\n"
+        for condition, condition_params in conditions:
+            params.extend(condition_params)
+    if order_by:
+        sql_string += "order by " + ",".join(check_identifier(col) for col in order_by)
+    cr.execute(sql_string, params)
+    return columns
+
+
+def get_table_rows(cr, table_name, columns=None):
+    execute_table_select(cr, table_name, columns)
     return cr.fetchall()
 
 
-def get_table_values(cr, table_name, value_mapping):
+# Rows are fetched with fetchmany, so only one batch of rows is held in memory at a time.
+# Each streamed table needs its own cursor as long as its generator is not exhausted.
+def iter_table_row_batches(cr, table_name, columns=None, batch_size=default_batch_size, order_by=None, watermark=None, conditions=None, filters=None):
+    with metrics.timer("extract"):
+        execute_table_select(cr, table_name, columns, order_by, watermark, conditions, filters)
+    while True:
+        with metrics.timer("extract"):
+            rows = cr.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+
+# With records, values are record_helper.Record objects that keep the fetched row instead of a dict
+def iter_table_value_batches(cr, table_name, value_mapping, batch_size=default_batch_size, order_by=None, watermark=None, conditions=None, filters=None, records=False):
     columns = list(value_mapping.keys())
-    rows = get_table_rows(cr, table_name, columns)
     keys = [value_mapping[col] for col in columns]
-    res = []
-    for row in rows:
-        # row = map(lambda x: bytes(str(x or ''), 'utf-8'), row)
-        res.append(dict(zip(keys, row)))
-    return res
+    schema = Schema(keys)
+    for rows in iter_table_row_batches(cr, table_name, columns, batch_size, order_by, watermark, conditions, filters):
+        if records:
+            yield [Record(schema, row) for row in rows]
+        else:
+            yield [dict(zip(keys, row)) for row in rows]
+
+
+def iter_table_values(cr, table_name, value_mapping, batch_size=default_batch_size, order_by=None, watermark=None, filters=None, records=False, conditions=None):
+    for batch in iter_table_value_batches(cr, table_name, value_mapping, batch_size, order_by, watermark, conditions, filters, records):
+        yield from batch
+
+
+def get_table_values(cr, table_name, value_mapping, filters=None, order_by=None):
+    return list(iter_table_values(cr, table_name, value_mapping, order_by=order_by, filters=filters))
+
+
+# Values that split partition_column in ranges of the same width, one less than the partitions.
+# Without rows there is one partition, without bounds.
+def get_partition_bounds(cr, table_name, partition_column, partitions):
+    partition_column = check_identifier(partition_column)
+    sql_string = f"""
+                select min({partition_column}), max({partition_column})
+                from {check_identifier(table_name)}
+                """
+    cr.execute(sql_string)
+    low, high = cr.fetchone()
+    if low is None or partitions <= 1:
+        return []
+    step = (high - low) // partitions + 1
+    return [low + index * step for index in range(1, partitions)]
+
+
+# Selects the rows with a value from low up to high. Without low the rows without a value are
+# selected as well, and without high all rows from low.
+def get_range_conditions(column, low=None, high=None):
+    column = check_identifier(column)
+    if low is None and high is None:
+        return []
+    if low is None:
+        return [(f"{column} < ? or {column} is null", [high])]
+    if high is None:
+        return [(f"{column} >= ?", [low])]
+    return [(f"{column} >= ? and {column} < ?", [low, high])]
+
+
+# The ranges between the bounds, as (low, high) pairs from (None, first bound) to (last bound, None)
+def get_bound_ranges(bounds):
+    return list(zip([None] + list(bounds), list(bounds) + [None]))
+
+
+# Splits the values of partition_column in ranges of the same width. Rows without a value belong
+# to the first partition and rows above the current maximum to the last one.
+def get_partition_conditions(cr, table_name, partition_column, partitions):
+    bounds = get_partition_bounds(cr, table_name, partition_column, partitions)
+    return [get_range_conditions(partition_column, low, high) for low, high in get_bound_ranges(bounds)]
+
+
+# Blobs are read on the connection of the partition, a BlobReader can not be passed to another thread
+@metrics.timed("extract")
+def read_blob_values(batch):
+    for vals in batch:
+        if isinstance(vals, Record):
+            if any(hasattr(value, "read") for value in vals.values):
+                vals.values = tuple(value.read() if hasattr(value, "read") else value for value in vals.values)
+            continue
+        for key, value in vals.items():
+            if hasattr(value, "read"):
+                vals[key] = value.read()
+    return batch
+
+
+# Reads a table in ranges of partition_column (ID, or DOSSIER_ID for tables of a case) on one
+# connection per partition, opened with connect(), and yields the same values as iter_table_values.
+# Without order_by, batches are yielded in the order they are read. With order_by, the partitions
+# are yielded one after the other while the next ones are read ahead (up to prefetch_batches each),
+# so when order_by starts with partition_column the values come in the same order as one select.
+# With one partition the table is only read ahead on its own connection, so the rows are fetched
+# while the batches before them are preprocessed and sent. conditions, like the case range of a
+# shard (see get_range_conditions), are added to the range of every partition.
+def iter_partitioned_table_values(connect, table_name, value_mapping, partition_column="ID", partitions=default_partitions, batch_size=default_batch_size,
+                                  order_by=None, watermark=None, filters=None, records=False, prefetch_batches=default_prefetch_batches, conditions=None):
+    if partitions <= 1:
+        partition_conditions = [[]]
+    else:
+        con = connect()
+        try:
+            partition_conditions = get_partition_conditions(con.cursor(), table_name, partition_column, partitions)
+        finally:
+            con.close()
+    if order_by:
+        partition_queues = [queue.Queue(prefetch_batches) for range_conditions in partition_conditions]
+    else:
+        partition_queues = [queue.Queue(prefetch_batches * len(partition_conditions))] * len(partition_conditions)
+    stopped = threading.Event()
+
+    def put(batches, item):
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read_partition(range_conditions, batches):
+        try:
+            partition_con = connect()
+            try:
+                for batch in iter_table_value_batches(partition_con.cursor(), table_name, value_mapping, batch_size, order_by, watermark, range_conditions + list(conditions or []), filters, records):
+                    put(batches, read_blob_values(batch))
+                    if stopped.is_set():
+                        return
+            finally:
+                partition_con.close()
+            put(batches, None)
+        except Exception as e:
+            put(batches, e)
 
+    threads = [threading.Thread(target=in_current_context(read_partition), args=(range_conditions, batches), daemon=True)
+               for range_conditions, batches in zip(partition_conditions, partition_queues)]
+    for thread in threads:
+        thread.start()
+    try:
+        # Every partition ends with None, or with the exception that stopped it. Without order_by
+        # all partitions share one queue, which is read until every partition ended.
+        for batches in partition_queues:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield from batch
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,83 @@
+import time
+import argparse
+from itertools import islice
+
+from themis_helper import connect_to_db, iter_table_values
+from snapshot_helper import connect_to_snapshot
+from transport_helper import CompressedRequestBody, transports
+from odoo_helper import *
+from main import record_tables, user_value_mapping, company_value_mapping, contact_value_mapping, case_value_mapping, party_value_mapping, timesheet_value_mapping, cost_value_mapping, document_value_mapping
+
+
+# Compares how long each transport takes to serialize real stage payloads and how large the
+# request bodies are. Mappings to Odoo ids are left empty: they do not change the payload shape.
+def get_stage_payloads(document_path):
+    yield "users", "res.users", "create_from_themis", preprocess_user_values, user_value_mapping, "GEBRUIKER"
+    yield "companies", "res.partner", "create_from_themis", lambda vals: preprocess_company_values(vals, {}, {}), company_value_mapping, "BEDRIJF"
+    yield "contacts", "res.partner", "create_from_themis", lambda vals: preprocess_contact_values(vals, {}, {}, {}), contact_value_mapping, "ADRESBOEK"
+    yield "cases", "cases.case", "create_from_themis", lambda vals: preprocess_case_values(vals, {}, {}, {}, {}), case_value_mapping, "DOSSIER"
+    yield "parties", "cases.party", "create", lambda vals: preprocess_party_values(vals, {}, {}, {}, {}, {}, {}), party_value_mapping, "DOSSIERADRESBOEK"
+    yield "timesheets", "cases.case", "create_timesheets_costs_from_themis", lambda vals: preprocess_timesheet_values(vals, {}, {}, {}, {}, {}, {}, {}), timesheet_value_mapping, "DOSSIERTIJD"
+    yield "costs", "cases.case", "create_timesheets_costs_from_themis", lambda vals: preprocess_cost_values(vals, {}, {}, {}, {}), cost_value_mapping, "DOSSIERKOST"
+    if document_path:
+        def preprocess_documents(vals):
+            for v in vals:
+                v.pop("id")
+            vals[:] = [v for v in vals if v["case_id"] and preprocess_document_values(v, document_path, {}, {}, {}, {})]
+        yield "documents", "cases.document", "create_from_themis", preprocess_documents, document_value_mapping, "DOSSIERDOCUMENT"
+
+
+# With compression the size of the compressed body and the time it takes to compress are added
+def benchmark_payload(vals, model, method, repeat, compression=None):
+    args = [vals, []] if method == "create_timesheets_costs_from_themis" else [vals]
+    result = {}
+    for protocol, transport in transports.items():
+        connection = transport("http://localhost")
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            body = connection.dumps("object", "execute_kw", "database", 2, "secret", model, method, args)
+            # Document contents are only encoded while the body is written out
+            for chunk in body:
+                pass
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        result[protocol] = (best, len(body))
+        if compression:
+            start = time.perf_counter()
+            compressed_body = CompressedRequestBody(connection.dumps("object", "execute_kw", "database", 2, "secret", model, method, args), compression)
+            result[protocol] += (time.perf_counter() - start, len(compressed_body))
+            compressed_body.close()
+    return result
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compare XML-RPC and JSON-RPC serialization of Themis stage payloads")
+    parser.add_argument("-tdb", dest="themisdb", help="Path to the Themis database, required unless --from-snapshot is given")
+    parser.add_argument("--from-snapshot", dest="fromsnapshot", help="Read the Themis tables from a snapshot written with main.py --extract")
+    parser.add_argument("-tdf", dest="documentpath", help="Path to the Themis documents folder, documents are skipped if not given")
+    parser.add_argument("-n", dest="rows", type=int, default=5000, help="Number of rows per stage")
+    parser.add_argument("-r", dest="repeat", type=int, default=3, help="Number of serializations per stage, the best is reported")
+    parser.add_argument("-cz", dest="compression", choices=["gzip", "zstd"], help="Also report the compressed size of the bodies and the time it takes to serialize and compress them")
+    args = parser.parse_args()
+    if not args.themisdb and not args.fromsnapshot:
+        parser.error("-tdb or --from-snapshot is required")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    con = connect_to_snapshot(args.fromsnapshot) if args.fromsnapshot else connect_to_db(args.themisdb)
+    header = "{:<12} {:>7} {:>12} {:>12} {:>14} {:>14}".format("stage", "rows", "xmlrpc s", "jsonrpc s", "xmlrpc bytes", "jsonrpc bytes")
+    if args.compression:
+        header += " {:>12} {:>12} {:>14} {:>14}".format("xmlrpc cz s", "jsonrpc cz s", "xmlrpc cz", "jsonrpc cz")
+    print(header)
+    for stage, model, method, preprocess, value_mapping, table_name in get_stage_payloads(args.documentpath):
+        vals = list(islice(iter_table_values(con.cursor(), table_name, value_mapping, records=table_name in record_tables), args.rows))
+        preprocess(vals)
+        result = benchmark_payload(vals, model, method, args.repeat, args.compression)
+        line = "{:<12} {:>7} {:>12.4f} {:>12.4f} {:>14} {:>14}".format(stage, len(vals), result["xmlrpc"][0], result["jsonrpc"][0], result["xmlrpc"][1], result["jsonrpc"][1])
+        if args.compression:
+            line += " {:>12.4f} {:>12.4f} {:>14} {:>14}".format(result["xmlrpc"][2], result["jsonrpc"][2], result["xmlrpc"][3], result["jsonrpc"][3])
+        print(line)
+    con.close()
@@ -0,0 +1,325 @@
+import os
+import re
+import mmap
+import json
+import zlib
+import uuid
+import base64
+import hashlib
+import tempfile
+import weakref
+import http.client
+import xmlrpc.client
+from decimal import Decimal
+from datetime import date, datetime
+from itertools import count
+from urllib.parse import urlsplit
+
+from record_helper import Record
+from metrics_helper import metrics
+
+
+# Multiple of 3, so every chunk encodes to base64 without padding
+encode_chunk_size = 3 * 1024 * 1024
+mmap_threshold = 16 * 1024 * 1024
+
+document_token_prefix = "themis-document-"
+document_token_pattern = re.compile(("(" + document_token_prefix + "[0-9a-f]{32})").encode("ascii"))
+document_files = weakref.WeakValueDictionary()
+
+# Content encodings of compressed request bodies, with their compression level
+compression_levels = {
+    "gzip": 6,
+    "zstd": 3,
+}
+# Compressed request bodies larger than this are kept in a temporary file instead of in memory
+compression_spool_size = 8 * 1024 * 1024
+
+
+class JsonRpcError(Exception):
+    def __init__(self, message, data=None):
+        super().__init__(message)
+        self.data = data or {}
+
+
+# Stands in for the base64 encoded content of a file in a request. Requests are serialized with
+# a token in its place, and the file is only read and encoded chunk by chunk while the request
+# body is written to the socket. Its encoded size is known from the file size up front.
+# With hash_content the SHA-1 of the content (see document_helper.hash_file) is computed while it
+# is sent, it is content_hash once the whole file went out.
+class DocumentFile:
+    def __init__(self, path, size=None, mtime_ns=None):
+        self.path = path
+        self.size = os.path.getsize(path) if size is None else size
+        # Modification time of an indexed file, see document_helper.DocumentIndex
+        self.mtime_ns = mtime_ns
+        self.encoded_size = 4 * ((self.size + 2) // 3)
+        self.token = document_token_prefix + uuid.uuid4().hex
+        self.hash_content = False
+        self.content_hash = None
+        document_files[self.token] = self
+
+    def iter_encoded(self):
+        encoded_size = 0
+        content_hash = hashlib.sha1() if self.hash_content else None
+        with open(self.path, "rb") as data:
+            if self.size >= mmap_threshold:
+                with mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    for start in range(0, len(view), encode_chunk_size):
+                        block = view[start:start + encode_chunk_size]
+                        if content_hash:
+                            content_hash.update(block)
+                        chunk = base64.b64encode(block)
+                        encoded_size += len(chunk)
+                        yield chunk
+            else:
+                for block in iter(lambda: data.read(encode_chunk_size), b""):
+                    if content_hash:
+                        content_hash.update(block)
+                    chunk = base64.b64encode(block)
+                    encoded_size += len(chunk)
+                    yield chunk
+        if encoded_size != self.encoded_size:
+            raise IOError("File " + self.path + " changed while it was being sent.")
+        if content_hash:
+            self.content_hash = content_hash.hexdigest()
+
+
+# Request body made of serialized bytes and DocumentFile parts. Its length is exact before
+# anything is read, and it can be iterated again when a request is retried.
+class RequestBody:
+    def __init__(self, data):
+        self.parts = []
+        for index, part in enumerate(document_token_pattern.split(data)):
+            if index % 2:
+                self.parts.append(document_files[part.decode("ascii")])
+            elif part:
+                self.parts.append(part)
+
+    def __len__(self):
+        return sum(part.encoded_size if isinstance(part, DocumentFile) else len(part) for part in self.parts)
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, DocumentFile):
+                yield from part.iter_encoded()
+            else:
+                yield part
+
+
+def get_compressor(encoding):
+    if encoding == "gzip":
+        return zlib.compressobj(compression_levels["gzip"], zlib.DEFLATED, 31)
+    if encoding == "zstd":
+        # zstd is in the standard library from Python 3.14, before that it needs the zstandard package
+        try:
+            from compression import zstd
+            return zstd.ZstdCompressor(compression_levels["zstd"])
+        except ImportError:
+            import zstandard
+            return zstandard.ZstdCompressor(level=compression_levels["zstd"]).compressobj()
+    raise ValueError("Unknown content encoding: " + repr(encoding))
+
+
+# Request body compressed with a content encoding. The body is compressed chunk by chunk while it
+# is read, document contents included, and its compressed length is only known afterwards, so it
+# is written to a temporary file first. It can be iterated again when a request is retried.
+class CompressedRequestBody:
+    def __init__(self, request_body, encoding):
+        self.encoding = encoding
+        self.data = tempfile.SpooledTemporaryFile(compression_spool_size)
+        compressor = get_compressor(encoding)
+        for chunk in request_body:
+            self.data.write(compressor.compress(chunk))
+        self.data.write(compressor.flush())
+        self.size = self.data.tell()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        self.data.seek(0)
+        return iter(lambda: self.data.read(encode_chunk_size), b"")
+
+    def close(self):
+        self.data.close()
+
+
+def dump_document_file(marshaller, value, write):
+    write("<value><string>")
+    write(value.token)
+    write("</string></value>\n")
+
+
+xmlrpc.client.Marshaller.dispatch[DocumentFile] = dump_document_file
+
+
+def dump_record(marshaller, value, write):
+    marshaller.dump_struct(value.to_dict(), write)
+
+
+xmlrpc.client.Marshaller.dispatch[Record] = dump_record
+
+
+class RequestBodyTransportMixin:
+    # xmlrpc.client retries a request once on a new connection when the kept-alive one was closed
+    def request(self, host, handler, request_body, verbose=False):
+        self.attempts = 0
+        return super().request(host, handler, request_body, verbose)
+
+    def single_request(self, host, handler, request_body, verbose=False):
+        self.attempts += 1
+        if self.attempts > 1:
+            metrics.count("retries")
+        return super().single_request(host, handler, request_body, verbose)
+
+    def send_content(self, connection, request_body):
+        if isinstance(request_body, CompressedRequestBody):
+            connection.putheader("Content-Encoding", request_body.encoding)
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders()
+        for chunk in request_body:
+            connection.send(chunk)
+
+
+class XmlRpcTransport(RequestBodyTransportMixin, xmlrpc.client.Transport):
+    pass
+
+
+class XmlRpcSafeTransport(RequestBodyTransportMixin, xmlrpc.client.SafeTransport):
+    pass
+
+
+# With compression (a key of compression_levels) request bodies are sent with that content
+# encoding, see OdooSession for the check that the server accepts them.
+class XmlRpcConnection:
+    def __init__(self, url, compression=None):
+        self.url = url
+        self.compression = compression
+        parts = urlsplit(url)
+        self.transport = XmlRpcSafeTransport() if parts.scheme == "https" else XmlRpcTransport()
+        self.host = parts.netloc
+        self.path = parts.path.rstrip("/") + "/xmlrpc/2/"
+
+    def dumps(self, service, method, *args):
+        return RequestBody(xmlrpc.client.dumps(args, method, allow_none=True).encode("utf-8"))
+
+    @staticmethod
+    def encoded_size(value):
+        return len(RequestBody(xmlrpc.client.dumps((value,), allow_none=True).encode("utf-8")))
+
+    def call(self, service, method, *args):
+        body = self.dumps(service, method, *args)
+        if self.compression:
+            body = CompressedRequestBody(body, self.compression)
+        metrics.count("request_bytes", len(body))
+        try:
+            response = self.transport.request(self.host, self.path + service, body)
+        finally:
+            if self.compression:
+                body.close()
+        if len(response) == 1:
+            response = response[0]
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+# XML-RPC marshals bytes as base64 to keep control characters out of the XML body (see
+# odoo_helper.convert_values_to_bytes). JSON has no such restriction, so bytes are sent as text.
+def json_default(value):
+    if isinstance(value, DocumentFile):
+        return value.token
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+
+def json_dumps(value):
+    return json.dumps(value, default=json_default, separators=(",", ":")).encode("utf-8")
+
+
+class JsonRpcConnection:
+    def __init__(self, url, compression=None):
+        self.url = url
+        self.compression = compression
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.netloc
+        self.path = parts.path.rstrip("/") + "/jsonrpc"
+        self.connection = None
+        self.request_ids = count(1)
+
+    def dumps(self, service, method, *args):
+        return RequestBody(json_dumps({
+            "jsonrpc": "2.0",
+            "method": "call",
+            "params": {"service": service, "method": method, "args": args},
+            "id": next(self.request_ids),
+        }))
+
+    @staticmethod
+    def encoded_size(value):
+        return len(RequestBody(json_dumps(value)))
+
+    def post(self, body):
+        if self.connection is None:
+            self.connection = self.connection_class(self.host)
+        headers = {"Content-Type": "application/json", "Content-Length": str(len(body))}
+        if isinstance(body, CompressedRequestBody):
+            headers["Content-Encoding"] = body.encoding
+        # A request that fails half way (e.g. a document that can not be read or a timeout) leaves
+        # the connection unusable, the next call opens a new one, like xmlrpc.client.Transport
+        try:
+            self.connection.request("POST", self.path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except BaseException:
+            self.close()
+            raise
+        if response.will_close:
+            self.close()
+        if response.status != 200:
+            raise JsonRpcError("HTTP " + str(response.status) + " " + response.reason)
+        return json.loads(data)
+
+    def call(self, service, method, *args):
+        body = self.dumps(service, method, *args)
+        if self.compression:
+            body = CompressedRequestBody(body, self.compression)
+        metrics.count("request_bytes", len(body))
+        try:
+            try:
+                result = self.post(body)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed the idle keep-alive connection, retry once on a new one
+                metrics.count("retries")
+                self.close()
+                result = self.post(body)
+        finally:
+            if self.compression:
+                body.close()
+        if result.get("error"):
+            error = result["error"]
+            raise JsonRpcError(error.get("data", {}).get("message") or error.get("message", ""), error.get("data"))
+        return result.get("result")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+transports = {
+    "xmlrpc": XmlRpcConnection,
+    "jsonrpc": JsonRpcConnection,
+}